@@ -20,6 +20,7 @@ from apps.accounts.serializers.account_settings_serializer import AccountSetting
 from apps.accounts.serializers.user_account_serializer import UserAccountSerializer, AddressUpdateSerializer
 from apps.accounts.serializers.user_serializer import UserSerializer
 from apps.accounts.tokens import accountActivationTokenGenerator
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
 
 from apps.merchants.models import Branch, MerchantBusiness
 from apps.orders.models import Order
@@ -477,13 +478,10 @@ class UpdateAddressView(APIView):
             return kwargs["query"]
 
         def search_for_address_in_gmaps(query):
-            gmaps_client = googlemaps.Client(key=settings.GOOGLE_SERVICES_API_KEY)
-            address_results = googlemaps.places.find_place(
-                client=gmaps_client,
-                input=query,
-                input_type="textquery",
+            address_results = GoogleMapsInstance().find_place(
+                query,
                 fields=["formatted_address"],
-            )   
+            )
             return address_results["candidates"]
 
         def success_response(address_results):
@@ -496,7 +494,7 @@ class UpdateAddressView(APIView):
             )
 
         try:
-            query = get_the_address_search_query(),
+            query = get_the_address_search_query()
             address_results = search_for_address_in_gmaps(query)
             return success_response(address_results)
         except Exception as e:
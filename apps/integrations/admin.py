@@ -1,3 +1,22 @@
 from django.contrib import admin
 
-# Register your models here.
+from apps.integrations.models import GoogleMapsCacheEntry
+from custom_admin_site import custom_admin_site
+
+
+class GoogleMapsCacheEntryAdmin(admin.ModelAdmin):
+
+    list_display = ["endpoint", "hits", "created", "last_used", "expires_at"]
+
+    list_filter = ["endpoint"]
+
+    readonly_fields = ["key", "endpoint", "response", "created", "last_used", "expires_at", "hits"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+custom_admin_site.register(GoogleMapsCacheEntry, GoogleMapsCacheEntryAdmin)
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+import googlemaps
+import googlemaps.geocoding
+import googlemaps.places
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from apps.integrations import outbound_pool
+from apps.integrations.models import GoogleMapsCacheEntry
+from global_utils import GlobalUtils
+
+
+class GoogleMapsInstance(GlobalUtils):
+
+    """
+    Wraps the Google Maps calls we make so that their responses are cached in the
+    database. Coordinates are rounded to GOOGLE_MAPS_CACHE["COORDINATE_PRECISION"]
+    decimal places so customers standing close to each other share entries.
+    """
+
+    # hit and miss counters for this process:
+    cache_stats = {"hits": 0, "misses": 0}
+    cache_stats_lock = threading.Lock()
+    # when this process last evicted entries:
+    last_evicted = None
+
+    def __init__(self):
+        self.cache_settings = settings.GOOGLE_MAPS_CACHE
+        self._client = None
+
+    @property
+    def client(self):
+        # only create the client when we actually have to call google:
+        if self._client is None:
+            # bounded so a slow response can't hold a worker forever:
+            timeout = settings.OUTBOUND_POOL["TIMEOUT_SECONDS"]
+            self._client = googlemaps.Client(
+                key=settings.GOOGLE_SERVICES_API_KEY, timeout=timeout, retry_timeout=timeout
+            )
+        return self._client
+
+    @classmethod
+    def get_cache_stats(cls):
+        with cls.cache_stats_lock:
+            hits = cls.cache_stats["hits"]
+            misses = cls.cache_stats["misses"]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+        }
+
+    def quantize_coordinates(self, coordinates):
+        precision = self.cache_settings["COORDINATE_PRECISION"]
+        latitude, longitude = [float(value) for value in str(coordinates).split(",")]
+        return f"{latitude:.{precision}f},{longitude:.{precision}f}"
+
+    def reverse_geocode(self, coordinates):
+        return self.start_reverse_geocode(coordinates, in_background=False)()
+
+    def start_reverse_geocode(self, coordinates, in_background=True):
+        """
+        Start a reverse geocode and return a function that waits for its response. On a
+        cache miss the Google call runs on the outbound pool so the caller can get on
+        with other work in the meantime.
+        """
+        coordinates = self.quantize_coordinates(coordinates)
+        return self.start_get_or_fetch(
+            "reverse_geocode",
+            {"coordinates": coordinates},
+            lambda: googlemaps.geocoding.reverse_geocode(self.client, coordinates),
+            in_background=in_background,
+        )
+
+    def geocode(self, address):
+        address = " ".join(str(address).split())
+        return self.get_or_fetch(
+            "geocode",
+            {"address": address.lower()},
+            lambda: googlemaps.geocoding.geocode(self.client, address),
+        )
+
+    def find_place(self, query, fields, location_bias=None):
+        query = " ".join(str(query).split())
+        params = {"query": query.lower(), "fields": sorted(fields)}
+        if location_bias:
+            params["location_bias"] = location_bias
+        return self.get_or_fetch(
+            "find_place",
+            params,
+            lambda: googlemaps.places.find_place(
+                client=self.client,
+                input=query,
+                input_type="textquery",
+                fields=fields,
+                location_bias=location_bias,
+            ),
+        )
+
+    def get_or_fetch(self, endpoint, params, fetch):
+        return self.start_get_or_fetch(endpoint, params, fetch, in_background=False)()
+
+    def start_get_or_fetch(self, endpoint, params, fetch, in_background=True):
+        # the cache is read and written on the calling thread, only the fetch runs on the pool:
+        key = self.make_key(endpoint, params)
+
+        cached_response = self.get_cached_response(key)
+        if cached_response is not None:
+            self._count("hits")
+            return lambda: cached_response
+
+        self._count("misses")
+        get_response = outbound_pool.submit(endpoint, fetch).result if in_background else fetch
+
+        def wait_for_response():
+            response = get_response()
+            self.cache_response(key, endpoint, response)
+            return response
+
+        return wait_for_response
+
+    def make_key(self, endpoint, params):
+        serialized_params = json.dumps(params, sort_keys=True)
+        return f"{endpoint}:{hashlib.sha256(serialized_params.encode()).hexdigest()}"
+
+    def get_cached_response(self, key):
+        try:
+            now = timezone.now()
+            entry = (
+                GoogleMapsCacheEntry.objects.filter(key=key, expires_at__gt=now)
+                .values_list("response", flat=True)
+                .first()
+            )
+            if entry is not None:
+                # keep track of recently used entries for lru eviction:
+                GoogleMapsCacheEntry.objects.filter(key=key).update(
+                    hits=F("hits") + 1, last_used=now
+                )
+            return entry
+        except Exception as e:
+            self.logger.warning(f"Failed to read the Google Maps cache: {e}")
+            return None
+
+    def get_cached_responses(self, keys):
+        # get_cached_response for many keys with a single read:
+        try:
+            now = timezone.now()
+            entries = dict(
+                GoogleMapsCacheEntry.objects.filter(key__in=keys, expires_at__gt=now)
+                .values_list("key", "response")
+            )
+            if entries:
+                GoogleMapsCacheEntry.objects.filter(key__in=entries).update(
+                    hits=F("hits") + 1, last_used=now
+                )
+            return entries
+        except Exception as e:
+            self.logger.warning(f"Failed to read the Google Maps cache: {e}")
+            return {}
+
+    def cache_response(self, key, endpoint, response):
+        try:
+            now = timezone.now()
+            GoogleMapsCacheEntry.objects.update_or_create(
+                key=key,
+                defaults={
+                    "endpoint": endpoint,
+                    "response": response,
+                    "expires_at": now + timedelta(seconds=self.cache_settings["TTL_SECONDS"]),
+                    "last_used": now,
+                },
+            )
+            self.evict_if_due()
+        except Exception as e:
+            self.logger.warning(f"Failed to write to the Google Maps cache: {e}")
+
+    def cache_responses(self, endpoint, responses, ttl_seconds=None):
+        # cache_response for many keys at once, responses is {key: response}:
+        try:
+            now = timezone.now()
+            ttl_seconds = ttl_seconds or self.cache_settings["TTL_SECONDS"]
+            GoogleMapsCacheEntry.objects.filter(key__in=responses).delete()
+            GoogleMapsCacheEntry.objects.bulk_create(
+                [
+                    GoogleMapsCacheEntry(
+                        key=key,
+                        endpoint=endpoint,
+                        response=response,
+                        expires_at=now + timedelta(seconds=ttl_seconds),
+                        last_used=now,
+                    )
+                    for key, response in responses.items()
+                ],
+                ignore_conflicts=True,
+            )
+            self.evict_if_due()
+        except Exception as e:
+            self.logger.warning(f"Failed to write to the Google Maps cache: {e}")
+
+    def evict_if_due(self):
+        # eviction reads the whole table, so it runs every few minutes instead of on every miss:
+        now = time.monotonic()
+        with self.cache_stats_lock:
+            last_evicted = GoogleMapsInstance.last_evicted
+            if last_evicted is not None and now - last_evicted < self.cache_settings["EVICT_EVERY_SECONDS"]:
+                return
+            GoogleMapsInstance.last_evicted = now
+        self.evict_least_recently_used()
+
+    def evict_least_recently_used(self):
+        max_entries = self.cache_settings["MAX_ENTRIES"]
+
+        # expired entries are always the first to go:
+        GoogleMapsCacheEntry.objects.filter(expires_at__lte=timezone.now()).delete()
+
+        # then the least recently used ones until we are back under the limit:
+        cutoff = list(
+            GoogleMapsCacheEntry.objects.order_by("-last_used")
+            .values_list("last_used", flat=True)[max_entries:max_entries + 1]
+        )
+        if cutoff:
+            GoogleMapsCacheEntry.objects.filter(last_used__lte=cutoff[0]).delete()
+
+    def _count(self, stat, count=1):
+        with self.cache_stats_lock:
+            self.cache_stats[stat] += count
@@ -1,3 +1,20 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class GoogleMapsCacheEntry(models.Model):
+
+    key = models.CharField(max_length=191, unique=True)
+    endpoint = models.CharField(max_length=50, db_index=True)
+    response = models.JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+    hits = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Google Maps cache entry"
+        verbose_name_plural = "Google Maps cache entries"
+
+    def __str__(self) -> str:
+        return f"{self.endpoint} - {self.hits} hits"
@@ -0,0 +1,90 @@
+"""
+A bounded thread pool shared by the outbound (third party HTTP) calls our views make, so
+independent calls can run at the same time as each other and as the local work of the
+request. Only the HTTP calls themselves should run on the pool: database work stays on
+the request thread.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# time spent in outbound calls vs time requests actually spent waiting for them:
+stats = {"calls": 0, "timeouts": 0, "call_seconds": 0.0, "wait_seconds": 0.0}
+stats_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.OUTBOUND_POOL["MAX_WORKERS"],
+                thread_name_prefix="outbound",
+            )
+    return _executor
+
+
+class OutboundCall():
+
+    def __init__(self, name, fn, *args, **kwargs):
+        self.name = name
+        self.duration = None
+        self.future = get_executor().submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.duration = time.perf_counter() - started
+
+    def result(self, timeout=None):
+        if timeout is None:
+            timeout = settings.OUTBOUND_POOL["TIMEOUT_SECONDS"]
+
+        started = time.perf_counter()
+        try:
+            return self.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.future.cancel()
+            _record(timed_out=True)
+            raise Exception(f"{self.name} timed out after {timeout} seconds")
+        finally:
+            waited = time.perf_counter() - started
+            if self.duration is not None:
+                _record(call_seconds=self.duration, wait_seconds=waited)
+
+
+def submit(name, fn, *args, **kwargs):
+    return OutboundCall(name, fn, *args, **kwargs)
+
+
+def _record(call_seconds=0.0, wait_seconds=0.0, timed_out=False):
+    with stats_lock:
+        if timed_out:
+            stats["timeouts"] += 1
+        else:
+            stats["calls"] += 1
+            stats["call_seconds"] += call_seconds
+            stats["wait_seconds"] += wait_seconds
+
+
+def get_stats():
+    with stats_lock:
+        current_stats = dict(stats)
+    # whatever part of a call the request didn't have to wait for ran alongside other work:
+    saved_seconds = max(current_stats["call_seconds"] - current_stats["wait_seconds"], 0.0)
+    return {
+        "calls": current_stats["calls"],
+        "timeouts": current_stats["timeouts"],
+        "call_seconds": round(current_stats["call_seconds"], 4),
+        "wait_seconds": round(current_stats["wait_seconds"], 4),
+        "saved_seconds": round(saved_seconds, 4),
+    }
@@ -1,3 +1,189 @@
-from django.test import TestCase
+import threading
+import time
+from concurrent import futures
+from datetime import timedelta
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from apps.integrations import outbound_pool
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+from apps.integrations.models import GoogleMapsCacheEntry
+
+
+class GoogleMapsCacheTests(TestCase):
+
+    reverse_geocode_response = [{"formatted_address": "115 Musgrave Rd, Berea, Durban, 4001"}]
+
+    def setUp(self):
+        GoogleMapsInstance.cache_stats = {"hits": 0, "misses": 0}
+        GoogleMapsInstance.last_evicted = None
+
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_reverse_geocode_is_shared_by_nearby_coordinates(self, _, mocked_reverse_geocode):
+        mocked_reverse_geocode.return_value = self.reverse_geocode_response
+
+        # two customers a few metres apart:
+        first_response = GoogleMapsInstance().reverse_geocode("-29.84691,31.00342")
+        second_response = GoogleMapsInstance().reverse_geocode("-29.84688,31.00339")
+
+        self.assertEqual(first_response, self.reverse_geocode_response)
+        self.assertEqual(second_response, self.reverse_geocode_response)
+        self.assertEqual(mocked_reverse_geocode.call_count, 1)
+        self.assertEqual(
+            GoogleMapsInstance.get_cache_stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5}
+        )
+        self.assertEqual(GoogleMapsCacheEntry.objects.get().hits, 1)
+
+    @patch("googlemaps.places.find_place")
+    @patch("googlemaps.Client")
+    def test_find_place_queries_are_normalized(self, _, mocked_find_place):
+        mocked_find_place.return_value = {"candidates": [{"formatted_address": "71 Rethman Street"}]}
+
+        GoogleMapsInstance().find_place("71 Rethman  Street", fields=["formatted_address"])
+        GoogleMapsInstance().find_place("71 rethman street ", fields=["formatted_address"])
+
+        self.assertEqual(mocked_find_place.call_count, 1)
+
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_expired_entries_are_refreshed(self, _, mocked_reverse_geocode):
+        mocked_reverse_geocode.return_value = self.reverse_geocode_response
+
+        GoogleMapsInstance().reverse_geocode("-29.8469,31.0034")
+        GoogleMapsCacheEntry.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        GoogleMapsInstance().reverse_geocode("-29.8469,31.0034")
+
+        self.assertEqual(mocked_reverse_geocode.call_count, 2)
+        self.assertEqual(GoogleMapsCacheEntry.objects.count(), 1)
+
+    @override_settings(
+        GOOGLE_MAPS_CACHE={
+            "TTL_SECONDS": 3600, "MAX_ENTRIES": 2, "EVICT_EVERY_SECONDS": 0, "COORDINATE_PRECISION": 3
+        }
+    )
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_least_recently_used_entries_are_evicted(self, _, mocked_reverse_geocode):
+        mocked_reverse_geocode.return_value = self.reverse_geocode_response
+        google_maps = GoogleMapsInstance()
+
+        google_maps.reverse_geocode("-29.1,31.1")
+        google_maps.reverse_geocode("-29.2,31.2")
+
+        # use the first entry again so the second one becomes the least recently used:
+        GoogleMapsCacheEntry.objects.filter(
+            key=google_maps.make_key("reverse_geocode", {"coordinates": "-29.200,31.200"})
+        ).update(last_used=timezone.now() - timedelta(minutes=5))
+        google_maps.reverse_geocode("-29.1,31.1")
+
+        google_maps.reverse_geocode("-29.3,31.3")
+
+        cached_keys = set(
+            entry.key for entry in GoogleMapsCacheEntry.objects.all()
+        )
+        self.assertEqual(len(cached_keys), 2)
+        self.assertNotIn(
+            google_maps.make_key("reverse_geocode", {"coordinates": "-29.200,31.200"}),
+            cached_keys,
+        )
+
+    @patch.object(GoogleMapsInstance, "evict_least_recently_used")
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_eviction_does_not_run_on_every_miss(self, _, mocked_reverse_geocode, mocked_evict):
+        mocked_reverse_geocode.return_value = self.reverse_geocode_response
+
+        for index in range(5):
+            GoogleMapsInstance().reverse_geocode(f"-29.{index},31.{index}")
+
+        self.assertEqual(mocked_reverse_geocode.call_count, 5)
+        self.assertEqual(mocked_evict.call_count, 1)
+
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_stats_are_only_shown_to_admins(self, _, mocked_reverse_geocode):
+        mocked_reverse_geocode.return_value = self.reverse_geocode_response
+        GoogleMapsInstance().reverse_geocode("-29.8469,31.0034")
+        GoogleMapsInstance().reverse_geocode("-29.8469,31.0034")
+
+        user = User.objects.create(username="customer", email="customer@gmail.com")
+        token = Token.objects.create(user=user)
+        response = self.client.get(reverse("google_maps_cache_stats"), HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertIn(response.status_code, [401, 403])
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse("google_maps_cache_stats"), HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertEqual(response.data["stats"], {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+
+class OutboundPoolTests(TestCase):
+
+    reverse_geocode_response = [{"formatted_address": "115 Musgrave Rd, Berea, Durban, 4001"}]
+
+    def setUp(self):
+        outbound_pool.stats.update({"calls": 0, "timeouts": 0, "call_seconds": 0.0, "wait_seconds": 0.0})
+
+    def test_outbound_calls_overlap_with_local_work(self):
+        call = outbound_pool.submit("slow_call", time.sleep, 0.1)
+        # the request only asks for the response once the call has finished in the background:
+        futures.wait([call.future])
+        call.result()
+
+        stats = outbound_pool.get_stats()
+        self.assertEqual(stats["calls"], 1)
+        self.assertGreaterEqual(stats["call_seconds"], 0.1)
+        self.assertLess(stats["wait_seconds"], stats["call_seconds"])
+        self.assertAlmostEqual(stats["saved_seconds"], stats["call_seconds"] - stats["wait_seconds"], places=3)
+
+    @override_settings(OUTBOUND_POOL={"MAX_WORKERS": 8, "TIMEOUT_SECONDS": 0.05})
+    def test_slow_outbound_calls_time_out(self):
+        call = outbound_pool.submit("slow_call", time.sleep, 0.5)
+
+        with self.assertRaisesMessage(Exception, "slow_call timed out after 0.05 seconds"):
+            call.result()
+        self.assertEqual(outbound_pool.get_stats()["timeouts"], 1)
+
+    @patch("googlemaps.geocoding.reverse_geocode")
+    @patch("googlemaps.Client")
+    def test_reverse_geocode_runs_in_the_background(self, _, mocked_reverse_geocode):
+        google_answered = threading.Event()
+        lookup_finished = threading.Event()
+
+        def slow_reverse_geocode(*args):
+            google_answered.wait(timeout=5)
+            lookup_finished.set()
+            return self.reverse_geocode_response
+        mocked_reverse_geocode.side_effect = slow_reverse_geocode
+
+        # starting the lookup doesn't wait for google, the request gets on with its own work:
+        customer_address_lookup = GoogleMapsInstance().start_reverse_geocode("-29.84691,31.00342")
+        self.assertFalse(lookup_finished.is_set())
+        google_answered.set()
+        response = customer_address_lookup()
+
+        self.assertEqual(response, self.reverse_geocode_response)
+
+        # the response was cached by the request thread once it arrived:
+        self.assertEqual(GoogleMapsInstance().reverse_geocode("-29.84691,31.00342"), self.reverse_geocode_response)
+        self.assertEqual(mocked_reverse_geocode.call_count, 1)
+
+    def test_stats_are_only_shown_to_admins(self):
+        outbound_pool.submit("quick_call", lambda: None).result()
+
+        user = User.objects.create(username="customer", email="customer@gmail.com")
+        token = Token.objects.create(user=user)
+        response = self.client.get(reverse("outbound_pool_stats"), HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertIn(response.status_code, [401, 403])
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse("outbound_pool_stats"), HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertEqual(response.data["stats"]["calls"], 1)
+        self.assertIn("saved_seconds", response.data["stats"])
@@ -0,0 +1,7 @@
+from django.urls import path
+from .views import GoogleMapsCacheStatsView, OutboundPoolStatsView
+
+urlpatterns = [
+    path("google-maps-cache-stats/", GoogleMapsCacheStatsView.as_view(), name="google_maps_cache_stats"),
+    path("outbound-pool-stats/", OutboundPoolStatsView.as_view(), name="outbound_pool_stats"),
+]
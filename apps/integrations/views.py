@@ -1,3 +1,37 @@
-from django.shortcuts import render
+from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-# Create your views here.
+from apps.integrations import outbound_pool
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+
+
+class GoogleMapsCacheStatsView(APIView):
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(
+            {
+                "success": True,
+                "message": "Google Maps cache stats retrieved successfully.",
+                "stats": GoogleMapsInstance.get_cache_stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class OutboundPoolStatsView(APIView):
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(
+            {
+                "success": True,
+                "message": "Outbound pool stats retrieved successfully.",
+                "stats": outbound_pool.get_stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
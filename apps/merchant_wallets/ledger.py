@@ -0,0 +1,187 @@
+"""
+Append only ledger of the money in merchant wallets.
+
+Every credit (a completed transaction) or debit (eg. a payout) is a WalletLedgerEntry
+that is never changed afterwards. Posting entries to a wallet bumps its wallet_balance
+and entry_count with a single UPDATE ... SET x = x + n (an F() expression), which also
+locks the wallet row until the surrounding transaction commits, so concurrent postings
+queue up instead of overwriting each other. The new balance is read back under that
+lock to give each entry its sequence and running balance_after.
+
+Reading a balance is reading wallet_balance, and a statement page is an indexed range
+of (wallet, sequence). The snapshot_wallet_balances command periodically checks that
+wallet_balance still matches the ledger and records a WalletBalanceSnapshot. Wallets
+from before the ledger get their balance at the time as an opening entry from the
+open_wallet_ledgers command.
+"""
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from apps.merchant_wallets.models import MerchantWallet, WalletBalanceSnapshot, WalletLedgerEntry
+from apps.transactions.models import Transaction
+
+
+def post_entries(wallet_id, entries):
+    """
+    Append entries to a wallet and return them. entries are dicts with the entry_type,
+    the (positive) amount and optionally the transaction_id and description.
+    """
+    if not entries:
+        return []
+    change = sum(
+        (entry["amount"] if entry["entry_type"] == WalletLedgerEntry.CREDIT else -entry["amount"])
+        for entry in entries
+    )
+    # no savepoint, a failed posting fails the transaction it is part of:
+    with transaction.atomic(savepoint=False):
+        MerchantWallet.objects.filter(pk=wallet_id).update(
+            wallet_balance=F("wallet_balance") + change,
+            entry_count=F("entry_count") + len(entries),
+        )
+        balance, entry_count = (
+            MerchantWallet.objects.filter(pk=wallet_id).values_list("wallet_balance", "entry_count").get()
+        )
+
+        # work the running balances forward from the balance before these entries:
+        balance_after = balance - change
+        sequence = entry_count - len(entries)
+        ledger_entries = []
+        for entry in entries:
+            sequence += 1
+            signed_amount = entry["amount"] if entry["entry_type"] == WalletLedgerEntry.CREDIT else -entry["amount"]
+            balance_after += signed_amount
+            ledger_entries.append(WalletLedgerEntry(
+                wallet_id=wallet_id,
+                sequence=sequence,
+                entry_type=entry["entry_type"],
+                amount=entry["amount"],
+                balance_after=balance_after,
+                transaction_id=entry.get("transaction_id"),
+                description=entry.get("description", ""),
+            ))
+        return WalletLedgerEntry.objects.bulk_create(ledger_entries)
+
+
+def credit_completed_transactions(transaction_ids):
+    """
+    Credit the merchant wallets with the completed transactions that weren't credited
+    yet, each wallet with a single posting.
+    """
+    already_credited = WalletLedgerEntry.objects.filter(
+        entry_type=WalletLedgerEntry.CREDIT, transaction_id__in=transaction_ids
+    ).values("transaction_id")
+    transactions = list(
+        Transaction.objects.filter(id__in=transaction_ids, status="COMPLETED")
+        .exclude(id__in=already_credited)
+        .order_by("id")
+        .values("id", "reference", "total_minus_service_fee", "branch__merchant_id")
+    )
+    if not transactions:
+        return
+
+    wallet_ids = get_wallet_ids({row["branch__merchant_id"] for row in transactions})
+    entries_by_wallet = {}
+    for row in transactions:
+        entries_by_wallet.setdefault(wallet_ids[row["branch__merchant_id"]], []).append({
+            "entry_type": WalletLedgerEntry.CREDIT,
+            "amount": row["total_minus_service_fee"],
+            "transaction_id": row["id"],
+            "description": f"Payment {row['reference']}",
+        })
+    with transaction.atomic(savepoint=False):
+        for wallet_id, entries in entries_by_wallet.items():
+            post_entries(wallet_id, entries)
+
+
+def get_wallet_ids(merchant_ids):
+    # {merchant id: wallet id}, merchants without a wallet get one:
+    merchant_ids = set(merchant_ids)
+    wallets = MerchantWallet.objects.values_list("merchant_business_id", "id")
+    wallet_ids = dict(wallets.filter(merchant_business_id__in=merchant_ids))
+    missing_merchant_ids = merchant_ids - set(wallet_ids)
+    if missing_merchant_ids:
+        # a wallet created by a concurrent posting in the meantime wins, there is one per merchant:
+        MerchantWallet.objects.bulk_create(
+            [MerchantWallet(merchant_business_id=merchant_id) for merchant_id in missing_merchant_ids],
+            ignore_conflicts=True,
+        )
+        wallet_ids.update(wallets.filter(merchant_business_id__in=missing_merchant_ids))
+    return wallet_ids
+
+
+def open_wallet_ledgers():
+    """
+    Post an opening balance entry (sequence 0) to the wallets that had a balance before
+    the ledger existed, so their ledger adds up to their wallet_balance. Returns the
+    number of wallets that got one.
+    """
+    opened = 0
+    wallet_ids = list(
+        MerchantWallet.objects.exclude(ledger_entries__sequence=0).values_list("id", flat=True)
+    )
+    for wallet_id in wallet_ids:
+        with transaction.atomic():
+            wallet = MerchantWallet.objects.select_for_update().only("id", "wallet_balance").get(pk=wallet_id)
+            if wallet.ledger_entries.filter(sequence=0).exists():
+                continue
+            # the balance before the first posting, which worked its running balance from it:
+            first_entry = wallet.ledger_entries.filter(sequence=1).first()
+            if first_entry is None:
+                opening_balance = wallet.wallet_balance
+            elif first_entry.entry_type == WalletLedgerEntry.CREDIT:
+                opening_balance = first_entry.balance_after - first_entry.amount
+            else:
+                opening_balance = first_entry.balance_after + first_entry.amount
+            if not opening_balance:
+                continue
+            WalletLedgerEntry.objects.create(
+                wallet=wallet,
+                sequence=0,
+                entry_type=WalletLedgerEntry.CREDIT if opening_balance > 0 else WalletLedgerEntry.DEBIT,
+                amount=abs(opening_balance),
+                balance_after=opening_balance,
+                description="Opening balance",
+            )
+            opened += 1
+    return opened
+
+
+def snapshot_wallet_balances():
+    """
+    Snapshot the balance of every wallet that changed since its last snapshot, after
+    checking it against the ledger. Returns the ids of wallets whose wallet_balance
+    doesn't match their ledger, those aren't snapshotted.
+    """
+    mismatched_wallet_ids = []
+    for wallet in MerchantWallet.objects.only("id", "wallet_balance", "entry_count").iterator():
+        with transaction.atomic():
+            wallet = MerchantWallet.objects.select_for_update().only(
+                "id", "wallet_balance", "entry_count"
+            ).get(pk=wallet.pk)
+            last_snapshot = wallet.balance_snapshots.order_by("-sequence").first()
+            if last_snapshot is not None and last_snapshot.sequence == wallet.entry_count:
+                continue
+
+            # only the entries after the last snapshot have to be added up, the opening balance too at first:
+            since_sequence = last_snapshot.sequence if last_snapshot else -1
+            totals = {
+                row["entry_type"]: row["total"]
+                for row in wallet.ledger_entries.filter(sequence__gt=since_sequence)
+                .values("entry_type")
+                .annotate(total=Sum("amount"))
+            }
+            ledger_balance = (
+                (last_snapshot.balance if last_snapshot else Decimal(0))
+                + totals.get(WalletLedgerEntry.CREDIT, Decimal(0))
+                - totals.get(WalletLedgerEntry.DEBIT, Decimal(0))
+            )
+            if ledger_balance != wallet.wallet_balance:
+                mismatched_wallet_ids.append(wallet.id)
+                continue
+            WalletBalanceSnapshot.objects.create(
+                wallet=wallet, sequence=wallet.entry_count, balance=wallet.wallet_balance
+            )
+    return mismatched_wallet_ids
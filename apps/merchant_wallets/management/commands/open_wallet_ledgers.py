@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.merchant_wallets.ledger import open_wallet_ledgers
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Post an opening balance entry to the wallets that had a balance before the ledger. "
+        "Run it once before the first snapshot_wallet_balances, running it again changes nothing."
+    )
+
+    def handle(self, *args, **options):
+        opened = open_wallet_ledgers()
+        self.stdout.write(self.style.SUCCESS(f"{opened} wallet ledgers opened"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.merchant_wallets.ledger import snapshot_wallet_balances
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Check every wallet balance against its ledger and snapshot it. Run it nightly, "
+        "wallets that don't match their ledger are reported and not snapshotted."
+    )
+
+    def handle(self, *args, **options):
+        mismatched_wallet_ids = snapshot_wallet_balances()
+        if mismatched_wallet_ids:
+            self.stderr.write(
+                self.style.ERROR(f"Wallet balances don't match the ledger: {mismatched_wallet_ids}")
+            )
+        else:
+            self.stdout.write(self.style.SUCCESS("Wallet balances snapshotted"))
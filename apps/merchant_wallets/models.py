@@ -1,25 +1,105 @@
-from decimal import Decimal
 from django.db import models
 
 from apps.transactions.models import Transaction
-from apps.transactions.serializers.transaction_serializer import TransactionSerializer
 
 
 class MerchantWallet(models.Model):
     merchant_business = models.ForeignKey('merchants.MerchantBusiness', on_delete=models.CASCADE)
+    # kept equal to the balance_after of the last ledger entry, see apps/merchant_wallets/ledger.py:
     wallet_balance = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    entry_count = models.PositiveBigIntegerField(default=0)
     transactions = models.ManyToManyField(to='transactions.Transaction', blank=True)
 
+    class Meta:
+        constraints = [
+            # postings look the wallet of a merchant up, so a merchant only ever has one:
+            models.UniqueConstraint(fields=["merchant_business"], name="unique_merchant_wallet"),
+        ]
+
     def __str__(self):
         return f"{self.merchant_business.name} - {self.wallet_balance}"
 
-    def get_all_transactions(self):
-        transaction_serializer = TransactionSerializer(self.transactions, many=True)
-        return transaction_serializer.data
+    def get_statement(self, before_sequence=None, page_size=50):
+        """
+        Return a page of ledger entries, newest first, starting before before_sequence.
+        """
+        entries = self.ledger_entries.order_by("-sequence")
+        if before_sequence is not None:
+            entries = entries.filter(sequence__lt=before_sequence)
+        return entries[:page_size]
 
     def get_balance(self):
         return str(self.wallet_balance)
 
     def update_balance(self, transaction:Transaction):
+        from apps.merchant_wallets.ledger import credit_completed_transactions
+
         if transaction.status == "COMPLETED":
-            self.wallet_balance += Decimal(transaction.total_minus_service_fee)
+            credit_completed_transactions([transaction.id])
+            self.refresh_from_db(fields=["wallet_balance", "entry_count"])
+
+
+class WalletLedgerEntry(models.Model):
+
+    """
+    Immutable credit or debit of a merchant wallet. sequence numbers the entries of a
+    wallet from 1 and balance_after is the wallet balance right after the entry. Wallets
+    that had a balance before the ledger existed start with an opening balance entry 0.
+    """
+
+    CREDIT = "CREDIT"
+    DEBIT = "DEBIT"
+
+    entry_types = {
+        CREDIT: "CREDIT",
+        DEBIT: "DEBIT",
+    }
+
+    wallet = models.ForeignKey(MerchantWallet, on_delete=models.CASCADE, related_name="ledger_entries")
+    sequence = models.PositiveBigIntegerField()
+    entry_type = models.CharField(max_length=6, choices=entry_types)
+    # always positive, entry_type says which way the money went:
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    transaction = models.ForeignKey(Transaction, on_delete=models.PROTECT, null=True, blank=True)
+    description = models.CharField(max_length=191, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["wallet", "sequence"], name="unique_wallet_ledger_sequence"),
+            # a transaction is only ever credited (or debited) once:
+            models.UniqueConstraint(fields=["transaction", "entry_type"], name="unique_wallet_ledger_transaction"),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet_id} #{self.sequence} {self.entry_type} {self.amount}"
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise Exception("Ledger entries can't be changed, post a correcting entry instead")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise Exception("Ledger entries can't be deleted, post a correcting entry instead")
+
+
+class WalletBalanceSnapshot(models.Model):
+
+    """
+    The balance of a wallet as of one of its ledger entries, written by the
+    snapshot_wallet_balances command.
+    """
+
+    wallet = models.ForeignKey(MerchantWallet, on_delete=models.CASCADE, related_name="balance_snapshots")
+    sequence = models.PositiveBigIntegerField()
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["wallet", "sequence"], name="unique_wallet_snapshot_sequence"),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet_id} as of #{self.sequence}: {self.balance}"
@@ -1,3 +1,161 @@
-from django.test import TestCase
+import io
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from apps.merchant_wallets.ledger import credit_completed_transactions, get_wallet_ids, post_entries
+from apps.merchant_wallets.models import MerchantWallet, WalletBalanceSnapshot, WalletLedgerEntry
+from apps.transactions.models import Transaction
+from global_test_config.global_test_config import GlobalTestCaseConfig
+
+
+class WalletLedgerTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        self.wallet = MerchantWallet.objects.create(merchant_business=self.branch.merchant)
+        self.merchant_token, _ = Token.objects.get_or_create(user=self.merchant_user_account.user)
+
+    def create_transaction(self, reference, amount, status="COMPLETED"):
+        return Transaction.objects.create(
+            reference=reference,
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=amount,
+            total_minus_service_fee=amount,
+            status=status,
+        )
+
+    def get_statement(self, **params):
+        return self.client.get(
+            reverse("wallet_statement"), params, HTTP_AUTHORIZATION=f"Token {self.merchant_token.key}"
+        )
+
+    def test_completed_transactions_are_credited_once(self):
+        transactions = [
+            self.create_transaction("ref1", Decimal("100.00")),
+            self.create_transaction("ref2", Decimal("50.50")),
+            self.create_transaction("ref3", Decimal("10.00"), status="PENDING"),
+        ]
+        transaction_ids = [transaction.id for transaction in transactions]
+
+        credit_completed_transactions(transaction_ids)
+        credit_completed_transactions(transaction_ids)
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.wallet_balance, Decimal("150.50"))
+        self.assertEqual(self.wallet.entry_count, 2)
+        self.assertEqual(
+            list(self.wallet.ledger_entries.order_by("sequence").values_list("sequence", "balance_after")),
+            [(1, Decimal("100.00")), (2, Decimal("150.50"))],
+        )
+
+    def test_debits_carry_the_running_balance(self):
+        post_entries(self.wallet.id, [{"entry_type": WalletLedgerEntry.CREDIT, "amount": Decimal("80.00")}])
+        post_entries(self.wallet.id, [
+            {"entry_type": WalletLedgerEntry.DEBIT, "amount": Decimal("30.00"), "description": "Payout"},
+            {"entry_type": WalletLedgerEntry.CREDIT, "amount": Decimal("5.25")},
+        ])
+
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.get_balance(), "55.25")
+        self.assertEqual(
+            list(self.wallet.ledger_entries.order_by("sequence").values_list("balance_after", flat=True)),
+            [Decimal("80.00"), Decimal("50.00"), Decimal("55.25")],
+        )
+
+    def test_entries_cannot_be_changed(self):
+        entry = post_entries(self.wallet.id, [{"entry_type": WalletLedgerEntry.CREDIT, "amount": Decimal("1.00")}])[0]
+        entry = WalletLedgerEntry.objects.get(id=entry.id)
+        entry.amount = Decimal("1000.00")
+        with self.assertRaises(Exception):
+            entry.save()
+        with self.assertRaises(Exception):
+            entry.delete()
+
+    def test_statements_are_paged_with_a_fixed_number_of_queries(self):
+        post_entries(self.wallet.id, [
+            {"entry_type": WalletLedgerEntry.CREDIT, "amount": Decimal("10.00")} for _ in range(25)
+        ])
+
+        sequences = []
+        cursor = None
+        while True:
+            params = {"page_size": 10}
+            if cursor:
+                params["cursor"] = cursor
+            # the token, the merchant, the wallet and the page of entries:
+            with self.assertNumQueries(5):
+                response = self.get_statement(**params)
+            self.assertEqual(response.data["balance"], "250.00")
+            sequences += [entry["sequence"] for entry in response.data["entries"]]
+            cursor = response.data["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(sequences, list(range(25, 0, -1)))
+
+    def test_merchants_not_paid_yet_have_an_empty_statement(self):
+        self.wallet.delete()
+
+        response = self.get_statement()
+
+        self.assertEqual(response.data["balance"], "0.00")
+        self.assertEqual(response.data["entries"], [])
+        # reading a statement doesn't create a wallet:
+        self.assertFalse(MerchantWallet.objects.exists())
+
+    def test_merchants_have_one_wallet(self):
+        merchant_id = self.branch.merchant.id
+        self.assertEqual(get_wallet_ids([merchant_id]), {merchant_id: self.wallet.id})
+
+        # a wallet created by a concurrent posting is the one used:
+        self.wallet.delete()
+        other_wallet = MerchantWallet.objects.create(merchant_business_id=merchant_id)
+        self.assertEqual(get_wallet_ids([merchant_id]), {merchant_id: other_wallet.id})
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MerchantWallet.objects.create(merchant_business_id=merchant_id)
+
+    def test_wallets_from_before_the_ledger_are_opened_with_their_balance(self):
+        MerchantWallet.objects.filter(id=self.wallet.id).update(wallet_balance=Decimal("120.00"))
+        call_command("open_wallet_ledgers", stdout=io.StringIO())
+        call_command("open_wallet_ledgers", stdout=io.StringIO())
+        post_entries(self.wallet.id, [{"entry_type": WalletLedgerEntry.DEBIT, "amount": Decimal("20.00")}])
+
+        self.assertEqual(
+            list(self.wallet.ledger_entries.order_by("sequence").values_list("sequence", "amount", "balance_after")),
+            [(0, Decimal("120.00"), Decimal("120.00")), (1, Decimal("20.00"), Decimal("100.00"))],
+        )
+
+        errors = io.StringIO()
+        call_command("snapshot_wallet_balances", stdout=io.StringIO(), stderr=errors)
+        self.assertEqual(errors.getvalue(), "")
+        self.assertEqual(
+            list(self.wallet.balance_snapshots.values_list("sequence", "balance")), [(1, Decimal("100.00"))]
+        )
+
+    def test_customers_have_no_statement(self):
+        response = self.client.get(reverse("wallet_statement"), HTTP_AUTHORIZATION=f"Token {self.user_token}")
+        self.assertEqual(response.data["success"], False)
+
+    def test_balances_are_checked_against_the_ledger_and_snapshotted(self):
+        post_entries(self.wallet.id, [{"entry_type": WalletLedgerEntry.CREDIT, "amount": Decimal("40.00")}])
+        call_command("snapshot_wallet_balances", stdout=io.StringIO())
+        post_entries(self.wallet.id, [{"entry_type": WalletLedgerEntry.DEBIT, "amount": Decimal("15.00")}])
+        call_command("snapshot_wallet_balances", stdout=io.StringIO())
+
+        self.assertEqual(
+            list(self.wallet.balance_snapshots.order_by("sequence").values_list("sequence", "balance")),
+            [(1, Decimal("40.00")), (2, Decimal("25.00"))],
+        )
+
+        # a balance changed outside of the ledger is reported instead of snapshotted:
+        MerchantWallet.objects.filter(id=self.wallet.id).update(wallet_balance=Decimal("999.00"), entry_count=3)
+        errors = io.StringIO()
+        call_command("snapshot_wallet_balances", stdout=io.StringIO(), stderr=errors)
+        self.assertIn(str(self.wallet.id), errors.getvalue())
+        self.assertEqual(WalletBalanceSnapshot.objects.count(), 2)
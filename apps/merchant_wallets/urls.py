@@ -0,0 +1,7 @@
+from django.urls import path
+
+from apps.merchant_wallets.views import WalletStatementView
+
+urlpatterns = [
+    path("statement/", WalletStatementView.as_view(), name="wallet_statement"),
+]
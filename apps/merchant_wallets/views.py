@@ -1,3 +1,91 @@
-from django.shortcuts import render
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-# Create your views here.
+from apps.merchant_wallets.models import MerchantWallet
+from apps.merchants.models import MerchantBusiness
+from global_view_functions.global_view_functions import GlobalViewFunctions
+
+
+class WalletStatementView(APIView, GlobalViewFunctions):
+
+    """
+    The balance of the merchant's wallet and a page of its ledger entries, newest first.
+    Pass the next_cursor of a page as cursor to get the one after it.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+
+    def get(self, request, **kwargs):
+        try:
+            if not self.if_user_is_merchant(request):
+                raise Exception("You're not permitted to use this feature")
+            page_size = min(
+                max(int(request.query_params.get("page_size", self.DEFAULT_PAGE_SIZE)), 1),
+                self.MAX_PAGE_SIZE,
+            )
+            cursor = request.query_params.get("cursor")
+            try:
+                before_sequence = int(cursor) if cursor else None
+            except ValueError:
+                raise Exception("Invalid cursor.")
+
+            merchant_id = (
+                MerchantBusiness.objects.filter(user_account=request.user.useraccount)
+                .values_list("id", flat=True)
+                .first()
+            )
+            if merchant_id is None:
+                raise Exception("Merchant not found")
+            # merchants get their wallet when they are first paid, until then there is nothing to show:
+            wallet = (
+                MerchantWallet.objects.filter(merchant_business_id=merchant_id)
+                .only("id", "wallet_balance")
+                .first()
+            )
+
+            # one extra entry tells whether there is a next page:
+            entries = [] if wallet is None else list(
+                wallet.get_statement(before_sequence, page_size + 1).values(
+                    "sequence",
+                    "entry_type",
+                    "amount",
+                    "balance_after",
+                    "description",
+                    "created",
+                    "transaction__reference",
+                )
+            )
+            next_cursor = None
+            if len(entries) > page_size:
+                entries = entries[:page_size]
+                next_cursor = str(entries[-1]["sequence"])
+
+            return Response({
+                "success": True,
+                "message": "Wallet statement retrieved successfully",
+                "balance": wallet.get_balance() if wallet is not None else "0.00",
+                "entries": [
+                    {
+                        "sequence": entry["sequence"],
+                        "entry_type": entry["entry_type"],
+                        "amount": str(entry["amount"]),
+                        "balance_after": str(entry["balance_after"]),
+                        "description": entry["description"],
+                        "created": entry["created"],
+                        "transaction_reference": entry["transaction__reference"],
+                    }
+                    for entry in entries
+                ],
+                "next_cursor": next_cursor,
+            }, status=status.HTTP_200_OK)
+
+        except Exception as e:
+            return Response({
+                "success": False,
+                "message": "Failed to get the wallet statement",
+                "error": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
@@ -92,6 +92,14 @@ class BranchAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return request.user.useraccount.is_super_user
 
+    def save_model(self, request, obj, form, change):
+        # geocode new branches and branches that moved, unless the coordinates were entered by hand:
+        coordinates_entered = {"latitude", "longitude"} & set(form.changed_data)
+        coordinates_missing = obj.latitude is None or obj.longitude is None
+        if not coordinates_entered and (coordinates_missing or "address" in form.changed_data):
+            obj.geocode_address()
+        super().save_model(request, obj, form, change)
+
 class SaleCampaignAdmin(admin.ModelAdmin):
     list_display = (
         "branch_product",
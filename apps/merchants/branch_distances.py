@@ -0,0 +1,127 @@
+"""
+Driving distances from a customer to a list of branches.
+
+Every branch that isn't cached yet is sent to the Distance Matrix API as a destination
+of the customer's location, up to DISTANCE_MATRIX["MAX_DESTINATIONS"] per request,
+instead of making one request per branch. Results are cached per (rounded customer
+location, branch) pair. When Google can't answer (the quota is used up, the call timed
+out, ...) the distance and duration are estimated from the straight line distance so
+the store list still loads.
+"""
+
+import logging
+
+import googlemaps.distance_matrix
+from django.conf import settings
+
+from apps.integrations import outbound_pool
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+from apps.merchants.branch_locator import haversine_km, parse_coordinates
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT = "distance_matrix"
+
+
+def get_branch_distances(coordinates, branches, gmaps_client=None):
+    """
+    Return {branch id: distance matrix element} with the driving distance and duration
+    from the customer to each branch. `branches` are dicts with the id, latitude and
+    longitude of a branch, eg. the results of find_branches_in_radius. Elements that
+    were estimated instead of coming from Google have "estimated" set to True.
+    """
+    distance_settings = settings.DISTANCE_MATRIX
+    gmaps_client = gmaps_client or GoogleMapsInstance()
+    latitude, longitude = parse_coordinates(coordinates)
+    origin = gmaps_client.quantize_coordinates(coordinates)
+
+    # the branch coordinates are part of the key so moving a branch invalidates its entries:
+    keys = {
+        branch["id"]: gmaps_client.make_key(ENDPOINT, {
+            "origin": origin,
+            "branch_id": branch["id"],
+            "destination": f"{branch['latitude']},{branch['longitude']}",
+        })
+        for branch in branches
+    }
+    cached_responses = gmaps_client.get_cached_responses(list(keys.values()))
+    distances = {
+        branch_id: cached_responses[key]
+        for branch_id, key in keys.items() if key in cached_responses
+    }
+    missing_branches = [branch for branch in branches if branch["id"] not in distances]
+    gmaps_client._count("hits", len(distances))
+    gmaps_client._count("misses", len(missing_branches))
+    if not missing_branches:
+        return distances
+
+    # send the remaining branches in batches, all the batches at the same time:
+    batch_size = distance_settings["MAX_DESTINATIONS"]
+    batches = [
+        missing_branches[index:index + batch_size]
+        for index in range(0, len(missing_branches), batch_size)
+    ]
+    client = gmaps_client.client
+    calls = [
+        outbound_pool.submit(ENDPOINT, _fetch_distances, client, origin, batch)
+        for batch in batches
+    ]
+
+    new_responses = {}
+    for batch, call in zip(batches, calls):
+        try:
+            elements = call.result()
+        except Exception as e:
+            logger.warning(f"Failed to get distances from Google, estimating them instead: {e}")
+            elements = []
+
+        for index, branch in enumerate(batch):
+            element = elements[index] if index < len(elements) else None
+            if element and element.get("status") == "OK":
+                distances[branch["id"]] = new_responses[keys[branch["id"]]] = {
+                    **element, "estimated": False
+                }
+            else:
+                # estimates are not cached so google is asked again next time:
+                distances[branch["id"]] = estimate_distance(latitude, longitude, branch)
+
+    if new_responses:
+        gmaps_client.cache_responses(ENDPOINT, new_responses, distance_settings["TTL_SECONDS"])
+    return distances
+
+
+def _fetch_distances(client, origin, branches):
+    response = googlemaps.distance_matrix.distance_matrix(
+        client,
+        origins=[origin],
+        destinations=[(branch["latitude"], branch["longitude"]) for branch in branches],
+    )
+    return response["rows"][0]["elements"]
+
+
+def estimate_distance(latitude, longitude, branch):
+    """
+    Estimate a distance matrix element from the straight line distance to the branch.
+    """
+    distance_settings = settings.DISTANCE_MATRIX
+    road_distance_km = haversine_km(
+        latitude, longitude, branch["latitude"], branch["longitude"]
+    ) * distance_settings["ROAD_DISTANCE_FACTOR"]
+    duration_seconds = round(road_distance_km / distance_settings["FALLBACK_SPEED_KMH"] * 3600)
+    return {
+        "distance": {"text": f"{road_distance_km:.1f} km", "value": round(road_distance_km * 1000)},
+        "duration": {"text": format_duration(duration_seconds), "value": duration_seconds},
+        "status": "OK",
+        "estimated": True,
+    }
+
+
+def format_duration(seconds):
+    # the same format google uses, eg. "1 hour 5 mins":
+    hours, minutes = divmod(max(round(seconds / 60), 1), 60)
+    parts = []
+    if hours:
+        parts.append(f"{hours} hour" if hours == 1 else f"{hours} hours")
+    if minutes or not hours:
+        parts.append(f"{minutes} min" if minutes == 1 else f"{minutes} mins")
+    return " ".join(parts)
@@ -0,0 +1,189 @@
+"""
+Locates branches close to a customer without scanning every branch.
+
+Each branch is bucketed into a fixed-size latitude/longitude grid cell when
+it is saved (see Branch.grid_cell). A radius search only reads the branches in
+the few cells that overlap the search circle, so the cost of a lookup depends
+on how many branches are nearby rather than on how many exist on the platform.
+"""
+
+import math
+from datetime import timedelta
+
+from django.utils import timezone
+
+from apps.merchants.models import Branch
+
+EARTH_RADIUS_KM = 6371.0088
+
+# roughly 11km of latitude per cell:
+GRID_CELL_SIZE_DEGREES = 0.1
+
+KM_PER_DEGREE_OF_LATITUDE = 111.32
+
+# how long to wait before geocoding a branch whose address couldn't be geocoded again:
+GEOCODE_RETRY_AFTER = timedelta(days=1)
+
+
+def parse_coordinates(coordinates: str):
+    """
+    Convert the "latitude,longitude" string sent by the mobile app into floats.
+    """
+    try:
+        latitude, longitude = [float(value) for value in str(coordinates).split(",")]
+    except (TypeError, ValueError):
+        raise Exception(f"Invalid coordinates provided: {coordinates}")
+    if not (-90 <= latitude <= 90) or not (-180 <= longitude <= 180):
+        raise Exception(f"Coordinates out of range: {coordinates}")
+    return latitude, longitude
+
+
+def _cell_index(latitude, longitude):
+    row = math.floor((latitude + 90) / GRID_CELL_SIZE_DEGREES)
+    column = math.floor((longitude + 180) / GRID_CELL_SIZE_DEGREES)
+    return row, column
+
+
+def _cell_key(row, column):
+    columns = round(360 / GRID_CELL_SIZE_DEGREES)
+    return f"{row}:{column % columns}"
+
+
+def get_grid_cell(latitude, longitude):
+    return _cell_key(*_cell_index(latitude, longitude))
+
+
+def get_grid_cells_in_radius(latitude, longitude, radius_km):
+    """
+    Return every grid cell that overlaps the square bounding the search circle.
+    """
+    latitude_delta = radius_km / KM_PER_DEGREE_OF_LATITUDE
+
+    # longitude degrees shrink towards the poles:
+    cos_latitude = max(math.cos(math.radians(latitude)), 0.01)
+    longitude_delta = min(radius_km / (KM_PER_DEGREE_OF_LATITUDE * cos_latitude), 180)
+
+    min_row, min_column = _cell_index(
+        max(latitude - latitude_delta, -90), longitude - longitude_delta
+    )
+    max_row, max_column = _cell_index(
+        min(latitude + latitude_delta, 90), longitude + longitude_delta
+    )
+    return [
+        _cell_key(row, column)
+        for row in range(min_row, max_row + 1)
+        for column in range(min_column, max_column + 1)
+    ]
+
+
+def haversine_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(
+        math.radians, (latitude_1, longitude_1, latitude_2, longitude_2)
+    )
+    a = (
+        math.sin((latitude_2 - latitude_1) / 2) ** 2
+        + math.cos(latitude_1)
+        * math.cos(latitude_2)
+        * math.sin((longitude_2 - longitude_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def find_branches_in_radius(latitude, longitude, radius_km):
+    """
+    Return the active branches within radius_km of the given point, nearest first.
+
+    Each result is a dict with the branch id, merchant id, address, coordinates
+    and the straight line distance to the point in kilometres.
+    """
+    branches = Branch.objects.filter(
+        grid_cell__in=get_grid_cells_in_radius(latitude, longitude, radius_km),
+        is_active=True,
+        merchant__is_active=True,
+    ).values_list("id", "merchant_id", "address", "latitude", "longitude")
+
+    branches_in_radius = []
+    for branch_id, merchant_id, address, branch_latitude, branch_longitude in branches:
+        distance = haversine_km(latitude, longitude, branch_latitude, branch_longitude)
+        if distance <= radius_km:
+            branches_in_radius.append({
+                "id": branch_id,
+                "merchant_id": merchant_id,
+                "address": address,
+                "latitude": branch_latitude,
+                "longitude": branch_longitude,
+                "distance_km": round(distance, 2),
+            })
+
+    branches_in_radius.sort(key=lambda branch: branch["distance_km"])
+    return branches_in_radius
+
+
+def find_nearest_branch(merchant_id, latitude, longitude):
+    """
+    Return (branch id, distance in km) of the merchant's active branch closest to
+    the given point, or (None, None) if none of its branches have a location.
+
+    Only stored coordinates are used so no external calls are made, branches that
+    haven't been geocoded yet are left out until locate_branches has located them.
+    """
+    located_branches = list(
+        Branch.objects.filter(
+            merchant_id=merchant_id, is_active=True, latitude__isnull=False, longitude__isnull=False
+        ).values_list("id", "latitude", "longitude")
+    )
+    if not located_branches:
+        return None, None
+
+    distances = [
+        haversine_km(latitude, longitude, branch_latitude, branch_longitude)
+        for _, branch_latitude, branch_longitude in located_branches
+    ]
+    nearest_index = min(range(len(distances)), key=distances.__getitem__)
+    return located_branches[nearest_index][0], round(distances[nearest_index], 2)
+
+
+def locate_branches():
+    """
+    Give every branch a grid cell so find_branches_in_radius can find it. Branches
+    saved before coordinates and grid cells were stored are geocoded (or only get
+    their grid cell if they already have coordinates). Branches that failed to
+    geocode within the last GEOCODE_RETRY_AFTER are skipped. Returns the number of
+    branches that were located and the number that still have no location.
+    """
+    branches = list(
+        Branch.objects.filter(grid_cell="")
+        .exclude(geocode_failed_at__gt=timezone.now() - GEOCODE_RETRY_AFTER)
+        .only("id", "latitude", "longitude", "grid_cell")
+    )
+
+    # branches with coordinates only need their grid cell, which is done in one query:
+    branches_with_coordinates = [
+        branch for branch in branches if branch.latitude is not None and branch.longitude is not None
+    ]
+    for branch in branches_with_coordinates:
+        branch.set_grid_cell()
+    Branch.objects.bulk_update(branches_with_coordinates, ["grid_cell"], batch_size=500)
+
+    located, failed = len(branches_with_coordinates), 0
+    for branch in branches:
+        if branch.latitude is None or branch.longitude is None:
+            _, branch_latitude, _ = _geocode_branch(branch.id)
+            if branch_latitude is None:
+                failed += 1
+            else:
+                located += 1
+    return located, failed
+
+
+def _geocode_branch(branch_id):
+    branch = Branch.objects.get(id=branch_id)
+    branch.geocode_address()
+    if branch.latitude is not None and branch.longitude is not None:
+        branch.set_grid_cell()
+        branch.geocode_failed_at = None
+    else:
+        # remember the failure so the address isn't sent to google again on every run:
+        branch.geocode_failed_at = timezone.now()
+    branch.save(update_fields=["latitude", "longitude", "grid_cell", "geocode_failed_at"])
+    return branch.id, branch.latitude, branch.longitude
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from apps.merchants.branch_locator import locate_branches
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Geocode the branches that have no coordinates and set the grid cell of every "
+        "branch that doesn't have one yet, so customers nearby can find them."
+    )
+
+    def handle(self, *args, **options):
+        located, failed = locate_branches()
+        self.stdout.write(self.style.SUCCESS(f"Located {located} branches"))
+        if failed:
+            self.stdout.write(self.style.WARNING(f"Failed to geocode {failed} branches"))
@@ -1,4 +1,5 @@
 import json
+import logging
 from datetime import datetime, timedelta, timezone
 from datetime import time
 
@@ -10,6 +11,8 @@ from cryptography.fernet import Fernet as fernet
 from apps.accounts.models import UserAccount
 from django.core.exceptions import ValidationError
 
+logger = logging.getLogger(__name__)
+
 
 class MerchantBusiness(models.Model):
     logo = models.CharField(
@@ -92,6 +95,35 @@ class Branch(models.Model):
         null=True,
         help_text="This branch is associated with the selected business."
     )
+    latitude = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Latitude of this branch, used to show it to nearby customers."
+    )
+    longitude = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Longitude of this branch, used to show it to nearby customers."
+    )
+    geocode_failed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="When the address of this branch last failed to geocode."
+    )
+    grid_cell = models.CharField(
+        max_length=32,
+        blank=True,
+        default="",
+        db_index=True,
+        editable=False,
+        help_text="Spatial index bucket calculated from the branch coordinates."
+    )
+    catalog_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Bumped whenever a product or sale campaign of this branch changes."
+    )
 
     class Meta:
         verbose_name = "a branch"
@@ -100,6 +132,42 @@ class Branch(models.Model):
     def __str__(self) -> str:
         return f"{self.merchant.name} - {self.address}"
 
+    def save(self, *args, **kwargs):
+        self.set_grid_cell()
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # the catalog version is only bumped in the database, never write back a stale one:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "catalog_version"
+            ]
+        super(Branch, self).save(*args, **kwargs)
+
+    def geocode_address(self):
+        """
+        Look up and set the coordinates of this branch from its address. Branches are
+        geocoded once when they are created so customers can be matched to them locally.
+        """
+        # imported here because the integrations app depends on this module:
+        from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+
+        try:
+            results = GoogleMapsInstance().geocode(self.address)
+            if results:
+                location = results[0]["geometry"]["location"]
+                self.latitude = location["lat"]
+                self.longitude = location["lng"]
+        except Exception as e:
+            logger.warning(f"Failed to geocode branch address {self.address}: {e}")
+
+    def set_grid_cell(self):
+        # imported here to avoid a circular import with the branch locator:
+        from apps.merchants.branch_locator import get_grid_cell
+
+        if self.latitude is None or self.longitude is None:
+            self.grid_cell = ""
+        else:
+            self.grid_cell = get_grid_cell(self.latitude, self.longitude)
+
 
 def default_campaign_end_date():
     return datetime.now() + timedelta(days=5)
@@ -171,6 +239,8 @@ class SaleCampaign(models.Model):
                 self.save(update_fields=["percentage_off"])
 
     def calculate_sale_campaign_price(self):
+        # imported here because the products app depends on this module:
+        from apps.products.pricing import calculate_sale_price
+
         # Always calculate based on the current active percentage_off
-        branch_price = self.branch_product.branch_price
-        return round(branch_price - (branch_price * self.percentage_off / 100), 2)
+        return calculate_sale_price(self.branch_product.branch_price, self.percentage_off)
@@ -6,6 +6,7 @@ from rest_framework import serializers
 from apps.merchant_wallets.models import MerchantWallet
 from apps.merchants.models import Branch, MerchantBusiness, SaleCampaign
 from apps.accounts.models import UserAccount
+from apps.products.pricing import calculate_sale_price
 
 logger = logging.getLogger("littlebuddies")
 
@@ -73,6 +74,7 @@ class BranchSerializer(serializers.ModelSerializer):
             branch.address = branchData["branchAddress"]
             branch.merchant = merchant
             branch.area = branchData["branchArea"]
+            branch.geocode_address()
             branch.save()
         except Exception as e:
             tb = traceback.format_exc()
@@ -91,8 +93,9 @@ class SaleCampaignSerializer(serializers.ModelSerializer):
         if "branch_product" in representation:
             branch_product = representation["branch_product"]
             if branch_product is not None:
-                new_discount_price = (float(branch_product["branch_price"]) * (1 - representation["percentage_off"] / 100))
-                branch_product["branch_price"] = str(f"{new_discount_price:.2f}")
+                branch_product["branch_price"] = str(
+                    calculate_sale_price(branch_product["branch_price"], representation["percentage_off"])
+                )
         return representation
 
     def is_valid(self, *, raise_exception=False):
@@ -1,15 +1,21 @@
 from unittest.mock import patch
+import googlemaps.exceptions
 from django.db import connection, transaction, connections
 from django.test import TestCase, RequestFactory, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 import pytest
 import json
 import uuid
 from django.contrib.auth.models import User
+from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
 
+from rest_framework.renderers import JSONRenderer
 from rest_framework.reverse import reverse
 from django.contrib.admin.sites import AdminSite
 from django.apps import apps
+from django.core.management import call_command
 from django.utils import timezone
 
 from apps.merchant_wallets.models import MerchantWallet
@@ -19,8 +25,13 @@ from global_test_config.global_test_config import GlobalTestCaseConfig, MockedPa
 from apps.merchants.models import MerchantBusiness
 from apps.merchants.models import MerchantBusiness, Branch, SaleCampaign
 from apps.accounts.models import UserAccount
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+from apps.merchants.branch_distances import format_duration, get_branch_distances
+from apps.merchants.branch_locator import find_branches_in_radius
 from apps.merchants.admin import MerchantBusinessAdmin, BranchAdmin, SaleCampaignAdmin
-from apps.products.models import BranchProduct, GlobalProduct
+from apps.products.models import BranchCatalogChange, BranchProduct, GlobalProduct
+from apps.products.serializers.serializers import BranchProductProjectionSerializer, BranchProductSerializer
+from apps.products.pricing import calculate_sale_price, get_effective_prices
 
 @pytest.fixture(autouse=True)
 def clean_database(db):
@@ -993,3 +1004,606 @@ def reset_auto_increment_ids():
 #             HTTP_AUTHORIZATION=f"Token {token}"
 #         )
 #         self.assertEqual(response.status_code, 401)
+
+
+def distance_matrix_response(client, origins, destinations):
+    # a made up distance matrix response with one element per destination:
+    return {
+        "rows": [{
+            "elements": [
+                {
+                    "distance": {"text": f"{index + 1}.0 km", "value": (index + 1) * 1000},
+                    "duration": {"text": f"{index + 2} mins", "value": (index + 2) * 60},
+                    "status": "OK",
+                }
+                for index in range(len(destinations))
+            ]
+        }]
+    }
+
+
+@patch("googlemaps.distance_matrix.distance_matrix", side_effect=distance_matrix_response)
+@patch("googlemaps.Client")
+class StoreRangeTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        # the query counts below include the google maps cache eviction, so start every test with it due:
+        GoogleMapsInstance.cache_stats = {"hits": 0, "misses": 0}
+        GoogleMapsInstance.last_evicted = None
+
+        # place the default branch in Berea, Durban:
+        self.branch.latitude = -29.8469
+        self.branch.longitude = 31.0034
+        self.branch.save()
+
+        # create a second pet store in Johannesburg, far outside the customers range:
+        self.far_branch = self.create_a_branch(
+            custom_merchant_business={
+                "logo": "Logo",
+                "user_account": self.create_second_merchant_user_account(),
+                "name": "Joburg Pets",
+                "email": "joburgpets@gmail.com",
+                "address": "1 Commissioner Street, Johannesburg",
+                "delivery_fee": 25.00,
+            },
+            custom_branch_data={
+                "is_active": True,
+                "address": "1 Commissioner Street, Johannesburg",
+            },
+        )
+        self.far_branch.latitude = -26.2041
+        self.far_branch.longitude = 28.0473
+        self.far_branch.save()
+
+    def create_second_merchant_user_account(self):
+        user = User.objects.create(
+            username="joburgpets", email="joburgpets@gmail.com", password="ThisIsMyPassword"
+        )
+        user_account = UserAccount()
+        user_account.user = user
+        user_account.phone_number = "0611111111"
+        user_account.is_merchant = True
+        user_account.device_token = "joburgpetsdevicetoken"
+        user_account.save()
+        return user_account
+
+    def get_store_range(self, coordinates):
+        return self.client.get(
+            reverse("get_store_range", args=[coordinates]),
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+        )
+
+    def test_get_store_range_only_returns_nearby_stores(self, *_):
+        response = self.get_store_range("-29.8587,31.0218")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["success"], True)
+        self.assertEqual(len(response.data["petstores"]), 1)
+        petstore = response.data["petstores"][0]
+        self.assertEqual(petstore["name"], "Orsum Pets")
+        self.assertEqual(petstore["nearest_branch"]["id"], self.branch.id)
+        self.assertLess(petstore["nearest_branch"]["distance_km"], 5)
+        self.assertEqual(petstore["nearest_branch"]["distance"]["duration"]["text"], "2 mins")
+
+    def test_get_store_range_with_no_stores_nearby(self, *_):
+        response = self.get_store_range("-33.9249,18.4241")
+
+        self.assertEqual(response.data["success"], False)
+        self.assertEqual(response.data["error"], "No Pet stores were found")
+
+    def test_get_store_range_with_invalid_coordinates(self, *_):
+        response = self.get_store_range("somewhere")
+
+        self.assertEqual(response.data["success"], False)
+
+    def test_get_store_range_cost_does_not_grow_with_far_away_branches(self, *_):
+        # benchmark: the query count and the branches that are read must stay the
+        # same no matter how many branches exist outside the customers area:
+        with self.assertNumQueries(9):
+            # the first call also caches the distance to the branch:
+            self.get_store_range("-29.8587,31.0218")
+        with self.assertNumQueries(6):
+            self.get_store_range("-29.8587,31.0218")
+
+        far_away_branches = []
+        for index in range(2000):
+            branch = Branch(
+                is_active=True,
+                address=f"{index} Long Street, Cape Town",
+                merchant=self.far_branch.merchant,
+                latitude=-33.9249 + (index % 40) * 0.01,
+                longitude=18.4241 + (index // 40) * 0.01,
+            )
+            branch.set_grid_cell()
+            far_away_branches.append(branch)
+        Branch.objects.bulk_create(far_away_branches)
+
+        with self.assertNumQueries(6):
+            response = self.get_store_range("-29.8587,31.0218")
+        self.assertEqual(len(response.data["petstores"]), 1)
+
+
+@patch("googlemaps.Client")
+class BranchDistanceTests(GlobalTestCaseConfig):
+
+    customer_coordinates = "-29.8587,31.0218"
+
+    def setUp(self):
+        super().setUp()
+        self.branches = [
+            {"id": index, "latitude": -29.80 - index * 0.001, "longitude": 31.00}
+            for index in range(1, 61)
+        ]
+
+    @patch("googlemaps.distance_matrix.distance_matrix", side_effect=distance_matrix_response)
+    def test_distances_are_requested_in_batches_and_cached(self, mocked_distance_matrix, *_):
+        distances = get_branch_distances(self.customer_coordinates, self.branches)
+
+        # 60 branches fit in 3 requests of at most 25 destinations:
+        self.assertEqual(mocked_distance_matrix.call_count, 3)
+        self.assertEqual(
+            sorted(len(call.kwargs["destinations"]) for call in mocked_distance_matrix.call_args_list),
+            [10, 25, 25],
+        )
+        self.assertEqual(len(distances), 60)
+        self.assertFalse(any(distance["estimated"] for distance in distances.values()))
+
+        # a customer a few metres away gets the cached distances:
+        cached_distances = get_branch_distances("-29.85872,31.02183", self.branches)
+        self.assertEqual(mocked_distance_matrix.call_count, 3)
+        self.assertEqual(cached_distances, distances)
+
+    @patch(
+        "googlemaps.distance_matrix.distance_matrix",
+        side_effect=googlemaps.exceptions.ApiError("OVER_QUERY_LIMIT"),
+    )
+    def test_distances_are_estimated_when_google_cannot_answer(self, mocked_distance_matrix, *_):
+        distances = get_branch_distances(self.customer_coordinates, self.branches[:2])
+
+        self.assertTrue(all(distance["estimated"] for distance in distances.values()))
+        self.assertGreater(distances[1]["distance"]["value"], 0)
+        self.assertEqual(distances[1]["duration"]["text"], "13 mins")
+
+        # estimates aren't cached so google is asked again:
+        get_branch_distances(self.customer_coordinates, self.branches[:2])
+        self.assertEqual(mocked_distance_matrix.call_count, 2)
+
+    def test_durations_are_formatted_like_google(self, *_):
+        self.assertEqual(format_duration(20), "1 min")
+        self.assertEqual(format_duration(25 * 60), "25 mins")
+        self.assertEqual(format_duration(60 * 60), "1 hour")
+        self.assertEqual(format_duration(2 * 60 * 60 + 5 * 60), "2 hours 5 mins")
+
+
+@patch("googlemaps.Client")
+@patch(
+    "googlemaps.geocoding.reverse_geocode",
+    return_value=[{"formatted_address": "115 Musgrave Rd, Berea, Durban, 4001"}],
+)
+class NearestBranchTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+
+        # the default branch is in Berea and the merchant has a second branch in Umhlanga:
+        self.branch.latitude = -29.8469
+        self.branch.longitude = 31.0034
+        self.branch.save()
+        self.umhlanga_branch = Branch.objects.create(
+            is_active=True,
+            address="Gateway Theatre of Shopping, Umhlanga",
+            merchant=self.branch.merchant,
+            latitude=-29.7277,
+            longitude=31.0656,
+        )
+
+    def get_nearest_branch(self, coordinates):
+        return self.client.get(
+            reverse("get_nearest_branch", args=[coordinates, self.branch.merchant.id]),
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+        )
+
+    @patch("googlemaps.places.find_place")
+    def test_nearest_branch_is_resolved_from_stored_coordinates(self, mocked_find_place, *_):
+        response = self.get_nearest_branch("-29.7300,31.0600")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["nearestBranch"]["branch"]["id"], self.umhlanga_branch.id)
+        self.assertLess(response.data["nearestBranch"]["distance_km"], 1)
+        mocked_find_place.assert_not_called()
+
+        response = self.get_nearest_branch("-29.8500,31.0100")
+        self.assertEqual(response.data["nearestBranch"]["branch"]["id"], self.branch.id)
+
+    @patch("googlemaps.geocoding.geocode")
+    def test_branches_without_coordinates_are_not_geocoded_by_requests(self, mocked_geocode, *_):
+        Branch.objects.filter(id=self.branch.id).update(latitude=None, longitude=None, grid_cell="")
+
+        # the Berea branch is closer, but it can't be matched until locate_branches has located it:
+        response = self.get_nearest_branch("-29.8587,31.0218")
+
+        self.assertEqual(response.data["nearestBranch"]["branch"]["id"], self.umhlanga_branch.id)
+        mocked_geocode.assert_not_called()
+
+    @patch("googlemaps.geocoding.geocode", side_effect=googlemaps.exceptions.ApiError("UNKNOWN_ERROR"))
+    def test_branches_that_fail_to_geocode_are_retried_later(self, mocked_geocode, *_):
+        Branch.objects.filter(id=self.branch.id).update(latitude=None, longitude=None, grid_cell="")
+
+        call_command("locate_branches", stdout=StringIO())
+        call_command("locate_branches", stdout=StringIO())
+
+        self.branch.refresh_from_db()
+        self.assertIsNotNone(self.branch.geocode_failed_at)
+        self.assertEqual(mocked_geocode.call_count, 1)
+
+        Branch.objects.filter(id=self.branch.id).update(geocode_failed_at=timezone.now() - timedelta(days=2))
+        call_command("locate_branches", stdout=StringIO())
+        self.assertEqual(mocked_geocode.call_count, 2)
+
+    @patch("googlemaps.geocoding.geocode")
+    def test_branches_without_a_grid_cell_are_backfilled(self, mocked_geocode, *_):
+        mocked_geocode.return_value = [
+            {"geometry": {"location": {"lat": -29.8579, "lng": 31.0292}}}
+        ]
+        # one branch was never geocoded and the other was saved before grid cells existed:
+        Branch.objects.filter(id=self.branch.id).update(latitude=None, longitude=None, grid_cell="")
+        Branch.objects.filter(id=self.umhlanga_branch.id).update(grid_cell="")
+
+        call_command("locate_branches", stdout=StringIO())
+
+        self.branch.refresh_from_db()
+        self.umhlanga_branch.refresh_from_db()
+        self.assertEqual(self.branch.latitude, -29.8579)
+        self.assertNotEqual(self.branch.grid_cell, "")
+        self.assertNotEqual(self.umhlanga_branch.grid_cell, "")
+        self.assertEqual(mocked_geocode.call_count, 1)
+        self.assertEqual(
+            {branch["id"] for branch in find_branches_in_radius(-29.80, 31.03, 20)},
+            {self.branch.id, self.umhlanga_branch.id},
+        )
+
+    def test_catalog_query_count_does_not_grow_with_the_catalog(self, *_):
+        # warm up the address cache so both requests do the same work:
+        self.get_nearest_branch("-29.8500,31.0100")
+        with self.assertNumQueries(10):
+            response = self.get_nearest_branch("-29.8500,31.0100")
+        self.assertEqual(len(response.data["nearestBranch"]["products"]), 3)
+
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=self.branch_product_1.global_product,
+                branch_price=Decimal("40.00"),
+                created_by=self.branch_product_1.created_by,
+            )
+            for _ in range(2000)
+        ])
+        new_branch_products = list(
+            BranchProduct.objects.filter(branch_price=Decimal("40.00")).order_by("id")
+        )
+        SaleCampaign.objects.bulk_create([
+            SaleCampaign(branch=self.branch, branch_product=branch_product, percentage_off=10)
+            for branch_product in new_branch_products[:200]
+        ])
+
+        with self.assertNumQueries(10):
+            response = self.get_nearest_branch("-29.8500,31.0100")
+
+        products = {product["id"]: product for product in response.data["nearestBranch"]["products"]}
+        self.assertEqual(len(products), 2003)
+        self.assertEqual(products[new_branch_products[0].id]["branch_price"], "36.00")
+        self.assertEqual(products[new_branch_products[-1].id]["branch_price"], "40.00")
+        self.assertEqual(products[self.branch_product_2.id]["branch_price"], "25.00")
+
+
+class PricingTests(GlobalTestCaseConfig):
+
+    def test_effective_prices_are_calculated_in_one_query(self):
+        branch_product_ids = [
+            self.branch_product_1.id,
+            self.branch_product_2.id,
+            self.branch_product_3.id,
+        ]
+        with self.assertNumQueries(1):
+            effective_prices = get_effective_prices(branch_product_ids)
+
+        sale_campaign = SaleCampaign.objects.get(branch_product=self.branch_product_2)
+        self.assertEqual(effective_prices[self.branch_product_2.id]["sale_campaign_id"], sale_campaign.id)
+        self.assertEqual(effective_prices[self.branch_product_2.id]["effective_price"], Decimal("25.00"))
+        self.assertIsNone(effective_prices[self.branch_product_1.id]["sale_campaign_id"])
+        self.assertEqual(effective_prices[self.branch_product_1.id]["effective_price"], Decimal("50.00"))
+
+    def test_ended_and_inactive_campaigns_are_ignored(self):
+        SaleCampaign.objects.filter(branch_product=self.branch_product_2).update(
+            campaign_ends=timezone.localdate() - timedelta(days=1)
+        )
+        SaleCampaign.objects.create(
+            branch=self.branch,
+            branch_product=self.branch_product_3,
+            percentage_off=20,
+            active=False,
+        )
+
+        effective_prices = get_effective_prices([self.branch_product_2.id, self.branch_product_3.id])
+
+        self.assertEqual(effective_prices[self.branch_product_2.id]["effective_price"], Decimal("50.00"))
+        self.assertEqual(effective_prices[self.branch_product_3.id]["effective_price"], Decimal("50.00"))
+
+    def test_sale_prices_are_rounded_half_up_to_cents(self):
+        self.assertEqual(calculate_sale_price("10.05", 50), Decimal("5.03"))
+        self.assertEqual(calculate_sale_price(Decimal("19.99"), 15), Decimal("16.99"))
+        self.assertEqual(calculate_sale_price(0.1 + 0.2, 0), Decimal("0.30"))
+
+
+class BranchCatalogTests(GlobalTestCaseConfig):
+
+    def get_branch_catalog(self, since=None, etag=None):
+        url = reverse("get_branch_catalog", args=[self.branch.id])
+        headers = {"HTTP_AUTHORIZATION": f"Token {self.user_token}"}
+        if etag:
+            headers["HTTP_IF_NONE_MATCH"] = etag
+        return self.client.get(url, {"since": since} if since else {}, **headers)
+
+    def test_catalog_version_is_bumped_by_products_and_sale_campaigns(self):
+        self.branch.refresh_from_db()
+        version = self.branch.catalog_version
+
+        self.branch_product_1.branch_price = Decimal("45.00")
+        self.branch_product_1.save()
+        SaleCampaign.objects.create(
+            branch=self.branch, branch_product=self.branch_product_3, percentage_off=10
+        )
+
+        self.branch.refresh_from_db()
+        self.assertEqual(self.branch.catalog_version, version + 2)
+
+        # saving a stale branch instance must not roll the version back, its new address is a change too:
+        stale_branch = Branch.objects.get(id=self.branch.id)
+        self.branch_product_1.save()
+        stale_branch.address = "New address"
+        stale_branch.save()
+        self.branch.refresh_from_db()
+        self.assertEqual(self.branch.catalog_version, version + 4)
+
+        # saving what catalogs don't show leaves the version alone:
+        self.branch.latitude = -29.85
+        self.branch.save()
+        self.branch.refresh_from_db()
+        self.assertEqual(self.branch.catalog_version, version + 4)
+
+    def test_unchanged_catalog_is_not_sent_again(self):
+        response = self.get_branch_catalog()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["mode"], "full")
+        self.assertEqual(len(response.data["products"]), 3)
+
+        response = self.get_branch_catalog(etag=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        self.branch_product_1.branch_price = Decimal("45.00")
+        self.branch_product_1.save()
+        response = self.get_branch_catalog(etag=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_delta_only_contains_changed_and_removed_products(self):
+        version = self.get_branch_catalog().data["version"]
+
+        self.branch_product_1.branch_price = Decimal("45.00")
+        self.branch_product_1.save()
+        removed_product_id = self.branch_product_3.id
+        self.branch_product_3.delete()
+
+        response = self.get_branch_catalog(since=version)
+
+        self.assertEqual(response.data["mode"], "delta")
+        self.assertEqual([product["id"] for product in response.data["products"]], [self.branch_product_1.id])
+        self.assertEqual(response.data["products"][0]["branch_price"], "45.00")
+        self.assertEqual(response.data["removed"], [removed_product_id])
+
+    def test_merchant_and_product_edits_reach_the_catalog(self):
+        response = self.get_branch_catalog()
+
+        merchant = MerchantBusiness.objects.get(id=self.branch.merchant_id)
+        merchant.delivery_fee = Decimal("35.00")
+        merchant.save()
+
+        response = self.get_branch_catalog(etag=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {product["branch"]["merchant"]["delivery_fee"] for product in response.data["products"]}, {"35.00"}
+        )
+
+        global_product = self.branch_product_1.global_product
+        global_product.name = "Puppy Food"
+        global_product.save()
+
+        response = self.get_branch_catalog(since=response.data["version"])
+        self.assertEqual(response.data["mode"], "delta")
+        self.assertEqual([product["id"] for product in response.data["products"]], [self.branch_product_1.id])
+        self.assertEqual(response.data["products"][0]["global_product"]["name"], "Puppy Food")
+
+    def test_delta_follows_products_and_sale_campaigns_that_moved(self):
+        version = self.get_branch_catalog().data["version"]
+        other_branch = Branch.objects.create(
+            is_active=True, address="1 Other Street", merchant=self.branch.merchant
+        )
+
+        # the sale moves from the second product to the first:
+        campaign = SaleCampaign.objects.get(branch_product=self.branch_product_2)
+        campaign.branch_product = self.branch_product_1
+        campaign.save()
+        self.branch_product_3.branch = other_branch
+        self.branch_product_3.save()
+
+        response = self.get_branch_catalog(since=version)
+
+        self.assertEqual(response.data["mode"], "delta")
+        prices = {product["id"]: product["branch_price"] for product in response.data["products"]}
+        self.assertEqual(prices, {self.branch_product_1.id: "25.00", self.branch_product_2.id: "50.00"})
+        self.assertEqual(response.data["removed"], [self.branch_product_3.id])
+
+    def test_delta_reprices_products_whose_sale_campaign_ended(self):
+        version = self.get_branch_catalog().data["version"]
+
+        # the app last synced a few days ago and the sale has ended since:
+        BranchCatalogChange.objects.filter(branch_id=self.branch.id, version=version).update(
+            created=timezone.now() - timedelta(days=3)
+        )
+        SaleCampaign.objects.filter(branch_product=self.branch_product_2).update(
+            campaign_ends=timezone.localdate() - timedelta(days=1)
+        )
+
+        response = self.get_branch_catalog(since=version)
+
+        self.assertEqual(response.data["mode"], "delta")
+        self.assertEqual(len(response.data["products"]), 1)
+        self.assertEqual(response.data["products"][0]["id"], self.branch_product_2.id)
+        self.assertEqual(response.data["products"][0]["branch_price"], "50.00")
+
+    def test_unknown_version_falls_back_to_the_full_catalog(self):
+        response = self.get_branch_catalog(since=10000)
+
+        self.assertEqual(response.data["mode"], "full")
+        self.assertEqual(len(response.data["products"]), 3)
+
+    def test_changes_older_than_the_retention_window_are_pruned(self):
+        old_version = self.get_branch_catalog().data["version"]
+        BranchCatalogChange.objects.filter(branch_id=self.branch.id).update(
+            created=timezone.now() - timedelta(days=31)
+        )
+        self.branch_product_1.branch_price = Decimal("45.00")
+        self.branch_product_1.save()
+        recent_version = self.get_branch_catalog().data["version"]
+        self.branch_product_2.branch_price = Decimal("55.00")
+        self.branch_product_2.save()
+
+        call_command("prune_catalog_changes", stdout=StringIO())
+
+        # apps that synced before the window get the full catalog, the others still get a delta:
+        self.assertEqual(self.get_branch_catalog(since=old_version).data["mode"], "full")
+        response = self.get_branch_catalog(since=recent_version)
+        self.assertEqual(response.data["mode"], "delta")
+        self.assertEqual([product["id"] for product in response.data["products"]], [self.branch_product_2.id])
+
+
+class UpdatedMerchantsNearbyTests(GlobalTestCaseConfig):
+
+    def create_nearby_stores(self, count):
+        merchants = [self.branch.merchant]
+        for number in range(count - 1):
+            user = User.objects.create(username=f"petstore{number}", email=f"petstore{number}@gmail.com")
+            user_account = UserAccount.objects.create(
+                user=user, phone_number=f"06{number:08d}", is_merchant=True
+            )
+            merchant = MerchantBusiness.objects.create(
+                user_account=user_account,
+                name=f"Pet Store {number}",
+                email=f"petstore{number}@gmail.com",
+                address=f"{number} Pet Street",
+                delivery_fee=Decimal("20.00"),
+            )
+            branch = Branch.objects.create(is_active=True, address=f"{number} Pet Street", merchant=merchant)
+            for price in ["30.00", "40.00"]:
+                BranchProduct.objects.create(
+                    branch=branch,
+                    global_product=self.branch_product_1.global_product,
+                    branch_price=Decimal(price),
+                    created_by=user_account,
+                )
+            merchants.append(merchant)
+        return merchants
+
+    def get_updated_stores(self, stores):
+        return self.client.get(
+            reverse("get_updated_petstores_near_me", args=[json.dumps(stores)]),
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+        )
+
+    def test_distances_are_matched_to_stores_by_id(self):
+        merchants = self.create_nearby_stores(3)
+        stores = [
+            {"id": merchant.id, "distance": f"{minutes} mins"}
+            for minutes, merchant in reversed(list(enumerate(merchants, start=1)))
+        ]
+
+        response = self.get_updated_stores(stores)
+
+        self.assertEqual(response.status_code, 200)
+        returned_stores = response.data["petStoresNearby"]
+        self.assertEqual([store["merchant"]["id"] for store in returned_stores], [store["id"] for store in stores])
+        for store, returned_store in zip(stores, returned_stores):
+            self.assertEqual(returned_store["distance"]["duration"]["text"], store["distance"])
+
+        # the default store has a product on sale:
+        products = {product["id"]: product for product in returned_stores[-1]["products"]}
+        self.assertEqual(len(products), 3)
+        self.assertEqual(products[self.branch_product_2.id]["branch_price"], "25.00")
+
+    def test_fifty_stores_take_a_constant_number_of_queries(self):
+        merchants = self.create_nearby_stores(50)
+        stores = [{"id": merchant.id, "distance": "10 mins"} for merchant in merchants]
+
+        with self.assertNumQueries(4):
+            response = self.get_updated_stores(stores[:1])
+        self.assertEqual(len(response.data["petStoresNearby"]), 1)
+
+        with self.assertNumQueries(4):
+            response = self.get_updated_stores(stores)
+        self.assertEqual(len(response.data["petStoresNearby"]), 50)
+        self.assertEqual(sum(len(store["products"]) for store in response.data["petStoresNearby"]), 101)
+
+    def test_unchanged_stores_are_not_sent_again(self):
+        stores = [{"id": self.branch.merchant.id, "distance": "10 mins"}]
+        response = self.get_updated_stores(stores)
+
+        response = self.client.get(
+            reverse("get_updated_petstores_near_me", args=[json.dumps(stores)]),
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # a new delivery fee is sent straight away:
+        merchant = MerchantBusiness.objects.get(id=self.branch.merchant_id)
+        merchant.delivery_fee = Decimal("35.00")
+        merchant.save()
+        response = self.client.get(
+            reverse("get_updated_petstores_near_me", args=[json.dumps(stores)]),
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["petStoresNearby"][0]["merchant"]["delivery_fee"], "35.00")
+
+
+class ProjectionSerializerTests(GlobalTestCaseConfig):
+
+    """
+    Compares the depth=N BranchProductSerializer with the projection serializer that
+    replaced it on the catalog and search endpoints.
+    """
+
+    def measure(self, serialize):
+        with CaptureQueriesContext(connection) as queries:
+            data = serialize()
+        return {"bytes": len(JSONRenderer().render(data)), "queries": len(queries)}
+
+    def test_catalog_serialization(self):
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=self.branch_product_1.global_product,
+                branch_price=Decimal("40.00"),
+                created_by=self.merchant_user_account,
+            )
+            for _ in range(200)
+        ])
+        branch_products = BranchProduct.objects.filter(branch=self.branch).order_by("id")
+
+        before = self.measure(lambda: BranchProductSerializer(branch_products.all(), many=True).data)
+        after = self.measure(lambda: BranchProductProjectionSerializer(branch_products.all()).data)
+
+        self.assertEqual(after["queries"], 1)
+        self.assertLess(after["queries"], before["queries"])
+        self.assertLess(after["bytes"], before["bytes"])
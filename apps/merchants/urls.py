@@ -5,6 +5,7 @@ from apps.merchants.views import (CreateMerchantView,
                                 AcknowledgeOrderView,
                                 FulfillOrderView,
                                 GetNearestBranch,
+                                GetBranchCatalog,
                                 GetUpdatedMerchantsNearby
                                 )
 
@@ -13,6 +14,7 @@ urlpatterns = [
     # little buddies unique url name urls:
     path('get-store-range/<str:coordinates>/', GetStoreRange.as_view(), name="get_store_range"),
     path('get-nearest-branch/<str:coordinates>/<int:merchantId>/', GetNearestBranch.as_view(), name="get_nearest_branch"),
+    path('get-branch-catalog/<int:branchId>/', GetBranchCatalog.as_view(), name="get_branch_catalog"),
     path('get-updated-petstores-near-me/<str:storeIds>/', GetUpdatedMerchantsNearby.as_view(), name="get_updated_petstores_near_me"),
 
 
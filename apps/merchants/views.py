@@ -7,7 +7,6 @@ import googlemaps.addressvalidation
 import googlemaps.client
 import googlemaps.convert
 import googlemaps.directions
-import googlemaps.distance_matrix
 import googlemaps.geocoding
 import googlemaps.geolocation
 import googlemaps.maps
@@ -18,14 +17,33 @@ from rest_framework.response import Response
 import googlemaps
 
 from apps.integrations.firebase_integration.firebase_module import FirebaseInstance
-from apps.merchants.models import Branch, MerchantBusiness, SaleCampaign
-from apps.merchants.serializers.merchant_serializer import BranchSerializer, MerchantSerializer, SaleCampaignSerializer
+from apps.integrations.google_maps_integration.google_maps_module import GoogleMapsInstance
+from apps.merchants.branch_distances import get_branch_distances
+from apps.merchants.branch_locator import (
+    find_branches_in_radius,
+    find_nearest_branch,
+    parse_coordinates,
+)
+from apps.merchants.models import Branch, MerchantBusiness
+from apps.merchants.serializers.merchant_serializer import BranchSerializer, MerchantSerializer
 
 from apps.orders.models import Order, OrderedProduct
 from apps.accounts.models import UserAccount
 from apps.orders.serializers.order_serializer import OrderSerializer
 from apps.products.models import BranchProduct
-from apps.products.serializers.serializers import BranchProductSerializer, ProductSerializer
+from apps.products.catalog import (
+    etag_matches,
+    get_branch_catalog,
+    get_catalog_changes,
+    make_catalog_etag,
+    serialize_sale_campaigns,
+)
+from apps.products.pricing import (
+    active_sale_campaigns,
+    annotate_sale_campaigns,
+    calculate_sale_price,
+)
+from apps.products.serializers.serializers import BranchProductProjectionSerializer
 from global_view_functions.global_view_functions import GlobalViewFunctions
 import logging
 
@@ -35,19 +53,45 @@ class GetStoreRange(APIView, GlobalViewFunctions):
     
     def get(self, request, **kwargs):
         try:
-            coordinates = kwargs.get('coordinates') # TODO: use these coordinates to find stores near the user
-            mb = MerchantBusiness.objects.all()
-            sc = SaleCampaign.objects.filter(branch__merchant__in=mb, campaign_ends__gte=datetime.datetime.now(), active=True)
-            sale_campaigns = []
-            if sc: 
-                scs = SaleCampaignSerializer(sc, many=True)
-                sale_campaigns = scs.data
-            if mb: ms = MerchantSerializer(mb, many=True)
-            else: raise Exception("No Pet stores were found")
+            latitude, longitude = parse_coordinates(kwargs.get('coordinates'))
+
+            # find the active branches around the customer, nearest first:
+            branches_in_range = find_branches_in_radius(
+                latitude, longitude, settings.STORE_RANGE_RADIUS_KM
+            )
+            if not branches_in_range:
+                raise Exception("No Pet stores were found")
+
+            # each pet store is represented by its branch closest to the customer:
+            nearest_branches = {}
+            for branch in branches_in_range:
+                nearest_branches.setdefault(branch["merchant_id"], branch)
+
+            # driving distances to those branches, batched and cached:
+            distances = get_branch_distances(
+                kwargs.get('coordinates'), list(nearest_branches.values())
+            )
+
+            mb = MerchantBusiness.objects.in_bulk(list(nearest_branches))
+            petstores = MerchantSerializer(
+                [mb[merchant_id] for merchant_id in nearest_branches if merchant_id in mb],
+                many=True
+            ).data
+            for petstore in petstores:
+                nearest_branch = nearest_branches[petstore["id"]]
+                petstore["nearest_branch"] = {
+                    **nearest_branch, "distance": distances[nearest_branch["id"]]
+                }
+
+            sale_campaigns = serialize_sale_campaigns(
+                active_sale_campaigns().filter(
+                    branch_id__in=[branch["id"] for branch in nearest_branches.values()],
+                )
+            )
             return Response({
                 "success": True,
                 "message": "Store range retrieved successfully",
-                "petstores": ms.data,
+                "petstores": petstores,
                 "sale_campaigns": sale_campaigns
             }, status=200)
         except Exception as e:
@@ -68,18 +112,14 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
             # get the merchant business they want to get the nearest branch of:
             merchant_business = MerchantBusiness.objects.get(id=kwargs["merchantId"])
 
-            # initialize the google maps service:
-            gmaps_client = googlemaps.Client(key=settings.GOOGLE_SERVICES_API_KEY)
+            # initialize the (cached) google maps service:
+            gmaps_client = GoogleMapsInstance()
 
-            # get the customers address based on the coordinates:
-            customer_address = self._get_customer_address(coordinates, gmaps_client)
+            # start looking up the customers address, it runs on the outbound pool while we work locally:
+            customer_address_lookup = gmaps_client.start_reverse_geocode(coordinates)
 
             # find the nearest branch of the merchant business that is closes to the customers address:
-            branch_data = self._locate_nearest_branch(
-                coordinates, 
-                merchant_business,
-                gmaps_client, 
-            )
+            branch_data = self._locate_nearest_branch(coordinates, merchant_business)
 
             # get the last order made from this branch by this user:
             if branch_data:
@@ -93,6 +133,9 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
                     if last_order else None
                 )
 
+            # the customers address should be ready by now:
+            customer_address = self._get_customer_address(customer_address_lookup)
+
             return Response({
                 "success": True,
                 "message": "Nearest branch retrieved successfully!",
@@ -129,10 +172,10 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
 
                 # get the ordered products from the transaction and order:
                 order_products = list(last_order.products_ordered.select_related(
-                    'branch_product__product'
+                    'branch_product__global_product'
                 ).all())
                 transaction_products = list(last_order.transaction.products_ordered.select_related(
-                    'branch_product__product'
+                    'branch_product__global_product'
                 ).all())
 
                 # get the products to use from either the transaction or the order:
@@ -190,7 +233,7 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
                                 "percentage_change": round(
                                     ((current_price - old_price) / old_price) * 100, 2
                                 ),
-                                "image": current_products_dict[product_id]["product"]["photo"],
+                                "image": current_products_dict[product_id]["global_product"]["photo"],
                             }
                         )
 
@@ -198,70 +241,29 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
         except Exception as e:
             raise Exception(f"Failed to calculate price changes: {str(e)}")
 
-    def _get_branch_products(self, branch):
-        bps = BranchProductSerializer(
-            BranchProduct.objects.filter(branch=branch), many=True
-        )
-        return bps
-
-    def _get_branch_sale_campaigns(self, branch):
-        sale_campaigns = SaleCampaign.objects.filter(
-            branch=branch, campaign_ends__gte=datetime.datetime.now()
-        )
-        scs = SaleCampaignSerializer()
-        if sale_campaigns:
-            scs = SaleCampaignSerializer(sale_campaigns, many=True)
-            return sale_campaigns, scs.data
-        return None, None
-
-    def _locate_nearest_branch(
-        self, coordinates, merchant_business: MerchantBusiness, gmaps_client
-    ):
+    def _locate_nearest_branch(self, coordinates, merchant_business: MerchantBusiness):
         try:
-            # use the coordinates provided to find the nearest branch:
-            nearest_branch = googlemaps.places.find_place(
-                client=gmaps_client,
-                input=merchant_business.name,
-                input_type="textquery",
-                fields=["formatted_address", "name"],
-                location_bias=f"circle:3000@{coordinates}",
+            # find the merchants branch closest to the customer using the stored branch coordinates:
+            latitude, longitude = parse_coordinates(coordinates)
+            branch_id, distance_km = find_nearest_branch(
+                merchant_business.id, latitude, longitude
             )
-            # if the response does not contain any candidates, return an error response:
-            if not nearest_branch["candidates"]:
-                return {"success": False, "message": "No branches found in Google Maps response"}
-
-            # get the address of the located branch:
-            branch_address = nearest_branch["candidates"][0]["formatted_address"]
-            normalized_branch_address = " ".join(branch_address.split())
-
-            # in our database, find the branch that matches this address:
-            # this must return one, if it does not this is a critical error:
-            try:
-                branch = Branch.objects.get(
-                    address__icontains=normalized_branch_address,
-                    merchant__name__icontains=merchant_business.name
-                )
-            except Exception as e:
-                raise Exception(f"Failed to find branch matching address (Critical error): {str(e)}")
+            if branch_id is None:
+                return {"success": False, "message": "No branches with a known location were found"}
 
-            # serialize the branch and get the products:
-            bs = BranchSerializer(branch, many=False)
-            branch_products = self._get_branch_products(branch)
-
-            #  get the sale campaigns created by this branch:
-            sale_campaigns, sale_campaigns_serialized = self._get_branch_sale_campaigns(branch)
+            branch = Branch.objects.select_related("merchant__user_account").get(id=branch_id)
 
-            # if sale campaigns have been found we need to adjust the prices in the branch products
-            # according to the sale campaign discount percentages:
-            self._adjust_prices_based_on_sale_campaigns(
-                sale_campaigns, branch_products.data
-            )
+            # serialize the branch and get the products priced with their sale campaigns:
+            bs = BranchSerializer(branch, many=False)
+            products, sale_campaigns = get_branch_catalog(branch)
 
             # set the branch data response:
             branch_data = {
-                "branch": bs.data, 
-                "products": branch_products.data,
-                "sale_campaigns": sale_campaigns_serialized if sale_campaigns else [],
+                "branch": bs.data,
+                "distance_km": distance_km,
+                "catalog_etag": make_catalog_etag(branch.id, branch.catalog_version),
+                "products": products,
+                "sale_campaigns": sale_campaigns,
             }
             return branch_data
 
@@ -273,44 +275,52 @@ class GetNearestBranch(APIView, GlobalViewFunctions):
                 "error": str(e),
             }
 
-    def _adjust_prices_based_on_sale_campaigns(self, sale_campaigns, branch_products):
-
-        # adjust prices for each product if it is on sale:
-        if sale_campaigns:
-            for branch_product in branch_products:
-                sale_campaign = sale_campaigns.filter(branch_product=branch_product["id"]).first()
-                if sale_campaign:
-                    discount = sale_campaign.percentage_off
-                    discounted_price = float(branch_product["branch_price"]) * (1 - discount / 100)
-                    branch_product["branch_price"] = str(f"{discounted_price:.2f}")
-
-    def _get_customer_address(self, coordinates, gmaps_client):
+    def _get_customer_address(self, customer_address_lookup):
         try:
-            device_address = googlemaps.geocoding.reverse_geocode(
-                gmaps_client,
-                coordinates,
-            )
+            device_address = customer_address_lookup()
             device_address = device_address[0]
             return device_address["formatted_address"]
         except Exception as e:
             raise Exception(f"Failed to get location area: {str(e)}")
 
-    def _set_distance(self, distances, branches):
-        for distance_data in distances:
-            branches["distance"] = distance_data
-        return branches
 
-    def _get_distance(self, coordinates, address, gmaps_client):
+class GetBranchCatalog(APIView, GlobalViewFunctions):
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, **kwargs):
         try:
-            distances = googlemaps.distance_matrix.distance_matrix(
-                client=gmaps_client,
-                origins=[coordinates],
-                destinations=[address]
-            )
-            distance = distances["rows"][0]["elements"]
-            return distance
+            branch = Branch.objects.get(id=kwargs["branchId"])
+            etag = make_catalog_etag(branch.id, branch.catalog_version)
+
+            # nothing changed since the app last downloaded this catalog:
+            if etag_matches(request, etag):
+                return Response(status=304, headers={"ETag": etag})
+
+            # only send what changed if the app tells us which version it has:
+            since = request.query_params.get("since")
+            changes = get_catalog_changes(branch, int(since)) if since else None
+            if changes is None:
+                products, sale_campaigns = get_branch_catalog(branch)
+                catalog = {"mode": "full", "products": products, "removed": []}
+            else:
+                changed_ids, removed_ids = changes
+                products, sale_campaigns = get_branch_catalog(branch, changed_ids)
+                catalog = {"mode": "delta", "products": products, "removed": removed_ids}
+
+            return Response({
+                "success": True,
+                "message": "Branch catalog retrieved successfully",
+                "version": branch.catalog_version,
+                **catalog,
+                "sale_campaigns": sale_campaigns,
+            }, status=200, headers={"ETag": etag})
         except Exception as e:
-            raise Exception(f"Failed to get distance from customer: {str(e)}")
+            return Response({
+                "success": False,
+                "message": "Failed to get branch catalog",
+                "error": str(e)
+            }, status=400)
 
 
 class GetUpdatedMerchantsNearby(APIView, GlobalViewFunctions):
@@ -318,25 +328,40 @@ class GetUpdatedMerchantsNearby(APIView, GlobalViewFunctions):
     def get(self, request, **kwargs):
         try:
             logger.info("Getting updated stores near customer...")
-            updatedMerchantsNearby = []
             stores = json.loads(kwargs["storeIds"])
-            storeIds = [store.get("id") for store in stores]
-            storeDistances = [store.get("distance") for store in stores]
-            merchants = MerchantBusiness.objects.filter(
-                id__in=storeIds)
-            for index, merchant in enumerate(merchants):
-                products = self.get_products(merchant)
-                serializer = MerchantSerializer(merchant, many=False)
-                updatedMerchantsNearby.append({
-                    "merchant": serializer.data,
-                    "products": products,
-                    "distance": {"duration": {"text": storeDistances[index]}}
-                })
+            storeIds = [int(store.get("id")) for store in stores]
+            storeDistances = {int(store.get("id")): store.get("distance") for store in stores}
+
+            # the response only changes when the stores, their distances or their catalogs do:
+            branch_versions = Branch.objects.filter(merchant_id__in=storeIds).order_by(
+                "id"
+            ).values_list("id", "catalog_version")
+            etag = make_catalog_etag(kwargs["storeIds"], *branch_versions)
+            if etag_matches(request, etag):
+                return Response(status=304, headers={"ETag": etag})
+
+            # get all the merchants and all their products at once:
+            merchants = MerchantBusiness.objects.in_bulk(storeIds)
+            products_by_merchant = self._get_products_by_merchant(storeIds)
+
+            # keep the order the app asked for and match the distances by id:
+            merchant_ids = [merchant_id for merchant_id in storeIds if merchant_id in merchants]
+            serialized_merchants = MerchantSerializer(
+                [merchants[merchant_id] for merchant_id in merchant_ids], many=True
+            ).data
+            updatedMerchantsNearby = [
+                {
+                    "merchant": merchant,
+                    "products": products_by_merchant.get(merchant_id, []),
+                    "distance": {"duration": {"text": storeDistances[merchant_id]}}
+                }
+                for merchant_id, merchant in zip(merchant_ids, serialized_merchants)
+            ]
             return Response({
                 "success": True,
                 "message": "Stores near customer retrieved successfully",
                 "petStoresNearby": updatedMerchantsNearby
-            }, status=200)
+            }, status=200, headers={"ETag": etag})
         except Exception as e:
             return Response({
                 "success": False,
@@ -344,6 +369,27 @@ class GetUpdatedMerchantsNearby(APIView, GlobalViewFunctions):
                 "error": str(e)
             }, status=401)
 
+    def _get_products_by_merchant(self, merchant_ids):
+        # sale prices are worked out in the same query as the products:
+        branch_products = annotate_sale_campaigns(
+            BranchProduct.objects.filter(
+                branch__merchant_id__in=merchant_ids, is_active=True, in_stock=True
+            )
+        ).order_by("id")
+
+        products_by_merchant = {}
+        serializer = BranchProductProjectionSerializer(
+            branch_products, extra_fields=["sale_campaign_id", "campaign_percentage"]
+        )
+        products = serializer.data
+        for row, product in zip(serializer.rows, products):
+            if row["sale_campaign_id"] is not None:
+                product["branch_price"] = str(
+                    calculate_sale_price(row["branch_price"], row["campaign_percentage"])
+                )
+            products_by_merchant.setdefault(product["branch"]["merchant"]["id"], []).append(product)
+        return products_by_merchant
+
 
 class CreateMerchantView(APIView, GlobalViewFunctions):
 
@@ -17,6 +17,11 @@ class Order(models.Model):
 
     class Meta:
         verbose_name = "Order"
+        # order lists are paged on (created, id) and synced incrementally on (updated, id):
+        indexes = [
+            models.Index(fields=["created", "id"]),
+            models.Index(fields=["updated", "id"]),
+        ]
 
     PENDING_PICKUP = "PENDING_PICKUP"
     PENDING_DELIVERY = "PENDING_DELIVERY"
@@ -38,6 +43,7 @@ class Order(models.Model):
     products_ordered = models.ManyToManyField("orders.OrderedProduct", related_name="ordered_products")
     status = models.CharField(max_length=16, choices=order_statuses, default=PAYMENT_PENDING)
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
     acknowledged = models.BooleanField(default=False)
     acknowledgement_notification_sent = models.BooleanField(default=False)
     delivery = models.BooleanField(default=True)
@@ -57,6 +63,9 @@ class OrderedProduct(models.Model):
         null=True, blank=False, decimal_places=2, max_digits=10, default=0.00
     )
     ordered_by = models.ForeignKey(UserAccount, on_delete=models.SET_NULL, blank=False, null=True)
+    # reference of the transaction the product was ordered in, used to find the ordered products
+    # of a checkout after they were bulk created on databases that don't return their ids:
+    transaction_reference = models.CharField(max_length=191, blank=True, null=True, db_index=True)
 
     def __str__(self) -> str:
         return f"{self.branch_product.global_product.name} - {self.quantity_ordered}"
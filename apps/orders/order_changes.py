@@ -0,0 +1,111 @@
+"""
+What changed about the products of past orders since they were placed, used by the
+order changes check and the reorder screen.
+
+Any number of orders are checked with a fixed number of queries: one for the orders,
+one for all of their ordered products (joined to their branch products), one for the
+effective prices of those branch products and one for the branches. Everything else
+is dict lookups keyed by order and branch product id.
+"""
+
+from django.db.models import F
+
+from apps.merchants.models import Branch
+from apps.merchants.serializers.merchant_serializer import BranchSerializer
+from apps.orders.models import Order
+from apps.products.pricing import get_effective_prices
+
+
+def get_order_changes(order_ids, user_id):
+    """
+    Return {order id: order changes} for the given orders of the customer with the given
+    user id, other orders are left out. The changes of an order list the price changes,
+    out of stock and no longer sold products (keyed by ordered product id) and the old
+    and new totals.
+    """
+    order_branches = dict(
+        Order.objects.filter(id__in=set(order_ids), transaction__customer__user_id=user_id)
+        .values_list("id", "transaction__branch_id")
+    )
+    if not order_branches:
+        return {}
+
+    ordered_products = list(
+        Order.products_ordered.through.objects.filter(order_id__in=order_branches)
+        .order_by("orderedproduct_id")
+        .values(
+            "order_id",
+            ordered_product_id=F("orderedproduct_id"),
+            order_price=F("orderedproduct__order_price"),
+            quantity_ordered=F("orderedproduct__quantity_ordered"),
+            branch_product_id=F("orderedproduct__branch_product_id"),
+            branch_id=F("orderedproduct__branch_product__branch_id"),
+            branch_price=F("orderedproduct__branch_product__branch_price"),
+            in_stock=F("orderedproduct__branch_product__in_stock"),
+            is_active=F("orderedproduct__branch_product__is_active"),
+            name=F("orderedproduct__branch_product__global_product__name"),
+        )
+    )
+    effective_prices = get_effective_prices(
+        {product["branch_product_id"] for product in ordered_products if product["branch_product_id"]}
+    )
+    branches = {
+        branch["id"]: branch
+        for branch in BranchSerializer(
+            Branch.objects.filter(id__in=set(order_branches.values())).select_related(
+                "merchant__user_account"
+            ),
+            many=True,
+        ).data
+    }
+
+    order_changes = {
+        order_id: {
+            "branch": branches.get(branch_id),
+            "order_id": order_id,
+            "price_changes": {},
+            "out_of_stock": {},
+            "no_longer_sold": {},
+            "old_total": 0.00,
+            "new_total": 0.00,
+        }
+        for order_id, branch_id in order_branches.items()
+    }
+
+    for product in ordered_products:
+        changes = order_changes[product["order_id"]]
+        changes["old_total"] += float(product["order_price"] or 0) * product["quantity_ordered"]
+        if product["branch_product_id"] is None:
+            continue
+
+        if not product["in_stock"]:
+            changes["out_of_stock"][product["ordered_product_id"]] = {"name": product["name"]}
+        if not product["is_active"]:
+            changes["no_longer_sold"][product["ordered_product_id"]] = {"name": product["name"]}
+            continue
+        if product["branch_id"] != order_branches[product["order_id"]]:
+            continue
+
+        price_changes = {}
+        # the branch might have updated their prices since the order was placed:
+        if product["in_stock"]:
+            price_changes = {
+                "previous_order_price": product["order_price"],
+                "new_order_price": product["branch_price"],
+            }
+        # or the product might be on sale now:
+        effective_price = effective_prices[product["branch_product_id"]]
+        if (
+            effective_price["sale_campaign_id"] is not None
+            and product["order_price"] != effective_price["effective_price"]
+        ):
+            price_changes["sale_campaign_price"] = effective_price["effective_price"]
+        if not price_changes:
+            continue
+
+        changes["price_changes"][product["ordered_product_id"]] = price_changes
+        new_price = price_changes.get("sale_campaign_price", price_changes.get("new_order_price"))
+        if new_price is not None and product["in_stock"]:
+            changes["new_total"] += float(new_price) * product["quantity_ordered"]
+
+    return order_changes
@@ -0,0 +1,143 @@
+"""
+In-process pub/sub behind the merchant order feed, with a shared database poll for
+changes made in other processes.
+
+Every time an order of a merchant is created or changes (apps/orders/signals.py
+publishes it once the change is committed) the version of that merchant goes up and
+the feed requests waiting on it wake up. Waiting requests block on a condition of
+their own merchant, so a new order wakes only the requests of the merchant it was
+placed with.
+
+A waiting request holds its worker thread for up to ORDER_FEED["MAX_WAIT_SECONDS"],
+so the feed needs threaded workers (eg. gunicorn --worker-class gthread --threads 32).
+On sync workers every waiting merchant would hold a whole worker. At most
+ORDER_FEED["MAX_WAITING_REQUESTS"] requests wait in each process. Requests over that
+get OrderFeedBusy and are told to retry later, so the feed can't take every thread.
+
+Publishing only wakes the requests of the process the change was made in. Orders
+changed in other processes, eg. paid by the process_paystack_events worker, are found
+by a single poller thread per process. While requests are waiting it reads the orders
+of their merchants that changed in the last ORDER_FEED["POLL_LOOKBACK_SECONDS"], every
+ORDER_FEED["POLL_SECONDS"], and publishes the merchants with changes it hasn't seen
+yet. It's one query per process however many requests wait, and none while nobody does.
+"""
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from apps.orders.models import Order
+
+logger = logging.getLogger(__name__)
+
+
+class OrderFeedBusy(Exception):
+    pass
+
+
+class OrderFeed():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # merchant id -> condition its feed requests wait on, and how many changes were published:
+        self.conditions = {}
+        self.versions = {}
+        self.waiting_requests = 0
+        # merchant id -> how many requests are waiting on it, the poller only looks at these:
+        self.waiting_merchants = {}
+        self.poller = None
+        self.poller_wakeup = threading.Condition(self.lock)
+        # (order id, updated) of the changes the poller already published:
+        self.polled_changes = set()
+
+    def get_condition(self, merchant_id):
+        with self.lock:
+            return self.conditions.setdefault(merchant_id, threading.Condition())
+
+    def get_version(self, merchant_id):
+        return self.versions.get(merchant_id, 0)
+
+    def publish(self, merchant_id):
+        condition = self.get_condition(merchant_id)
+        with condition:
+            self.versions[merchant_id] = self.versions.get(merchant_id, 0) + 1
+            condition.notify_all()
+
+    def wait(self, merchant_id, version, timeout):
+        """
+        Block until something is published for the merchant after `version` was read,
+        by this process or by the poller, or timeout seconds pass. Returns True if
+        something changed. Raises OrderFeedBusy when too many requests of this process
+        are waiting already.
+        """
+        with self.lock:
+            if self.waiting_requests >= settings.ORDER_FEED["MAX_WAITING_REQUESTS"]:
+                raise OrderFeedBusy("The order feed is busy, try again later.")
+            self.waiting_requests += 1
+            self.waiting_merchants[merchant_id] = self.waiting_merchants.get(merchant_id, 0) + 1
+            self.start_poller()
+        try:
+            condition = self.get_condition(merchant_id)
+            with condition:
+                return condition.wait_for(lambda: self.versions.get(merchant_id, 0) != version, timeout)
+        finally:
+            with self.lock:
+                self.waiting_requests -= 1
+                self.waiting_merchants[merchant_id] -= 1
+                if not self.waiting_merchants[merchant_id]:
+                    del self.waiting_merchants[merchant_id]
+
+    def start_poller(self):
+        # called holding the lock:
+        if self.poller is None or not self.poller.is_alive():
+            self.poller = threading.Thread(target=self.run_poller, name="order-feed-poller", daemon=True)
+            self.poller.start()
+        self.poller_wakeup.notify()
+
+    def run_poller(self):
+        while True:
+            with self.lock:
+                if not self.waiting_merchants:
+                    # don't hold on to a database connection while nobody is waiting:
+                    connection.close()
+                    self.poller_wakeup.wait_for(lambda: self.waiting_merchants)
+                merchant_ids = list(self.waiting_merchants)
+            try:
+                close_old_connections()
+                self.poll(merchant_ids)
+            except Exception as e:
+                logger.warning(f"Failed to poll the order feed: {e}")
+            time.sleep(settings.ORDER_FEED["POLL_SECONDS"])
+
+    def poll(self, merchant_ids):
+        """
+        Publish the merchants among merchant_ids with order changes the poller hasn't
+        seen yet. Orders are stamped before they commit, so the poller looks back
+        ORDER_FEED["POLL_LOOKBACK_SECONDS"] to find orders that commit late.
+        """
+        since = timezone.now() - timedelta(seconds=settings.ORDER_FEED["POLL_LOOKBACK_SECONDS"])
+        changes = Order.objects.filter(
+            updated__gt=since, transaction__branch__merchant_id__in=merchant_ids
+        ).values_list("id", "updated", "transaction__branch__merchant_id")
+
+        changed_merchant_ids = set()
+        polled_changes = set()
+        for order_id, updated, merchant_id in changes:
+            polled_changes.add((order_id, updated))
+            if (order_id, updated) not in self.polled_changes:
+                changed_merchant_ids.add(merchant_id)
+        # only the changes still within the lookback have to be remembered:
+        self.polled_changes = polled_changes | {
+            change for change in self.polled_changes if change[1] > since
+        }
+
+        for merchant_id in changed_merchant_ids:
+            self.publish(merchant_id)
+        return changed_merchant_ids
+
+order_feed = OrderFeed()
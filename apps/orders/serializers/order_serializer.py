@@ -1,6 +1,12 @@
-
 from rest_framework import serializers
 from apps.orders.models import Order
+from global_serializer_functions.projection_serializer import (
+    ProjectionSerializer,
+    date_to_string,
+    datetime_to_string,
+    decimal_to_string,
+    file_to_url,
+)
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -10,3 +16,74 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = "__all__"
         depth = 3
 
+
+class OrderProjectionSerializer(ProjectionSerializer):
+
+    """
+    Lean version of OrderSerializer for order lists. The ordered products are
+    serialized separately with OrderedProductProjectionSerializer.
+    """
+
+    fields = [
+        "id",
+        "status",
+        "created",
+        "updated",
+        "acknowledged",
+        "delivery",
+        "delivery_fee",
+        "delivery_date",
+        "delivery_address",
+        "customer__id",
+        "customer__phone_number",
+        "customer__address",
+        "customer__user__first_name",
+        "customer__user__last_name",
+        "transaction__id",
+        "transaction__reference",
+        "transaction__status",
+        "transaction__total_with_service_fee",
+        "transaction__total_minus_service_fee",
+        "transaction__created",
+        "transaction__branch__id",
+        "transaction__branch__address",
+        "transaction__branch__merchant__id",
+        "transaction__branch__merchant__name",
+        "transaction__branch__merchant__logo",
+    ]
+
+    formatters = {
+        "created": datetime_to_string,
+        "updated": datetime_to_string,
+        "delivery_fee": decimal_to_string,
+        "transaction__total_with_service_fee": decimal_to_string,
+        "transaction__total_minus_service_fee": decimal_to_string,
+        "transaction__created": datetime_to_string,
+    }
+
+
+class OrderedProductProjectionSerializer(ProjectionSerializer):
+
+    fields = [
+        "id",
+        "quantity_ordered",
+        "order_price",
+        "branch_product__id",
+        "branch_product__branch_price",
+        "branch_product__global_product__id",
+        "branch_product__global_product__name",
+        "branch_product__global_product__description",
+        "branch_product__global_product__image",
+        "branch_product__global_product__photo",
+        "branch_product__global_product__category",
+        "sale_campaign__id",
+        "sale_campaign__percentage_off",
+        "sale_campaign__campaign_ends",
+    ]
+
+    formatters = {
+        "order_price": decimal_to_string,
+        "branch_product__branch_price": decimal_to_string,
+        "branch_product__global_product__photo": file_to_url,
+        "sale_campaign__campaign_ends": date_to_string,
+    }
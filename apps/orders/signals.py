@@ -1,7 +1,32 @@
+from functools import partial
+
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from .models import Order
+from .order_feed import order_feed
+from apps.transactions.models import Transaction
+
+
+def get_loaded_merchant_id(order):
+    # the merchant of an order whose transaction and branch were loaded with it, without a query:
+    if Order.transaction.is_cached(order) and Transaction.branch.is_cached(order.transaction):
+        branch = order.transaction.branch
+        return branch.merchant_id if branch is not None else None
+    return None
+
+
+def publish_order_change(transaction_id, merchant_id=None):
+    # looked up once the change is committed so saving an order doesn't wait on it:
+    if merchant_id is None:
+        merchant_id = (
+            Transaction.objects.filter(pk=transaction_id)
+            .values_list("branch__merchant_id", flat=True)
+            .first()
+        )
+    if merchant_id is not None:
+        order_feed.publish(merchant_id)
 
 
 @receiver(post_save, sender=Order)
@@ -14,6 +39,13 @@ def order_post_save_handler(sender, instance:Order, created, **kwargs):
     :param created: Boolean, True if a new record was created.
     :param kwargs: Additional arguments.
     """
+    # wake up the merchant's order feed once the change is visible to other connections,
+    # feed requests of other processes find the change when they next check the database:
+    if instance.transaction_id:
+        transaction.on_commit(
+            partial(publish_order_change, instance.transaction_id, get_loaded_merchant_id(instance))
+        )
+
     if created:
         # runs when the order is first created:
         pass
@@ -1,17 +1,28 @@
+import threading
+import time
 from unittest.mock import patch
 from django.apps import apps
 from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 import pytest
+from rest_framework.renderers import JSONRenderer
 from rest_framework.reverse import reverse
 from django.conf import settings
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.core.mail import send_mail
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
 from decimal import Decimal
 
 from django.contrib.auth import get_user_model
 from apps.orders.models import Order, OrderedProduct, record_cancellation
+from apps.orders.order_feed import order_feed
+from apps.orders.serializers.order_serializer import OrderSerializer
+from apps.orders.views import GetAllOrdersView
 from global_test_config.global_test_config import (
     GlobalTestCaseConfig,
     MockedPaystackResponse,
@@ -414,3 +425,416 @@ class CancelOrderTests(TestCase):
         self.assertEqual(cancelled_order.additional_notes, "Test cancellation")
         self.assertEqual(cancelled_order.refund_amount, Decimal("100.00"))
 
+
+class GetAllOrdersTests(GlobalTestCaseConfig):
+
+    def create_delivered_order(self):
+        transaction = Transaction.objects.create(
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=Decimal("105.00"),
+            total_minus_service_fee=Decimal("100.00"),
+            status="COMPLETED",
+        )
+        ordered_products = [
+            OrderedProduct.objects.create(
+                branch_product=self.branch_product_1,
+                quantity_ordered=1,
+                order_price=Decimal("50.00"),
+            ),
+            OrderedProduct.objects.create(
+                branch_product=self.branch_product_2,
+                sale_campaign=SaleCampaign.objects.get(branch_product=self.branch_product_2),
+                quantity_ordered=2,
+                order_price=Decimal("25.00"),
+            ),
+        ]
+        order = Order.objects.create(
+            customer=self.customer_user_account,
+            transaction=transaction,
+            status=Order.DELIVERED,
+            delivery_fee=Decimal("20.00"),
+        )
+        order.products_ordered.set(ordered_products)
+        return order
+
+    def get_all_orders(self, **params):
+        return self.client.get(
+            reverse("get_all_orders_view"),
+            params,
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+        )
+
+    def test_orders_are_listed_with_their_sale_prices(self):
+        order = self.create_delivered_order()
+
+        response = self.get_all_orders()
+
+        self.assertEqual(response.data["success"], True)
+        order_from_response = response.data["orders"][0]
+        self.assertEqual(order_from_response["id"], order.id)
+        self.assertEqual(order_from_response["transaction"]["branch"]["id"], self.branch.id)
+        self.assertEqual(order_from_response["transaction"]["total_with_service_fee"], "105.00")
+        products = {
+            product["branch_product"]["id"]: product
+            for product in order_from_response["products_ordered"]
+        }
+        self.assertIsNone(products[self.branch_product_1.id]["sale_campaign"])
+        self.assertEqual(products[self.branch_product_1.id]["branch_product"]["branch_price"], "50.00")
+        self.assertEqual(products[self.branch_product_2.id]["sale_campaign"]["percentage_off"], 50)
+        self.assertEqual(products[self.branch_product_2.id]["branch_product"]["branch_price"], "25.00")
+
+        # account details like password hashes are no longer part of the payload:
+        self.assertNotIn("password", str(response.data))
+
+    def test_order_list_query_count_does_not_grow_with_the_orders(self):
+        self.create_delivered_order()
+        with self.assertNumQueries(4):
+            response = self.get_all_orders()
+        self.assertEqual(len(response.data["orders"]), 1)
+
+        for _ in range(20):
+            self.create_delivered_order()
+        with self.assertNumQueries(4):
+            response = self.get_all_orders()
+        self.assertEqual(len(response.data["orders"]), 20)
+        with self.assertNumQueries(4):
+            response = self.get_all_orders(cursor=response.data["next_cursor"])
+        self.assertEqual(len(response.data["orders"]), 1)
+
+    def test_order_list_projection_is_lighter_than_the_order_serializer(self):
+        for _ in range(20):
+            self.create_delivered_order()
+        orders = Order.objects.order_by("created")
+
+        with CaptureQueriesContext(connection) as before_queries:
+            before = JSONRenderer().render(OrderSerializer(orders.all(), many=True).data)
+        with CaptureQueriesContext(connection) as after_queries:
+            after = JSONRenderer().render(GetAllOrdersView().serialize_orders(orders.all()))
+
+        self.assertEqual(len(after_queries), 2)
+        self.assertLess(len(after_queries), len(before_queries))
+        self.assertLess(len(after), len(before))
+
+    def test_orders_are_paged_newest_first(self):
+        orders = [self.create_delivered_order() for _ in range(5)]
+
+        order_ids = []
+        cursor = None
+        while True:
+            params = {"page_size": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.get_all_orders(**params)
+            self.assertEqual(response.data["success"], True)
+            self.assertLessEqual(len(response.data["orders"]), 2)
+            order_ids += [order["id"] for order in response.data["orders"]]
+            cursor = response.data["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(order_ids, [order.id for order in reversed(orders)])
+
+    def test_only_orders_updated_since_the_last_sync_are_listed(self):
+        old_order, changed_order, cancelled_order, late_order = [self.create_delivered_order() for _ in range(4)]
+        last_sync = timezone.now()
+        Order.objects.update(updated=last_sync - timedelta(hours=1))
+
+        changed_order.acknowledged = True
+        changed_order.save()
+        cancelled_order.status = Order.CANCELLED
+        cancelled_order.save()
+
+        response = self.get_all_orders(updated_since=last_sync.isoformat())
+        self.assertEqual(response.data["success"], True)
+        # cancellations are part of the changes so the app can drop the order:
+        self.assertEqual(
+            [(order["id"], order["status"]) for order in response.data["orders"]],
+            [(changed_order.id, Order.DELIVERED), (cancelled_order.id, Order.CANCELLED)],
+        )
+        self.assertIsNone(response.data["next_cursor"])
+
+        # an order stamped before the last change but committed after the app synced is sent on the next sync,
+        # along with the orders the app already has:
+        Order.objects.filter(id=late_order.id).update(
+            updated=parse_datetime(response.data["last_updated"]) - timedelta(minutes=1)
+        )
+        response = self.get_all_orders(updated_since=response.data["last_updated"])
+        self.assertEqual(
+            [order["id"] for order in response.data["orders"]], [late_order.id, changed_order.id, cancelled_order.id]
+        )
+
+    def test_invalid_cursors_and_dates_are_rejected(self):
+        self.assertEqual(self.get_all_orders(cursor="not-a-cursor").data["success"], False)
+        self.assertEqual(self.get_all_orders(updated_since="yesterday").data["success"], False)
+
+
+class OrderFeedTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        self.merchant_token, _ = Token.objects.get_or_create(user=self.merchant_user_account.user)
+
+    def create_paid_order(self):
+        transaction = Transaction.objects.create(
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=Decimal("55.00"),
+            total_minus_service_fee=Decimal("50.00"),
+            status="COMPLETED",
+        )
+        order = Order.objects.create(
+            customer=self.customer_user_account,
+            transaction=transaction,
+            status=Order.PENDING_DELIVERY,
+        )
+        order.products_ordered.set([
+            OrderedProduct.objects.create(
+                branch_product=self.branch_product_1,
+                quantity_ordered=1,
+                order_price=Decimal("50.00"),
+            ),
+        ])
+        return order
+
+    def get_feed(self, **params):
+        return self.client.get(
+            reverse("order_feed"),
+            params,
+            HTTP_AUTHORIZATION=f"Token {self.merchant_token.key}",
+        )
+
+    def test_order_changes_are_published_to_the_merchant(self):
+        version = order_feed.get_version(self.branch.merchant_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_paid_order()
+        self.assertEqual(order_feed.get_version(self.branch.merchant_id), version + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order.acknowledged = True
+            order.save()
+        self.assertEqual(order_feed.get_version(self.branch.merchant_id), version + 2)
+
+        # the merchant of an order loaded with its transaction and branch isn't looked up:
+        order = Order.objects.select_related("transaction__branch").get(id=order.id)
+        order.status = Order.DELIVERED
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        self.assertEqual(order_feed.get_version(self.branch.merchant_id), version + 3)
+
+    def test_changed_orders_are_returned_straight_away(self):
+        response = self.get_feed(timeout=0)
+        self.assertEqual(response.data["success"], True)
+        self.assertEqual(response.data["orders"], [])
+        cursor = response.data["cursor"]
+
+        order = self.create_paid_order()
+        with patch.object(order_feed, "wait") as mocked_wait:
+            response = self.get_feed(cursor=cursor)
+        mocked_wait.assert_not_called()
+        self.assertEqual([order["id"] for order in response.data["orders"]], [order.id])
+
+        # nothing changed after the new cursor:
+        response = self.get_feed(cursor=response.data["cursor"], timeout=0)
+        self.assertEqual(response.data["orders"], [])
+
+    def test_waiting_requests_wake_up_when_an_order_is_published(self):
+        merchant_id = self.branch.merchant_id
+        version = order_feed.get_version(merchant_id)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(order_feed.wait(merchant_id, version, 10)))
+        waiter.start()
+
+        order_feed.publish(merchant_id)
+        waiter.join(10)
+
+        self.assertEqual(results, [True])
+
+    def test_orders_changed_by_other_processes_are_published_by_the_poller(self):
+        merchant_id = self.branch.merchant_id
+        order_feed.poll([merchant_id])
+        version = order_feed.get_version(merchant_id)
+
+        # on commit callbacks don't run in tests, so nothing is published in this process:
+        order = self.create_paid_order()
+        self.assertEqual(order_feed.get_version(merchant_id), version)
+
+        # one query for all the waiting merchants, and every change is published once:
+        with self.assertNumQueries(1):
+            self.assertEqual(order_feed.poll([merchant_id, merchant_id + 1000]), {merchant_id})
+        self.assertEqual(order_feed.get_version(merchant_id), version + 1)
+        self.assertEqual(order_feed.poll([merchant_id]), set())
+
+        order.status = Order.DELIVERED
+        order.save()
+        self.assertEqual(order_feed.poll([merchant_id]), {merchant_id})
+
+    def test_waiting_requests_share_one_poller(self):
+        merchant_ids = [self.branch.merchant_id, self.branch.merchant_id + 1000]
+        versions = {merchant_id: order_feed.get_version(merchant_id) for merchant_id in merchant_ids}
+        polling_threads = set()
+
+        def poll(polled_merchant_ids):
+            polling_threads.add(threading.current_thread().name)
+            # a change for every merchant once all of them have requests waiting:
+            if sorted(polled_merchant_ids) == merchant_ids:
+                for merchant_id in polled_merchant_ids:
+                    order_feed.publish(merchant_id)
+            return set()
+
+        results = []
+        waiters = [
+            threading.Thread(
+                target=lambda merchant_id=merchant_id: results.append(
+                    order_feed.wait(merchant_id, versions[merchant_id], 10)
+                )
+            )
+            for merchant_id in merchant_ids * 3
+        ]
+        with patch.object(order_feed, "poll", side_effect=poll):
+            with self.settings(ORDER_FEED={**settings.ORDER_FEED, "POLL_SECONDS": 0.01}):
+                for waiter in waiters:
+                    waiter.start()
+                for waiter in waiters:
+                    waiter.join(10)
+
+        self.assertEqual(results, [True] * 6)
+        self.assertEqual(polling_threads, {"order-feed-poller"})
+        self.assertEqual(order_feed.waiting_merchants, {})
+
+    def test_busy_feeds_ask_apps_to_retry_later(self):
+        with self.settings(ORDER_FEED={**settings.ORDER_FEED, "MAX_WAITING_REQUESTS": 0}):
+            response = self.get_feed(timeout=10)
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], str(settings.ORDER_FEED["BUSY_RETRY_SECONDS"]))
+        self.assertEqual(order_feed.waiting_requests, 0)
+
+    def test_idle_feeds_time_out(self):
+        started = time.perf_counter()
+        response = self.get_feed(timeout=0.2)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.2)
+        self.assertEqual(response.data["orders"], [])
+
+    def test_customers_cannot_follow_the_feed(self):
+        response = self.client.get(
+            reverse("order_feed"), HTTP_AUTHORIZATION=f"Token {self.user_token}"
+        )
+        self.assertEqual(response.data["success"], False)
+
+
+class OrderChangesTests(GlobalTestCaseConfig):
+
+    def create_order(self, ordered_products):
+        transaction = Transaction.objects.create(
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=Decimal("130.00"),
+            total_minus_service_fee=Decimal("125.00"),
+            status="COMPLETED",
+        )
+        order = Order.objects.create(
+            customer=self.customer_user_account,
+            transaction=transaction,
+            status=Order.DELIVERED,
+        )
+        order.products_ordered.set([
+            OrderedProduct.objects.create(
+                branch_product=branch_product, quantity_ordered=quantity, order_price=order_price
+            )
+            for branch_product, quantity, order_price in ordered_products
+        ])
+        return order
+
+    def check_order(self, order_id, token=None):
+        return self.client.get(
+            reverse("check_for_order_changes", kwargs={"order_id": order_id}),
+            HTTP_AUTHORIZATION=f"Token {token or self.user_token}",
+        )
+
+    def test_price_and_stock_changes_are_reported(self):
+        order = self.create_order([
+            (self.branch_product_1, 2, Decimal("40.00")),
+            (self.branch_product_2, 1, Decimal("50.00")),
+            (self.branch_product_3, 1, Decimal("50.00")),
+        ])
+        ordered_products = {
+            ordered_product.branch_product_id: ordered_product.id
+            for ordered_product in order.products_ordered.all()
+        }
+        self.branch_product_3.in_stock = False
+        self.branch_product_3.save()
+
+        response = self.check_order(order.id)
+
+        self.assertEqual(response.data["success"], True, response.data)
+        changes = response.data["order_changes"]
+        self.assertEqual(changes["branch"]["id"], self.branch.id)
+        price_changes = changes["price_changes"]
+        self.assertEqual(price_changes[ordered_products[self.branch_product_1.id]]["new_order_price"], Decimal("50.00"))
+        # the second dog food is on sale at half price now:
+        self.assertEqual(
+            price_changes[ordered_products[self.branch_product_2.id]]["sale_campaign_price"], Decimal("25.00")
+        )
+        self.assertIn(ordered_products[self.branch_product_3.id], changes["out_of_stock"])
+        self.assertEqual(changes["old_total"], 180.00)
+        self.assertEqual(changes["new_total"], 125.00)
+
+    def test_concurrent_checks_do_not_share_their_changes(self):
+        first_order = self.create_order([(self.branch_product_1, 1, Decimal("40.00"))])
+        second_order = self.create_order([(self.branch_product_3, 1, Decimal("50.00"))])
+
+        self.check_order(first_order.id)
+        response = self.check_order(second_order.id)
+
+        changes = response.data["order_changes"]
+        self.assertEqual(list(changes["price_changes"]), [second_order.products_ordered.get().id])
+
+    def test_many_orders_are_checked_with_a_fixed_number_of_queries(self):
+        orders = [
+            self.create_order([
+                (self.branch_product_1, 1, Decimal("40.00")),
+                (self.branch_product_2, 1, Decimal("50.00")),
+            ])
+            for _ in range(10)
+        ]
+
+        # the token, the orders, their products, the effective prices and the branch with its merchant:
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                reverse("check_for_orders_changes"),
+                {"order_ids": [order.id for order in orders] + [999999]},
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Token {self.user_token}",
+            )
+
+        self.assertEqual(response.data["success"], True)
+        self.assertEqual(
+            [changes["order_id"] for changes in response.data["order_changes"]],
+            [order.id for order in orders],
+        )
+        self.assertEqual(response.data["orders_not_found"], [999999])
+
+    def test_unknown_orders_fail(self):
+        response = self.check_order(999999)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data["success"], False)
+
+    def test_only_the_customers_own_orders_are_checked(self):
+        order = self.create_order([(self.branch_product_1, 1, Decimal("40.00"))])
+
+        response = self.client.get(reverse("check_for_order_changes", kwargs={"order_id": order.id}))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        merchant_token, _ = Token.objects.get_or_create(user=self.merchant_user_account.user)
+        response = self.check_order(order.id, token=merchant_token.key)
+        self.assertEqual(response.data["success"], False)
+
+        response = self.client.post(
+            reverse("check_for_orders_changes"),
+            {"order_ids": [order.id]},
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Token {merchant_token.key}",
+        )
+        self.assertEqual(response.data["order_changes"], [])
+        self.assertEqual(response.data["orders_not_found"], [order.id])
@@ -1,10 +1,21 @@
 from django.urls import path
 
-from apps.orders.views import GetAllOrdersView, CancelOrder, checkForOrderChangesView
+from apps.orders.views import (
+    GetAllOrdersView,
+    CancelOrder,
+    OrderFeedView,
+    checkForOrderChangesView,
+)
 
 urlpatterns = [
     path("get-all-orders/", GetAllOrdersView.as_view(), name="get_all_orders_view"),
+    path("order-feed/", OrderFeedView.as_view(), name="order_feed"),
     path("cancel-order/<int:order_id>/", CancelOrder.as_view(), name="cancel_order"),
+    path(
+        "check-for-order-changes/",
+        checkForOrderChangesView.as_view(),
+        name="check_for_orders_changes",
+    ),
     path(
         "check-for-order-changes/<int:order_id>/",
         checkForOrderChangesView.as_view(),
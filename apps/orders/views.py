@@ -1,3 +1,8 @@
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import permissions, status
@@ -6,15 +11,22 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
-import datetime
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import logging
 
-from apps.merchants.serializers.merchant_serializer import BranchSerializer
+from apps.merchants.models import MerchantBusiness
 from apps.orders.models import Order, record_cancellation
-from apps.orders.serializers.order_serializer import OrderSerializer
+from apps.orders.order_changes import get_order_changes
+from apps.orders.order_feed import OrderFeedBusy, order_feed
+from apps.orders.serializers.order_serializer import (
+    OrderProjectionSerializer,
+    OrderedProductProjectionSerializer,
+)
 from apps.transactions.models import Transaction
-from apps.merchants.models import SaleCampaign
+from apps.products.pricing import calculate_sale_price
 from global_view_functions.global_view_functions import GlobalViewFunctions
 
 logger = logging.getLogger(__name__)
@@ -22,22 +34,65 @@ logger = logging.getLogger(__name__)
 
 class GetAllOrdersView(APIView, GlobalViewFunctions):
 
+    """
+    Lists the orders of a merchant or customer a page at a time, newest first. Passing
+    updated_since (an ISO datetime) lists only the orders that changed after it instead,
+    oldest change first, so the apps can keep their copy in sync without fetching
+    everything again. Syncs overlap by SYNC_OVERLAP so the apps get some orders twice
+    and replace them by id. Either way every page is read with the same handful of queries.
+    """
+
     permission_classes = [permissions.IsAuthenticated]
 
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    # orders are stamped before their transaction commits and the paystack webhook worker and
+    # reconciliation stamp whole batches at once, so an order can commit with an older stamp
+    # than orders an app already synced. Every sync reads back this far before updated_since:
+    SYNC_OVERLAP = timedelta(minutes=5)
+
     def get(self, request, **kwargs):
         try:
+            page_size = min(
+                max(int(request.query_params.get("page_size", self.DEFAULT_PAGE_SIZE)), 1),
+                self.MAX_PAGE_SIZE,
+            )
+            updated_since = self.parse_updated_since(request.query_params.get("updated_since"))
+            cursor = self.decode_cursor(request.query_params.get("cursor"))
+
             if self.if_user_is_merchant(request):
                 orders = self.get_orders_as_merchant(request)
             else:
-                orders = self.get_orders_as_customer(request)
-            orders = OrderSerializer(orders, many=True)
-            orders = orders.data
+                orders = self.get_orders_as_customer(request, incremental=updated_since is not None)
+
+            if updated_since is not None:
+                position_field = "updated"
+                orders = orders.filter(updated__gt=updated_since - self.SYNC_OVERLAP).order_by("updated", "id")
+            else:
+                position_field = "created"
+                orders = orders.order_by("-created", "-id")
+            if cursor:
+                orders = orders.filter(self.get_cursor_filter(position_field, *cursor))
+
+            # one extra order tells whether there is a next page:
+            orders = self.serialize_orders(orders[:page_size + 1])
+            next_cursor = None
+            if len(orders) > page_size:
+                orders = orders[:page_size]
+                next_cursor = self.encode_cursor(orders[-1][position_field], orders[-1]["id"])
             orders = self.modify_orders_that_had_specials(orders)
+
             return Response(
                 {
                     "success": True,
                     "message": "Orders retrieved successfully",
                     "orders": orders,
+                    "next_cursor": next_cursor,
+                    # the updated_since to pass on the next sync once every page was read:
+                    "last_updated": (
+                        orders[-1]["updated"] if updated_since is not None and orders
+                        else request.query_params.get("updated_since")
+                    ),
                 }
             )
         except Exception as e:
@@ -50,18 +105,69 @@ class GetAllOrdersView(APIView, GlobalViewFunctions):
         orders = Order.objects.filter(
             transaction__branch__merchant__user_account__pk=user_account.pk,
         )
-        if orders:
-            return orders
+        return orders
 
-    def get_orders_as_customer(self, request):
+    def get_orders_as_customer(self, request, incremental=False):
         user_account = request.user.useraccount
+        statuses = [Order.PENDING_DELIVERY, Order.PENDING_PICKUP, Order.DELIVERED]
+        if incremental:
+            # so the apps find out about orders that were cancelled since their last sync:
+            statuses.append(Order.CANCELLED)
         orders = Order.objects.filter(
-            status__in=[Order.PENDING_DELIVERY, Order.PENDING_PICKUP, Order.DELIVERED],
+            status__in=statuses,
             transaction__customer__id=user_account.pk,
             transaction__status="COMPLETED",
-        ).order_by("created")
-        if orders:
-            return orders
+        )
+        return orders
+
+    def parse_updated_since(self, updated_since):
+        if not updated_since:
+            return None
+        parsed = parse_datetime(updated_since)
+        if parsed is None:
+            raise Exception("Invalid updated_since, expected an ISO 8601 datetime.")
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def get_cursor_filter(self, position_field, position, order_id):
+        # everything that comes after the last order of the previous page:
+        if position_field == "updated":
+            return Q(updated__gt=position) | Q(updated=position, id__gt=order_id)
+        return Q(created__lt=position) | Q(created=position, id__lt=order_id)
+
+    def encode_cursor(self, position, order_id):
+        # position is the iso formatted created or updated of the order:
+        cursor = json.dumps([position, order_id])
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            position, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(position), int(order_id)
+        except Exception:
+            raise Exception("Invalid cursor.")
+
+    def serialize_orders(self, orders):
+        # one query for the orders and one for all of their ordered products:
+        orders = OrderProjectionSerializer(orders).data
+        ordered_products = OrderedProductProjectionSerializer(
+            Order.products_ordered.through.objects.filter(
+                order_id__in=[order["id"] for order in orders]
+            ).order_by("id"),
+            prefix="orderedproduct__",
+            extra_fields=["order_id"],
+        )
+
+        products_by_order = {}
+        serialized_products = ordered_products.data
+        for row, ordered_product in zip(ordered_products.rows, serialized_products):
+            products_by_order.setdefault(row["order_id"], []).append(ordered_product)
+        for order in orders:
+            order["products_ordered"] = products_by_order.get(order["id"], [])
+        return orders
 
     def modify_orders_that_had_specials(self, orders):
         for order in orders:
@@ -73,15 +179,89 @@ class GetAllOrdersView(APIView, GlobalViewFunctions):
         return orders
 
     def _adjust_prices_based_on_sale_campaigns(self, sale_campaign, ordered_product):
-        discount = sale_campaign["percentage_off"]
-        discounted_price = float(ordered_product["branch_product"]["branch_price"]) * (
-            1 - discount / 100
-        )
         ordered_product["branch_product"]["branch_price"] = str(
-            f"{discounted_price:.2f}"
+            calculate_sale_price(
+                ordered_product["branch_product"]["branch_price"],
+                sale_campaign["percentage_off"],
+            )
         )
 
 
+class OrderFeedView(GetAllOrdersView):
+
+    """
+    Long polling feed of a merchant's new and changed orders. The request returns as
+    soon as an order after the cursor exists, or waits up to `timeout` seconds
+    (ORDER_FEED["MAX_WAIT_SECONDS"] at most) for one to be placed or change. Pass the
+    cursor of every response on the next request. Without a cursor the feed starts
+    from now, so apps load the order list first and follow the feed from there. When
+    too many requests are waiting already the feed answers 503 with a Retry-After.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, **kwargs):
+        try:
+            if not self.if_user_is_merchant(request):
+                raise Exception("You're not permitted to use this feature")
+            merchant_id = (
+                MerchantBusiness.objects.filter(user_account=request.user.useraccount)
+                .values_list("id", flat=True)
+                .first()
+            )
+            if merchant_id is None:
+                raise Exception("Merchant not found")
+
+            feed_settings = settings.ORDER_FEED
+            timeout = min(
+                max(float(request.query_params.get("timeout", feed_settings["MAX_WAIT_SECONDS"])), 0),
+                feed_settings["MAX_WAIT_SECONDS"],
+            )
+            cursor = request.query_params.get("cursor") or self.encode_cursor(
+                timezone.now().isoformat(), 0
+            )
+            position = self.decode_cursor(cursor)
+
+            # the version is read first so a change made while the orders are read still wakes us up:
+            version = order_feed.get_version(merchant_id)
+            orders = self.get_changed_orders(request, position)
+            deadline = time.monotonic() + timeout
+            while not orders and deadline > time.monotonic():
+                if not order_feed.wait(merchant_id, version, deadline - time.monotonic()):
+                    break
+                # a change this request already has (eg. published again by the poller) means waiting on:
+                version = order_feed.get_version(merchant_id)
+                orders = self.get_changed_orders(request, position)
+
+            if orders:
+                cursor = self.encode_cursor(orders[-1]["updated"], orders[-1]["id"])
+            return Response(
+                {
+                    "success": True,
+                    "message": "Order feed retrieved successfully",
+                    "orders": orders,
+                    "cursor": cursor,
+                }
+            )
+        except OrderFeedBusy as e:
+            return Response(
+                {"success": False, "message": "Failed to get the order feed", "error": str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(settings.ORDER_FEED["BUSY_RETRY_SECONDS"])},
+            )
+        except Exception as e:
+            return Response(
+                {"success": False, "message": "Failed to get the order feed", "error": str(e)}
+            )
+
+    def get_changed_orders(self, request, position):
+        orders = self.get_orders_as_merchant(request).filter(
+            self.get_cursor_filter("updated", *position)
+        ).order_by("updated", "id")
+        orders = self.serialize_orders(orders[:settings.ORDER_FEED["MAX_ORDERS"]])
+        return self.modify_orders_that_had_specials(orders)
+
+
 class CancelOrder(APIView, GlobalViewFunctions):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -185,30 +365,21 @@ class checkForOrderChangesView(APIView, GlobalViewFunctions):
 
     '''
     This endpoint only checks for changes within the orders products such as
-    price changes and availability in terms of stock or if they are still active (still being sold)
+    price changes and availability in terms of stock or if they are still active (still being sold).
+    GET checks a single order, POST {"order_ids": [...]} checks many at once for the reorder screen.
+    Customers can only check their own orders.
     '''
 
-    permission_classes = []
-
-    order = None
-
-    ordered_products = None
+    permission_classes = [permissions.IsAuthenticated]
 
-    order_changes = {
-        "branch": None,
-        "order_id": 0,
-        "price_changes": {},
-        "out_of_stock": {},
-        "no_longer_sold": {},
-        "new_total": {},
-    }
+    MAX_ORDERS = 50
 
-    def return_successful_response(self):
+    def return_successful_response(self, **data):
         return Response(
             {
                 "success": True,
                 "message": "Order changes checked successfully!",
-                "order_changes": self.order_changes,
+                **data,
             }
         )
 
@@ -221,81 +392,34 @@ class checkForOrderChangesView(APIView, GlobalViewFunctions):
             }, status=500
         )
 
-    def get_order(self, order_id):
-        order = Order.objects.prefetch_related(
-            "ordered_products__branch_product__product"
-        ).get(id=order_id)
-        return order
-
-    def check_for_price_changes(self):
-        branch = self.order.transaction.branch
-        sale_campaigns = SaleCampaign.objects.filter(
-            branch=branch, active=True, campaign_ends__gte=datetime.datetime.now()
-        )
-
-        # we need to check if the branch updated their prices recently:
-        branch_products = branch.branchproduct_set.filter(in_stock=True, is_active=True)
-        for product in self.ordered_products.filter(branch_product__is_active=True):
-            for branch_product in branch_products:
-                if product.branch_product == branch_product:
-                    price_on_order = product.order_price
-                    self.order_changes["price_changes"][product.id] = {
-                        "previous_order_price": price_on_order,
-                        "new_order_price": branch_product.branch_price,
-                    }
-                    break
-
-        # now we check for price changes based on if the product is on sale:
-        if sale_campaigns:
-            for product in self.ordered_products.filter(branch_product__is_active=True):
-                for sale_campaign in sale_campaigns:
-                    if sale_campaign.branch_product == product.branch_product:
-                        price_on_order = product.order_price
-                        sale_campaign_price = (
-                            sale_campaign.calculate_sale_campaign_price()
-                        )
-                        if price_on_order != sale_campaign_price:
-                            product_id = product.id
-                            if product_id not in self.order_changes["price_changes"]:
-                                self.order_changes["price_changes"][product_id] = {}
-                            self.order_changes["price_changes"][product_id][
-                                "sale_campaign_price"
-                            ] = sale_campaign_price
-                        break
-
-    def check_for_items_out_of_stock(self):
-        for ordered_product in self.ordered_products:
-            if not ordered_product.branch_product.in_stock:
-                self.order_changes["out_of_stock"][ordered_product.id] = {
-                    "name": ordered_product.branch_product.global_product.name,
-                }
-            if not ordered_product.branch_product.is_active:
-                self.order_changes["no_longer_sold"][ordered_product.id] = {
-                    "name": ordered_product.branch_product.global_product.name,
-                }
-
-    def calculate_the_new_total_price(self):
-        new_order_total = 0.00
-        for order_id, price_changes in self.order_changes["price_changes"].items():
-            new_order_total += (
-                float(price_changes["new_order_price"])
-                if not "sale_campaign_price" in price_changes
-                else float(price_changes["sale_campaign_price"])
-            )
-        self.order_changes["old_total"] = float(self.order.transaction.final_total)
-        self.order_changes["new_total"] = new_order_total
-
     def get(self, request, *args, **kwargs):
         try:
-            self.order_changes['order_id'] = kwargs.get("order_id")
-            self.order = self.get_order(order_id=kwargs.get("order_id"))
-            self.order_changes["branch"] = BranchSerializer(
-                self.order.transaction.branch, many=False
-            ).data
-            self.ordered_products = self.order.products_ordered.all()
-            self.check_for_items_out_of_stock()
-            self.check_for_price_changes()
-            self.calculate_the_new_total_price()
-            return self.return_successful_response()
+            order_id = kwargs.get("order_id")
+            order_changes = get_order_changes([order_id], request.user.id).get(order_id)
+            if order_changes is None:
+                raise Exception("Order not found")
+            return self.return_successful_response(order_changes=order_changes)
+        except Exception as e:
+            return self.return_failed_response(error_message=e.args[0])
+
+    def post(self, request, *args, **kwargs):
+        try:
+            try:
+                order_ids = [int(order_id) for order_id in request.data.get("order_ids") or []]
+            except (TypeError, ValueError):
+                raise Exception("Invalid order ids")
+            if not order_ids:
+                raise Exception("No orders were specified")
+            if len(order_ids) > self.MAX_ORDERS:
+                raise Exception(f"At most {self.MAX_ORDERS} orders can be checked at once")
+
+            order_changes = get_order_changes(order_ids, request.user.id)
+            return self.return_successful_response(
+                order_changes=[
+                    order_changes[order_id]
+                    for order_id in dict.fromkeys(order_ids) if order_id in order_changes
+                ],
+                orders_not_found=[order_id for order_id in order_ids if order_id not in order_changes],
+            )
         except Exception as e:
             return self.return_failed_response(error_message=e.args[0])
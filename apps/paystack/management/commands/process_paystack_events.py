@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.paystack.webhook_inbox import process_pending_events
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Apply the paystack webhook events stored by the webhook. Run it with --forever "
+        "as a long running worker next to the web processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--forever",
+            action="store_true",
+            help="Keep looking for new events instead of stopping once the inbox is empty.",
+        )
+        parser.add_argument("--batch-size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"] or settings.PAYSTACK_WEBHOOKS["BATCH_SIZE"]
+        processed = 0
+        while True:
+            batch = process_pending_events(batch_size)
+            processed += batch
+            # a full batch means there are probably more events waiting. A batch with failed
+            # events comes back short, so they wait for the next round instead of being retried
+            # in a tight loop:
+            if batch == batch_size:
+                continue
+            if not options["forever"]:
+                break
+            time.sleep(settings.PAYSTACK_WEBHOOKS["POLL_SECONDS"])
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} paystack events"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.paystack.reconciliation import reconcile_stale_payments
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Verify the payments no webhook confirmed with paystack and complete or fail their "
+        "transactions and orders. Schedule it every hour or so."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--report",
+            default=None,
+            help="Where to write the csv report, defaults to reconciliation-<timestamp>.csv.",
+        )
+        parser.add_argument("--page-size", type=int, default=None)
+        parser.add_argument("--concurrency", type=int, default=None)
+
+    def handle(self, *args, **options):
+        report_path = options["report"] or f"reconciliation-{timezone.now():%Y%m%d%H%M%S}.csv"
+        with open(report_path, "w", newline="") as report_file:
+            summary = reconcile_stale_payments(
+                report_file,
+                page_size=options["page_size"],
+                concurrency=options["concurrency"],
+            )
+        counts = ", ".join(f"{action}: {count}" for action, count in sorted(summary.items())) or "nothing to do"
+        self.stdout.write(self.style.SUCCESS(f"Reconciled payments ({counts}), report written to {report_path}"))
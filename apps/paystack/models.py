@@ -9,3 +9,25 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"{self.email} - {self.amount} - {'Paid' if self.paid else 'Pending'}"
+
+
+class PaystackEvent(models.Model):
+
+    """
+    Inbox of the webhook events paystack sent us. The webhook only stores the event and
+    answers straight away, the events are applied later in batches by the
+    process_paystack_events command (see apps/paystack/webhook_inbox.py).
+    """
+
+    # paystack delivers the same event again when we answer slowly, the key makes those no-ops:
+    event_key = models.CharField(max_length=191, unique=True)
+    event = models.CharField(max_length=100)
+    reference = models.CharField(max_length=100, db_index=True)
+    payload = models.JSONField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+
+    def __str__(self):
+        return f"{self.event} - {self.reference} - {'Processed' if self.processed else 'Pending'}"
@@ -0,0 +1,150 @@
+"""
+Shared client for the Paystack API.
+
+Every call goes through one requests session per process, so connections to Paystack
+are kept alive and reused instead of paying for a new TLS handshake on every checkout.
+Calls have connect and read timeouts so a stalled Paystack can't hold a worker forever,
+and calls that are safe to repeat (GETs such as verifying a payment) are retried a few
+times with a jittered backoff when the connection fails or Paystack is briefly
+unavailable. Creating calls (initializing a payment) are never retried.
+
+The latency, errors and retries of every endpoint are kept in memory, see get_stats().
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# paystack answers these when it is briefly unavailable:
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# the latency of the last calls of every endpoint:
+LATENCY_SAMPLES = 1000
+
+_client = None
+_client_lock = threading.Lock()
+
+stats = {}
+stats_lock = threading.Lock()
+
+
+class PaystackClient():
+
+    def __init__(self, base_url=None, secret_key=None, client_settings=None):
+        self.settings = {**settings.PAYSTACK_CLIENT, **(client_settings or {})}
+        self.base_url = (base_url or self.settings["BASE_URL"]).rstrip("/")
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {secret_key or settings.PAYSTACK_SECRET_KEY}",
+            "Content-Type": "application/json",
+        })
+        # retries are handled in request() so they can be limited to idempotent calls:
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.settings["POOL_SIZE"], max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def initialize_transaction(self, email, amount, reference):
+        return self.request(
+            "POST",
+            "/transaction/initialize",
+            json={"email": email, "amount": amount, "reference": reference},
+        )
+
+    def verify_transaction(self, reference):
+        return self.request(
+            "GET", f"/transaction/verify/{reference}", endpoint="/transaction/verify"
+        )
+
+    def request(self, method, path, endpoint=None, **kwargs):
+        """
+        Send a request to paystack and return the response. Raises an Exception when
+        paystack couldn't be reached or didn't answer in time.
+        """
+        endpoint = endpoint or path
+        max_retries = self.settings["MAX_RETRIES"] if method.upper() in IDEMPOTENT_METHODS else 0
+        timeout = (self.settings["CONNECT_TIMEOUT_SECONDS"], self.settings["READ_TIMEOUT_SECONDS"])
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                self.wait_before_retry(attempt)
+                _record(endpoint, retried=True)
+
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, f"{self.base_url}{path}", timeout=timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                _record(endpoint, time.perf_counter() - started, failed=True)
+                if attempt == max_retries:
+                    raise Exception(f"Paystack {endpoint} failed: {e}")
+                continue
+
+            failed = response.status_code in RETRY_STATUS_CODES
+            _record(endpoint, time.perf_counter() - started, failed=failed)
+            if not failed or attempt == max_retries:
+                return response
+
+    def wait_before_retry(self, attempt):
+        # exponential backoff with full jitter so retrying workers don't all come back at once:
+        time.sleep(random.uniform(0, self.settings["BACKOFF_SECONDS"] * 2 ** (attempt - 1)))
+
+
+def get_paystack_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PaystackClient()
+    return _client
+
+
+def _record(endpoint, seconds=None, failed=False, retried=False):
+    with stats_lock:
+        endpoint_stats = stats.setdefault(endpoint, {
+            "calls": 0, "failures": 0, "retries": 0, "latencies": deque(maxlen=LATENCY_SAMPLES),
+        })
+        if retried:
+            endpoint_stats["retries"] += 1
+            return
+        endpoint_stats["calls"] += 1
+        endpoint_stats["latencies"].append(seconds)
+        if failed:
+            endpoint_stats["failures"] += 1
+
+
+def get_stats():
+    """
+    Return the calls, failures, retries and p50/p95/max latency (in ms) of every
+    endpoint called by this process.
+    """
+    with stats_lock:
+        current_stats = {
+            endpoint: {**endpoint_stats, "latencies": sorted(endpoint_stats["latencies"])}
+            for endpoint, endpoint_stats in stats.items()
+        }
+
+    def percentile(latencies, fraction):
+        if not latencies:
+            return None
+        return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 2)
+
+    return {
+        endpoint: {
+            "calls": endpoint_stats["calls"],
+            "failures": endpoint_stats["failures"],
+            "retries": endpoint_stats["retries"],
+            "p50_ms": percentile(endpoint_stats["latencies"], 0.5),
+            "p95_ms": percentile(endpoint_stats["latencies"], 0.95),
+            "max_ms": percentile(endpoint_stats["latencies"], 1),
+        }
+        for endpoint, endpoint_stats in current_stats.items()
+    }
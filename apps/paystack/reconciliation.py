@@ -0,0 +1,159 @@
+"""
+Resolves payments that were never confirmed by a webhook.
+
+The reconcile_payments command pages through the unpaid payments that are older than
+PAYSTACK_RECONCILIATION["STALE_AFTER_MINUTES"] (keyset on the payment id), verifies a
+page of references against paystack at a time with PAYSTACK_RECONCILIATION["CONCURRENCY"]
+calls in flight and applies the outcome of the whole page with a few bulk updates:
+
+- successful charges go through the same path as the webhook events, the ones whose
+  transaction was already failed or cancelled are reported as refund_due and the ones
+  for a different amount than the payment as amount_mismatch,
+- failed, abandoned and reversed charges fail the transaction and cancel its order,
+- anything else (still ongoing, not found, paystack unreachable) is left for the next run.
+
+Pending transactions that never got as far as paystack (they have no payment) are
+failed without asking paystack. Every reference ends up as a row in the report.
+"""
+
+import csv
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.orders.models import Order
+from apps.paystack.models import Payment
+from apps.paystack.paystack_client import PaystackClient
+from apps.paystack.webhook_inbox import apply_successful_charges
+from apps.transactions.models import Transaction
+
+logger = logging.getLogger(__name__)
+
+# paystack transaction status -> the status our transaction gets:
+FAILED_STATUSES = {
+    "failed": "FAILED",
+    "abandoned": "CANCELLED",
+    "reversed": "CANCELLED",
+}
+
+REPORT_FIELDS = ["reference", "paystack_status", "action", "error"]
+
+
+def verify_reference(client, reference):
+    """
+    Return (paystack status, amount charged in cents, error) for a reference, the
+    status is None when it couldn't be verified.
+    """
+    try:
+        response = client.verify_transaction(reference)
+    except Exception as e:
+        return None, None, str(e)
+    if response.status_code in (400, 404):
+        return "not_found", None, ""
+    if response.status_code != 200:
+        return None, None, f"paystack answered {response.status_code}"
+    try:
+        data = response.json()["data"]
+        return data["status"], data.get("amount"), ""
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return None, None, f"unexpected response: {e}"
+
+
+def reconcile_references(references, client, executor=None, apply_failures=True):
+    """
+    Verify the references with paystack and apply the outcome in bulk. Returns the
+    report rows of the references. With apply_failures=False only successful charges
+    are applied and failed ones are left pending.
+    """
+    if executor is None:
+        results = [verify_reference(client, reference) for reference in references]
+    else:
+        results = list(executor.map(lambda reference: verify_reference(client, reference), references))
+
+    rows = []
+    successful, failed = {}, {}
+    for reference, (paystack_status, amount, error) in zip(references, results):
+        if paystack_status == "success":
+            successful[reference] = amount
+            action = "completed"
+        elif paystack_status in FAILED_STATUSES and apply_failures:
+            failed.setdefault(FAILED_STATUSES[paystack_status], []).append(reference)
+            action = FAILED_STATUSES[paystack_status].lower()
+        else:
+            action = "left_pending"
+        rows.append({
+            "reference": reference, "paystack_status": paystack_status, "action": action, "error": error,
+        })
+
+    with transaction.atomic():
+        unapplied = apply_successful_charges(successful) if successful else {}
+        for transaction_status, failed_references in failed.items():
+            fail_transactions(Transaction.objects.filter(reference__in=failed_references), transaction_status)
+    # charges that succeeded after their transaction was failed or cancelled are refunded, and
+    # charges for the wrong amount are left pending, instead of being completed:
+    for row in rows:
+        if row["reference"] in unapplied:
+            row["action"] = unapplied[row["reference"]]
+    return rows
+
+
+def fail_transactions(transactions, transaction_status):
+    now = timezone.now()
+    transaction_ids = list(transactions.filter(status="PENDING").values_list("id", flat=True))
+    if not transaction_ids:
+        return
+    Transaction.objects.filter(id__in=transaction_ids).update(status=transaction_status, date_updated=now)
+    Order.objects.filter(transaction_id__in=transaction_ids, status=Order.PAYMENT_PENDING).update(
+        status=Order.CANCELLED, updated=now
+    )
+
+
+def reconcile_stale_payments(report_file, client=None, page_size=None, concurrency=None):
+    """
+    Reconcile every stale payment and write a row per reference to report_file (an
+    open text file). Returns {action: count}.
+    """
+    reconciliation_settings = settings.PAYSTACK_RECONCILIATION
+    page_size = page_size or reconciliation_settings["PAGE_SIZE"]
+    concurrency = concurrency or reconciliation_settings["CONCURRENCY"]
+    client = client or PaystackClient(client_settings={"POOL_SIZE": concurrency})
+    stale_before = timezone.now() - timedelta(minutes=reconciliation_settings["STALE_AFTER_MINUTES"])
+
+    report = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+    report.writeheader()
+    summary = {}
+
+    def write_rows(rows):
+        report.writerows(rows)
+        for row in rows:
+            summary[row["action"]] = summary.get(row["action"], 0) + 1
+
+    # payments whose transaction was already failed or cancelled aren't checked again:
+    stale_payments = Payment.objects.filter(
+        paid=False, created_at__lt=stale_before, transaction__status="PENDING"
+    ).order_by("id")
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="reconciliation") as executor:
+        while True:
+            page = list(stale_payments.filter(id__gt=last_id).values_list("id", "reference")[:page_size])
+            if not page:
+                break
+            last_id = page[-1][0]
+            write_rows(reconcile_references([reference for _, reference in page], client, executor))
+
+    # pending transactions whose payment was never initialized with paystack:
+    uninitialized = Transaction.objects.filter(
+        status="PENDING", payment__isnull=True, created__lt=stale_before
+    )
+    references = list(uninitialized.values_list("reference", flat=True))
+    with transaction.atomic():
+        fail_transactions(uninitialized, "FAILED")
+    write_rows([
+        {"reference": reference, "paystack_status": None, "action": "never_initialized", "error": ""}
+        for reference in references
+    ])
+    return summary
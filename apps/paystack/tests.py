@@ -1,13 +1,33 @@
-from datetime import datetime
+import csv
+import hashlib
+import hmac
+from datetime import datetime, timedelta
 from decimal import ROUND_DOWN, Decimal
+import io
 import json
+import time
+from unittest.mock import patch
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 import requests
+from rest_framework.authtoken.models import Token
 
-from apps.orders.models import Order
-from apps.paystack.models import Payment
+from apps.merchant_wallets.models import MerchantWallet
+from apps.orders.models import CancelledOrder, Order, OrderedProduct
+from apps.products.models import BranchProduct, GlobalProduct
+from apps.paystack import paystack_client, webhook_inbox
+from apps.paystack.models import Payment, PaystackEvent
+from apps.paystack.paystack_client import PaystackClient
+from apps.paystack.reconciliation import reconcile_stale_payments
 from apps.transactions.models import Transaction
-from global_test_config.global_test_config import GlobalTestCaseConfig
+from global_test_config.global_test_config import GlobalTestCaseConfig, benchmark
 
 
 class TestPaystack(GlobalTestCaseConfig):
@@ -68,3 +88,572 @@ class TestPaystack(GlobalTestCaseConfig):
 
     def test_verify_payment_view(self):
         pass
+
+
+class PaystackInitializeResponse:
+    status_code = 200
+
+    def json(self):
+        return {
+            "status": True,
+            "data": {"authorization_url": "https://checkout.paystack.com/test", "reference": "test"},
+        }
+
+
+@patch(
+    "apps.paystack.paystack_client.PaystackClient.initialize_transaction",
+    return_value=PaystackInitializeResponse(),
+)
+class CheckoutTests(GlobalTestCaseConfig):
+
+    def checkout(self, ordered_products, amount):
+        return self.client.post(
+            reverse("initialize_payment"),
+            data={
+                "amount": amount,
+                "ordered_products": ordered_products,
+                "branch": self.branch.id,
+                "is_delivery": True,
+                "delivery_date": "2026-10-20",
+                "address": "34 Blue Lagoon Street Offsprings",
+            },
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Token {self.user_token}",
+        )
+
+    def create_branch_products(self, count):
+        global_products = GlobalProduct.objects.bulk_create([
+            GlobalProduct(name=f"Cat Food-{index}", description="A bag of cat food")
+            for index in range(count)
+        ])
+        return BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=global_product,
+                branch_price=Decimal("10.10"),
+                created_by=self.merchant_user_account,
+            )
+            for global_product in global_products
+        ])
+
+    def test_quantities_are_counted_wherever_the_items_are_in_the_cart(self, *_):
+        # the third dog food is listed twice but not next to itself, the second is on sale:
+        cart = [self.branch_product_3.id, self.branch_product_1.id, self.branch_product_2.id, self.branch_product_3.id]
+        response = self.checkout(cart, "195.00")
+
+        self.assertEqual(response.json()["success"], True, response.json())
+        order = Order.objects.get()
+        quantities = {
+            ordered_product.branch_product_id: (ordered_product.quantity_ordered, str(ordered_product.order_price))
+            for ordered_product in order.products_ordered.all()
+        }
+        self.assertEqual(quantities, {
+            self.branch_product_1.id: (1, "50.00"),
+            self.branch_product_2.id: (1, "25.00"),
+            self.branch_product_3.id: (2, "50.00"),
+        })
+        transaction = Transaction.objects.get()
+        self.assertEqual(transaction.total_minus_service_fee, Decimal("159.90"))
+        self.assertEqual(
+            set(transaction.products_ordered.values_list("id", flat=True)),
+            set(order.products_ordered.values_list("id", flat=True)),
+        )
+
+    def test_paystack_is_sent_the_amount_in_whole_cents(self, mocked_initialize_transaction):
+        # 10.10 * 6 + 20 delivery, which is 8059.999... cents as a float:
+        branch_product = self.create_branch_products(1)[0]
+        response = self.checkout([branch_product.id] * 6, "80.60")
+
+        self.assertEqual(response.json()["success"], True, response.json())
+        amount = mocked_initialize_transaction.call_args.kwargs["amount"]
+        self.assertEqual(amount, 8060)
+        self.assertIsInstance(amount, int)
+        self.assertEqual(Payment.objects.get().amount, Decimal("80.60"))
+
+    def test_totals_that_do_not_balance_are_rejected(self, *_):
+        response = self.checkout([self.branch_product_1.id], "60.00")
+        self.assertEqual(response.json()["success"], False)
+        self.assertIn("Balancing failed", response.json()["message"])
+        self.assertFalse(OrderedProduct.objects.exists())
+
+    def test_products_of_other_branches_are_rejected(self, *_):
+        response = self.checkout([self.branch_product_1.id, 999999], "70.00")
+        self.assertEqual(response.json()["success"], False)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_checkout_queries_do_not_grow_with_the_cart(self, *_):
+        small_cart = [branch_product.id for branch_product in self.create_branch_products(2)]
+        large_cart = [branch_product.id for branch_product in self.create_branch_products(100)]
+
+        with CaptureQueriesContext(connection) as small_cart_queries:
+            response = self.checkout(small_cart, "40.20")
+        self.assertEqual(response.json()["success"], True, response.json())
+
+        # 100 lines of 10.10 (with some items ordered twice) plus delivery:
+        with CaptureQueriesContext(connection) as large_cart_queries:
+            response = self.checkout(large_cart + large_cart[:10], str(Decimal("10.10") * 110 + 20))
+        self.assertEqual(response.json()["success"], True, response.json())
+
+        self.assertEqual(len(large_cart_queries), len(small_cart_queries))
+        self.assertEqual(OrderedProduct.objects.filter(quantity_ordered=2).count(), 10)
+
+
+class PaystackStubHandler(BaseHTTPRequestHandler):
+
+    # keep connections alive like paystack does:
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append(("GET", self.path))
+        status_code, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        self.respond(status_code, {"status": True, "data": {"status": "success"}})
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append(("POST", self.path))
+        self.rfile.read(int(self.headers["Content-Length"]))
+        status_code, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        self.respond(status_code, {"status": True, "data": {"authorization_url": "url", "reference": "ref"}})
+
+    def respond(self, status_code, data):
+        body = json.dumps(data).encode()
+        try:
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class PaystackClientTests(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PaystackStubHandler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        self.server.requests = []
+        # (status code, seconds to wait before answering) of the next responses:
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+        self.client = PaystackClient(
+            base_url=f"http://127.0.0.1:{self.server.server_port}",
+            secret_key="sk_test",
+            client_settings={"READ_TIMEOUT_SECONDS": 0.5, "BACKOFF_SECONDS": 0.01},
+        )
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_kept_alive_and_reused(self):
+        for _ in range(20):
+            self.assertEqual(self.client.verify_transaction("ref").status_code, 200)
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_verification_is_retried_while_paystack_is_unavailable(self):
+        self.server.responses = [(503, 0), (502, 0)]
+        response = self.client.verify_transaction("ref")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, [("GET", "/transaction/verify/ref")] * 3)
+        stats = paystack_client.get_stats()["/transaction/verify"]
+        self.assertGreaterEqual(stats["retries"], 2)
+        self.assertGreaterEqual(stats["failures"], 2)
+
+    def test_initializing_a_payment_is_never_retried(self):
+        self.server.responses = [(503, 0)]
+        response = self.client.initialize_transaction("customer@gmail.com", 19500, "ref")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.requests, [("POST", "/transaction/initialize")])
+
+    def test_stalled_calls_time_out(self):
+        self.server.responses = [(200, 2)]
+        started = time.perf_counter()
+        with self.assertRaises(Exception) as context:
+            self.client.initialize_transaction("customer@gmail.com", 19500, "ref")
+        self.assertLess(time.perf_counter() - started, 1.5)
+        self.assertIn("/transaction/initialize", str(context.exception))
+
+    def test_latency_is_recorded_per_endpoint(self):
+        self.client.verify_transaction("first")
+        self.client.verify_transaction("second")
+
+        stats = paystack_client.get_stats()
+        # verifications of different references are reported together:
+        self.assertGreaterEqual(stats["/transaction/verify"]["calls"], 2)
+        self.assertIsNotNone(stats["/transaction/verify"]["p95_ms"])
+        self.assertNotIn("/transaction/verify/first", stats)
+
+
+class PaystackWebhookTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        self.orders = [self.create_pending_order(f"ref{index}", delivery=index % 2 == 0) for index in range(3)]
+
+    def create_pending_order(self, reference, delivery=True):
+        Payment.objects.create(email="customer@gmail.com", amount=Decimal("70.00"), reference=reference)
+        transaction = Transaction.objects.create(
+            reference=reference,
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=Decimal("70.00"),
+            total_minus_service_fee=Decimal("57.40"),
+        )
+        return Order.objects.create(
+            customer=self.customer_user_account,
+            transaction=transaction,
+            status=Order.PAYMENT_PENDING,
+            delivery=delivery,
+        )
+
+    def send_webhook(self, reference, event="charge.success", amount=7000, secret_key=None):
+        body = json.dumps(
+            {"event": event, "data": {"reference": reference, "status": "success", "amount": amount}}
+        ).encode()
+        signature = hmac.new(
+            (secret_key or settings.PAYSTACK_SECRET_KEY).encode(), body, hashlib.sha512
+        ).hexdigest()
+        return self.client.post(
+            reverse("paystack_webhook"),
+            body,
+            content_type="application/json",
+            HTTP_X_PAYSTACK_SIGNATURE=signature,
+        )
+
+    def process_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("process_paystack_events", stdout=io.StringIO())
+
+    def test_webhooks_only_store_the_event(self):
+        with self.assertNumQueries(1):
+            response = self.send_webhook("ref0")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PaystackEvent.objects.get().reference, "ref0")
+        self.assertFalse(Payment.objects.get(reference="ref0").paid)
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.PAYMENT_PENDING)
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_events_are_applied_in_batches(self, mocked_firebase_app):
+        for order in self.orders:
+            self.send_webhook(order.transaction.reference)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.process_events()
+
+        self.assertLessEqual(len(queries), 20)
+        self.assertTrue(all(payment.paid for payment in Payment.objects.all()))
+        self.assertEqual(set(Transaction.objects.values_list("status", flat=True)), {"COMPLETED"})
+        self.assertEqual(
+            [Order.objects.get(id=order.id).status for order in self.orders],
+            [Order.PENDING_DELIVERY, Order.PENDING_PICKUP, Order.PENDING_DELIVERY],
+        )
+        self.assertFalse(PaystackEvent.objects.filter(processed__isnull=True).exists())
+        self.assertEqual(mocked_firebase_app.send_push_notification.call_count, 3)
+        # the merchant is paid for all three with one ledger posting:
+        self.assertEqual(MerchantWallet.objects.get(merchant_business=self.branch.merchant).entry_count, 3)
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_duplicate_deliveries_are_no_ops(self, mocked_firebase_app):
+        self.send_webhook("ref0")
+        self.process_events()
+
+        # paystack retries, and the order moves on in the meantime:
+        Order.objects.filter(id=self.orders[0].id).update(status=Order.DELIVERED)
+        self.send_webhook("ref0")
+        self.process_events()
+
+        self.assertEqual(PaystackEvent.objects.count(), 1)
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.DELIVERED)
+        self.assertEqual(mocked_firebase_app.send_push_notification.call_count, 1)
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_payments_after_a_failure_are_reported_for_a_refund(self, mocked_firebase_app):
+        # the reconciliation job failed the payment before paystack's success arrived:
+        Transaction.objects.filter(reference="ref0").update(status="CANCELLED")
+        Order.objects.filter(id=self.orders[0].id).update(status=Order.CANCELLED)
+        self.send_webhook("ref0")
+        self.process_events()
+
+        self.assertEqual(Transaction.objects.get(reference="ref0").status, "REFUND_DUE")
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.CANCELLED)
+        cancellation = CancelledOrder.objects.get(order_id=self.orders[0].id)
+        self.assertFalse(cancellation.refunded)
+        self.assertEqual(cancellation.refund_amount, Decimal("70.00"))
+        mocked_firebase_app.send_push_notification.assert_not_called()
+        self.assertFalse(MerchantWallet.objects.filter(merchant_business=self.branch.merchant).exists())
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_a_failing_event_does_not_hold_up_the_others(self, mocked_firebase_app):
+        self.send_webhook("ref0")
+        self.send_webhook("ref1")
+        original_apply = webhook_inbox.apply_successful_charges
+
+        def apply_successful_charges(references):
+            if "ref1" in references:
+                raise Exception("boom")
+            return original_apply(references)
+
+        with patch("apps.paystack.webhook_inbox.apply_successful_charges", side_effect=apply_successful_charges):
+            self.process_events()
+
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.PENDING_DELIVERY)
+        failed_event = PaystackEvent.objects.get(reference="ref1")
+        self.assertIsNone(failed_event.processed)
+        self.assertEqual(failed_event.attempts, 1)
+        self.assertEqual(failed_event.error, "boom")
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_failing_events_are_not_retried_back_to_back(self, mocked_firebase_app):
+        self.send_webhook("ref0")
+        self.send_webhook("ref1")
+
+        with patch("apps.paystack.webhook_inbox.apply_successful_charges", side_effect=Exception("boom")):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("process_paystack_events", "--batch-size", "1", stdout=io.StringIO())
+
+        # the worker stops at the failed batch instead of taking the same event again:
+        self.assertEqual(
+            dict(PaystackEvent.objects.values_list("reference", "attempts")), {"ref0": 1, "ref1": 0}
+        )
+
+        # and the events that haven't failed go first next time:
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(webhook_inbox.process_pending_events(batch_size=1), 1)
+        self.assertIsNotNone(PaystackEvent.objects.get(reference="ref1").processed)
+        self.assertIsNone(PaystackEvent.objects.get(reference="ref0").processed)
+
+    def test_events_not_signed_by_paystack_are_rejected(self):
+        response = self.send_webhook("ref0", secret_key="sk_test_forged")
+
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(PaystackEvent.objects.exists())
+
+    @patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP")
+    def test_charges_for_the_wrong_amount_are_not_applied(self, mocked_firebase_app):
+        self.send_webhook("ref0", amount=100)
+        self.send_webhook("ref1")
+        self.process_events()
+
+        self.assertFalse(Payment.objects.get(reference="ref0").paid)
+        self.assertEqual(Order.objects.get(id=self.orders[0].id).status, Order.PAYMENT_PENDING)
+        event = PaystackEvent.objects.get(reference="ref0")
+        self.assertIsNone(event.processed)
+        self.assertEqual(event.error, "The amount charged doesn't match the payment")
+        # applying it again won't change the amount, so it isn't retried:
+        self.assertEqual(event.attempts, settings.PAYSTACK_WEBHOOKS["MAX_ATTEMPTS"])
+        # the other event of the batch is applied:
+        self.assertEqual(Order.objects.get(id=self.orders[1].id).status, Order.PENDING_PICKUP)
+
+    def test_unknown_events_are_rejected(self):
+        self.assertEqual(self.send_webhook("ref0", event="transfer.failed").status_code, 400)
+        self.assertFalse(PaystackEvent.objects.exists())
+
+
+class PaystackVerifyStubHandler(BaseHTTPRequestHandler):
+
+    """
+    Answers verify calls with the status the reference starts with, eg. "failed-12".
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't let them wait for each other's ack:
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        reference = self.path.rsplit("/", 1)[-1]
+        paystack_status = reference.split("-")[0]
+        if paystack_status == "missing":
+            status_code, data = 404, {"status": False, "message": "Transaction reference not found"}
+        else:
+            # every payment of the tests is for 70.00:
+            status_code, data = 200, {"status": True, "data": {"status": paystack_status, "amount": 7000}}
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PaymentReconciliationTests(GlobalTestCaseConfig):
+
+    """
+    Run the benchmark with RUN_BENCHMARKS=1, and set PAYMENTS to 100_000 to run the
+    reconciliation at production scale.
+    """
+
+    PAYMENTS = 5_000
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PaystackVerifyStubHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.paystack = PaystackClient(
+            base_url=f"http://127.0.0.1:{self.server.server_port}",
+            secret_key="sk_test",
+            client_settings={"POOL_SIZE": 16},
+        )
+
+    def tearDown(self):
+        self.paystack.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_pending_orders(self, references, minutes_ago=180):
+        payments = Payment.objects.bulk_create([
+            Payment(email="customer@gmail.com", amount=Decimal("70.00"), reference=reference)
+            for reference in references
+        ])
+        transactions = Transaction.objects.bulk_create([
+            Transaction(
+                reference=payment.reference,
+                customer=self.customer_user_account,
+                branch=self.branch,
+                total_with_service_fee=Decimal("70.00"),
+                total_minus_service_fee=Decimal("57.40"),
+                payment=payment,
+            )
+            for payment in payments
+        ])
+        Order.objects.bulk_create([
+            Order(customer=self.customer_user_account, transaction=transaction, status=Order.PAYMENT_PENDING)
+            for transaction in transactions
+        ])
+        created = timezone.now() - timedelta(minutes=minutes_ago)
+        Payment.objects.filter(reference__in=references).update(created_at=created)
+        Transaction.objects.filter(reference__in=references).update(created=created)
+
+    def reconcile(self, **kwargs):
+        report = io.StringIO()
+        with patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP"):
+            summary = reconcile_stale_payments(report, client=self.paystack, **kwargs)
+        return summary, list(csv.DictReader(io.StringIO(report.getvalue())))
+
+    def get_order_status(self, reference):
+        return Order.objects.get(transaction__reference=reference).status
+
+    def test_stale_payments_are_completed_or_failed(self):
+        self.create_pending_orders(["success-1", "failed-1", "abandoned-1", "ongoing-1", "missing-1"])
+        self.create_pending_orders(["success-2"], minutes_ago=5)
+
+        summary, report = self.reconcile()
+
+        self.assertEqual(summary, {"completed": 1, "failed": 1, "cancelled": 1, "left_pending": 2})
+        self.assertEqual(len(report), 5)
+        self.assertTrue(Payment.objects.get(reference="success-1").paid)
+        self.assertEqual(Transaction.objects.get(reference="success-1").status, "COMPLETED")
+        self.assertEqual(self.get_order_status("success-1"), Order.PENDING_DELIVERY)
+        self.assertEqual(Transaction.objects.get(reference="failed-1").status, "FAILED")
+        self.assertEqual(self.get_order_status("failed-1"), Order.CANCELLED)
+        self.assertEqual(Transaction.objects.get(reference="abandoned-1").status, "CANCELLED")
+        self.assertEqual(self.get_order_status("ongoing-1"), Order.PAYMENT_PENDING)
+        self.assertEqual(self.get_order_status("missing-1"), Order.PAYMENT_PENDING)
+        # customers could still be paying for recent ones:
+        self.assertEqual(self.get_order_status("success-2"), Order.PAYMENT_PENDING)
+
+        # resolved payments aren't checked again:
+        summary, report = self.reconcile()
+        self.assertEqual(summary, {"left_pending": 2})
+
+    def test_transactions_that_never_reached_paystack_are_failed(self):
+        transaction = Transaction.objects.create(
+            reference="uninitialized",
+            customer=self.customer_user_account,
+            branch=self.branch,
+            total_with_service_fee=Decimal("70.00"),
+            total_minus_service_fee=Decimal("57.40"),
+        )
+        Transaction.objects.filter(id=transaction.id).update(created=timezone.now() - timedelta(days=1))
+
+        summary, _ = self.reconcile()
+
+        self.assertEqual(summary, {"never_initialized": 1})
+        self.assertEqual(Transaction.objects.get(id=transaction.id).status, "FAILED")
+
+    def test_verifying_a_payment_completes_its_order(self):
+        self.create_pending_orders(["success-1"], minutes_ago=0)
+        with patch("apps.paystack.views.get_paystack_client", return_value=self.paystack), \
+                patch("apps.paystack.webhook_inbox.settings.FIREBASE_APP"):
+            response = self.client.get(
+                reverse("verify_payment", kwargs={"reference": "success-1"}),
+                HTTP_AUTHORIZATION=f"Token {self.user_token}",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_order_status("success-1"), Order.PENDING_DELIVERY)
+
+    def test_verifying_an_open_checkout_leaves_its_order_pending(self):
+        # paystack reports checkouts the customer hasn't finished yet as abandoned:
+        self.create_pending_orders(["abandoned-1"], minutes_ago=0)
+        with patch("apps.paystack.views.get_paystack_client", return_value=self.paystack):
+            response = self.client.get(
+                reverse("verify_payment", kwargs={"reference": "abandoned-1"}),
+                HTTP_AUTHORIZATION=f"Token {self.user_token}",
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Transaction.objects.get(reference="abandoned-1").status, "PENDING")
+        self.assertEqual(self.get_order_status("abandoned-1"), Order.PAYMENT_PENDING)
+
+    def test_only_the_customer_can_verify_their_payments(self):
+        self.create_pending_orders(["success-1"], minutes_ago=0)
+        merchant_token, _ = Token.objects.get_or_create(user=self.merchant_user_account.user)
+        with patch("apps.paystack.views.get_paystack_client", return_value=self.paystack) as mocked_client:
+            response = self.client.get(
+                reverse("verify_payment", kwargs={"reference": "success-1"}),
+                HTTP_AUTHORIZATION=f"Token {merchant_token.key}",
+            )
+        self.assertEqual(response.status_code, 404)
+        mocked_client.assert_not_called()
+        self.assertEqual(self.get_order_status("success-1"), Order.PAYMENT_PENDING)
+
+    def test_reconciliation_queries_do_not_grow_with_the_payments(self):
+        statuses = ["success", "failed", "abandoned"]
+        # the wallet the payments are credited to already exists on both runs:
+        MerchantWallet.objects.create(merchant_business=self.branch.merchant)
+        self.create_pending_orders([f"{statuses[index % 3]}-{index}" for index in range(6)])
+        with CaptureQueriesContext(connection) as small_page_queries:
+            self.reconcile(page_size=6)
+
+        self.create_pending_orders([f"{statuses[index % 3]}-{index}" for index in range(6, 36)])
+        with CaptureQueriesContext(connection) as large_page_queries:
+            summary, _ = self.reconcile(page_size=30)
+
+        self.assertEqual(summary, {"completed": 10, "failed": 10, "cancelled": 10})
+        self.assertEqual(len(large_page_queries), len(small_page_queries))
+
+    @benchmark
+    def test_reconciliation_at_scale(self):
+        statuses = ["success", "failed", "abandoned", "ongoing"]
+        self.create_pending_orders([
+            f"{statuses[index % len(statuses)]}-{index}" for index in range(self.PAYMENTS)
+        ])
+
+        with CaptureQueriesContext(connection) as queries:
+            summary, report = self.reconcile(page_size=1000, concurrency=16)
+
+        self.assertEqual(len(report), self.PAYMENTS)
+        self.assertEqual(summary["completed"], self.PAYMENTS // 4)
+        # the queries grow with the pages, not the payments:
+        self.assertLess(len(queries), self.PAYMENTS // 25)
+        self.assertEqual(
+            Order.objects.filter(status=Order.PAYMENT_PENDING).count(), self.PAYMENTS // 4
+        )
@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import InitializePaymentView, VerifyPaymentView, PaystackWebhookView
+from .views import InitializePaymentView, VerifyPaymentView, PaystackWebhookView, PaystackStatsView
 
 urlpatterns = [
     path("initialize/", InitializePaymentView.as_view(), name="initialize_payment"),
     path("verify/<str:reference>/", VerifyPaymentView.as_view(), name="verify_payment"),
     path("webhook/", PaystackWebhookView.as_view(), name="paystack_webhook"),
+    path("stats/", PaystackStatsView.as_view(), name="paystack_stats"),
 ]
@@ -1,17 +1,22 @@
-import datetime
 import uuid
-import requests
-from django.conf import settings
+from collections import Counter
+from decimal import Decimal, ROUND_HALF_UP
+
 from django.db import transaction as trans
+from rest_framework.permissions import IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from apps.merchants.models import Branch, SaleCampaign
+from apps.merchants.models import Branch
 from apps.orders.models import Order, OrderedProduct
 from apps.products.models import BranchProduct
+from apps.products.pricing import CENTS, read_effective_prices, to_decimal
 from apps.transactions.models import Transaction
 from .models import Payment
+from .paystack_client import get_paystack_client, get_stats
+from .reconciliation import reconcile_references
+from .webhook_inbox import record_event, verify_signature
 
 
 class InitializePaymentView(APIView):
@@ -39,24 +44,29 @@ class InitializePaymentView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-    def create_a_transaction(self, request, branch, order_amount, products_ordered):
+    def create_a_transaction(self, request, branch, order_amount, products_ordered, reference=None):
         try:
+            order_amount = to_decimal(order_amount)
             transaction = Transaction()
             # Generate a unique transaction reference
-            transaction.reference = str(uuid.uuid4()).replace("-", "")[:10]
+            transaction.reference = reference or self.generate_reference()
             transaction.customer = request.user.useraccount
             transaction.branch = branch
             transaction.total_with_service_fee = order_amount
-            transaction.total_minus_service_fee = round(order_amount * 0.82, 2)
+            transaction.total_minus_service_fee = (order_amount * Decimal("0.82")).quantize(
+                CENTS, rounding=ROUND_HALF_UP
+            )
             transaction.save()
             transaction.products_ordered.set(products_ordered)
-            transaction.save()
 
             return transaction
         except Exception as e:
             raise Exception(f"Failed to create a transaction: {e}")
 
-    def create_a_order(self, request, transaction: Transaction):
+    def generate_reference(self):
+        return str(uuid.uuid4()).replace("-", "")[:10]
+
+    def create_a_order(self, request, transaction: Transaction, products_ordered=None):
         try:
             # get the merchant this order belongs to:
             merchant_business = transaction.branch.merchant
@@ -72,138 +82,117 @@ class InitializePaymentView(APIView):
                 order.delivery_date = request.data["delivery_date"]
                 order.delivery_address = request.data["address"]
                 order.save()
-                order.products_ordered.set(transaction.products_ordered.all())
-                order.save()
+                order.products_ordered.set(
+                    products_ordered if products_ordered is not None
+                    else transaction.products_ordered.all()
+                )
 
             return order
         except Exception as e:
             raise Exception(f"Failed to create an order: {e}")
 
     def create_ordered_products(
-        self, is_delivery, ordered_product_ids, branch, order_amount
+        self, is_delivery, ordered_product_ids, branch, order_amount, reference=None, customer=None
     ):
+        """
+        Create an ordered product for every distinct product in the cart, with a fixed
+        number of queries however long the cart is. Every id in ordered_product_ids is
+        one item, so an id listed three times is ordered three times.
+        """
+        reference = reference or self.generate_reference()
         with trans.atomic():
-            products_ordered = []
-            previously_processed_order_id = 0
-            for id in ordered_product_ids:
-                # we dont want to process a product that has already been processed:
-                if id == previously_processed_order_id:
-                    continue
-                else:
-                    previously_processed_order_id = id
-                try:
-                    # get the product:
-                    branch_product = BranchProduct.objects.get(id=id, branch=branch)
-
-                    # create the ordered product:
-                    ordered_product = OrderedProduct()
-                    ordered_product.branch_product = branch_product
-
-                    # find the sale campaign if there is one:
-                    sale_campaign = SaleCampaign.objects.filter(
-                        branch_product=branch_product,
-                        branch=branch,
-                        active=True,
-                        campaign_ends__gte=datetime.datetime.now(),
-                    )
-                    if sale_campaign.count() > 0:
-                        # set the sale_campaign:
-                        sale_campaign = sale_campaign[0]
-                        ordered_product.sale_campaign = sale_campaign
-
-                        # set the order price / we must take the sale campaign into account:
-                        sale_campaign_price = sale_campaign.calculate_sale_campaign_price()
-                        # the final price they are buying the product for after sale campaign discount is applied:
-                        ordered_product.order_price = sale_campaign_price
-                    else:
-                        # the original price of the product:
-                        ordered_product.order_price = branch_product.branch_price
-
-                    # set how many items of this product was ordered:
-                    ordered_product.quantity_ordered = ordered_product_ids.count(id)
-
-                    # save the ordered product:
-                    ordered_product.save()
-
-                    # store it in the list:
-                    products_ordered.append(ordered_product)
-
-                except Exception as e:
-                    raise Exception(f"Failed to create ordered product: {e}")
+            # how many of each product were ordered:
+            quantities = Counter(int(id) for id in ordered_product_ids)
+
+            # get the products of this branch with the prices the customer pays for them, sales included:
+            effective_prices = {
+                product["id"]: product
+                for product in read_effective_prices(
+                    BranchProduct.objects.filter(id__in=quantities, branch=branch), []
+                )
+            }
+            missing_ids = [id for id in quantities if id not in effective_prices]
+            if missing_ids:
+                raise Exception(
+                    f"Failed to create ordered product: products {missing_ids} are not sold by this branch"
+                )
+
+            products_ordered = OrderedProduct.objects.bulk_create([
+                OrderedProduct(
+                    branch_product_id=id,
+                    sale_campaign_id=effective_prices[id]["sale_campaign_id"],
+                    order_price=effective_prices[id]["effective_price"],
+                    quantity_ordered=quantity,
+                    ordered_by=customer,
+                    transaction_reference=reference,
+                )
+                for id, quantity in quantities.items()
+            ])
+            if products_ordered and products_ordered[0].pk is None:
+                # mysql doesn't return the ids of bulk created rows:
+                products_ordered = list(
+                    OrderedProduct.objects.filter(transaction_reference=reference).order_by("id")
+                )
 
             # balance the amount:
             # fail this if the amount calculated does not match the order amount:
-            self.balance_the_total_amount(is_delivery, products_ordered, order_amount)
+            self.balance_the_total_amount(is_delivery, products_ordered, order_amount, branch)
 
         return products_ordered
 
-    def balance_the_total_amount(self, is_delivery, products_ordered, order_amount):
+    def balance_the_total_amount(self, is_delivery, products_ordered, order_amount, branch=None):
         """
         We need to ensure that the calculations done here match the calculations
         done on the mobile app. Stop the payment process if this fails
         """
-        try:
-            # get the total amount for the whole order minus the delivery fee:
-            total_amount_minus_delivery_fee = 0.00
-            total_amount_plus_delivery_fee = 0.00
-            for product in products_ordered:
-                # if the product has more than one of itself ordered then calculate the total amount:
-                if product.quantity_ordered > 1:
-                    total_amount_of_all = float(
-                        product.order_price * product.quantity_ordered
-                    )
-                    total_amount_minus_delivery_fee += total_amount_of_all
-                else:
-                    total_amount_minus_delivery_fee += float(product.order_price)
-            # get the delivery fee:
-            delivery_fee = 0.00
-            if is_delivery:
-                delivery_fee = float(
-                    product.branch_product.branch.merchant.delivery_fee
-                )
-                # add the delivery fee to the total amount:
-                total_amount_plus_delivery_fee = (
-                    total_amount_minus_delivery_fee + delivery_fee
-                )
-                # verify that the amounts match (delivery):
-                balancing_error_text = "Balancing failed: Total amount calculated does not match the order amount"
-                assert (
-                    total_amount_plus_delivery_fee == order_amount
-                ), balancing_error_text
-            else:
-                # verify that the amounts match (pickup):
-                balancing_error_text = "Balancing failed: Total amount calculated does not match the order amount"
-                assert (
-                    total_amount_minus_delivery_fee == order_amount
-                ), balancing_error_text
-
-        except Exception as e:
-            raise e
+        # get the total amount for the whole order minus the delivery fee:
+        total_amount = sum(
+            (to_decimal(product.order_price) * product.quantity_ordered for product in products_ordered),
+            Decimal(0),
+        )
+        if is_delivery:
+            # add the delivery fee to the total amount:
+            if branch is None:
+                branch = products_ordered[0].branch_product.branch
+            total_amount += to_decimal(branch.merchant.delivery_fee)
+
+        # verify that the amounts match:
+        balancing_error_text = "Balancing failed: Total amount calculated does not match the order amount"
+        assert (
+            total_amount.quantize(CENTS, rounding=ROUND_HALF_UP)
+            == to_decimal(order_amount).quantize(CENTS, rounding=ROUND_HALF_UP)
+        ), balancing_error_text
 
     def process_the_order(self, request):
         try:
             # find the branch this order belongs to:
             # the branch must be active:
-            branch = Branch.objects.get(id=request.data["branch"])
+            branch = Branch.objects.select_related("merchant").get(id=request.data["branch"])
             assert branch.is_active, f"{branch.address} - This branch is not active."
 
             # get the order amount for accounting:
-            order_amount = float(request.data["amount"])
+            order_amount = to_decimal(request.data["amount"])
 
             # create the ordered products:
+            reference = self.generate_reference()
             is_delivery = request.data["is_delivery"]
             ordered_product_ids = request.data["ordered_products"]
             products_ordered = self.create_ordered_products(
-                is_delivery, ordered_product_ids, branch, order_amount
+                is_delivery,
+                ordered_product_ids,
+                branch,
+                order_amount,
+                reference=reference,
+                customer=request.user.useraccount,
             )
 
             # create the transaction:
             transaction = self.create_a_transaction(
-                request, branch, order_amount, products_ordered
+                request, branch, order_amount, products_ordered, reference=reference
             )
 
             # now we create an order:
-            self.create_a_order(request, transaction)
+            self.create_a_order(request, transaction, products_ordered)
 
             return transaction
         except Exception as e:
@@ -213,24 +202,13 @@ class InitializePaymentView(APIView):
 
         # prepare the payload we send to paystack to initialize the payment:
         email = request.user.email
-        amount = float(request.data.get("amount"))  # Paystack expects amount in cents
-
-        # set the authentication paystack requires:
-        headers = {
-            "Authorization": f"Bearer {settings.PAYSTACK_SECRET_KEY}",
-            "Content-Type": "application/json",
-        }
-
-        # set the payload:
-        data = {
-            "email": email,
-            "amount": amount * 100,  # Convert to kobo (or cents)
-            "reference": transaction.reference,
-        }
+        amount = to_decimal(request.data.get("amount")).quantize(CENTS, rounding=ROUND_HALF_UP)
 
         # send the payload to paystack to initialize the payment process:
-        response = requests.post(
-            "https://api.paystack.co/transaction/initialize", json=data, headers=headers
+        response = get_paystack_client().initialize_transaction(
+            email=email,
+            amount=int((amount * 100).quantize(Decimal(1))),  # Paystack expects amount in cents
+            reference=transaction.reference,
         )
 
         if response.status_code == 200:
@@ -264,26 +242,16 @@ class InitializePaymentView(APIView):
 
 class VerifyPaymentView(APIView):
     def get(self, request, reference):
-        url = f"https://api.paystack.co/transaction/verify/{reference}"
-        headers = {"Authorization": f"Bearer {settings.PAYSTACK_SECRET_KEY}"}
-
-        response = requests.get(url, headers=headers)
-        response_data = response.json()
-
-        if response_data.get("status") and response_data["data"]["status"] == "success":
-            # Update payment record
-            payment = Payment.objects.filter(reference=reference).first()
-            if payment:
-                payment.paid = True
-                payment.save()
+        # customers can only verify the payments of their own orders:
+        if not Transaction.objects.filter(reference=reference, customer=request.user.useraccount).exists():
+            return Response({"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
 
-                # update the transaction status:
-
-                # create the order:
-
-                # send order emails:
-                pass
+        # a successful payment completes its transaction and order the same way the
+        # reconcile_payments job does. failures are left to that job, which only looks at
+        # stale payments, because paystack reports checkouts that are still open as abandoned:
+        report = reconcile_references([reference], get_paystack_client(), apply_failures=False)[0]
 
+        if report["action"] == "completed":
             return Response(
                 {"message": "Payment verified successfully"}, status=status.HTTP_200_OK
             )
@@ -299,43 +267,39 @@ class PaystackWebhookView(APIView):
 
     def post(self, request):
 
+        # only events signed by paystack are accepted, they move payments on and credit wallets:
+        if not verify_signature(request.body, request.headers.get("x-paystack-signature")):
+            return Response({"error": "Invalid signature"}, status=status.HTTP_401_UNAUTHORIZED)
+
         # the post request data from paystack:
         payload = request.data
 
         # if the payment was successful:
         if payload.get("event") == "charge.success":
-            # get the payment:
-            reference = payload["data"]["reference"]
-            payment = Payment.objects.filter(reference=reference).first()
-
-            if payment:
-                # update the payment status:
-                payment.paid = True
-                payment.save()
-
-                # update the transaction status:
-                transaction = Transaction.objects.filter(reference=reference).first()
-                transaction.status = "COMPLETED"
-                transaction.save()
-
-                # update the order status:
-                order = Order.objects.filter(transaction=transaction).first()
-                if order.delivery:
-                    order.status = "PENDING_DELIVERY"
-                else:
-                    order.status = "PENDING_PICKUP"
-                order.save()
-
-                # send a notification to the customer:
-                settings.FIREBASE_APP.send_push_notification(
-                    order.customer.device_token,
-                    f"Order from {order.transaction.branch.merchant.name} placed successfully!",
-                    "You will be notified once the store has acknowledged your order!",
-                    {"test": "data sent via notification"}
-                )
+            # store the event and answer paystack straight away, the payment, transaction and
+            # order are updated by the process_paystack_events worker (see webhook_inbox.py):
+            try:
+                record_event(payload)
+            except Exception as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
             return Response(
-                {"message": "Payment updated successfully"}, status=status.HTTP_200_OK
+                {"message": "Event received successfully"}, status=status.HTTP_200_OK
             )
 
         return Response({"error": "Invalid event"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class PaystackStatsView(APIView):
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(
+            {
+                "success": True,
+                "message": "Paystack stats retrieved successfully.",
+                "stats": get_stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
@@ -0,0 +1,240 @@
+"""
+Inbox for paystack webhook events.
+
+The webhook checks the event was signed by paystack, only records it (one insert that
+is ignored if the event was already delivered) and answers paystack straight away. The process_paystack_events
+command then applies the events in batches with process_pending_events():
+
+- payments, transactions and orders are read and updated with a handful of set based
+  queries per batch instead of a few per event, and the merchant wallets are credited
+  with one ledger posting per merchant,
+- only orders still waiting for payment are moved on, so an event that is applied twice
+  (or a payment that was already applied some other way) changes nothing and doesn't
+  notify the customer again,
+- payments that succeed after their transaction was failed or cancelled (eg. by the
+  reconcile_payments job) don't reopen anything or credit the merchant, they are
+  reported for a refund instead (see report_late_payments),
+- charges for a different amount than the payment we initialized aren't applied, their
+  events are left with an error for someone to look at and never retried,
+- events that fail are retried on later rounds, after the events that haven't failed,
+- workers lock the events they take with skip locked, so more than one can run.
+"""
+
+import hashlib
+import hmac
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.merchant_wallets.ledger import credit_completed_transactions
+from apps.orders.models import CancelledOrder, Order
+from apps.orders.order_feed import order_feed
+from apps.paystack.models import Payment, PaystackEvent
+from apps.transactions.models import Transaction
+
+logger = logging.getLogger(__name__)
+
+CHARGE_SUCCESS = "charge.success"
+
+# why apply_successful_charges didn't complete a payment:
+REFUND_DUE = "refund_due"
+AMOUNT_MISMATCH = "amount_mismatch"
+
+
+def verify_signature(body, signature):
+    """
+    Check the x-paystack-signature header of a webhook, the HMAC SHA512 of the raw request
+    body signed with our secret key.
+    """
+    expected_signature = hmac.new(
+        settings.PAYSTACK_SECRET_KEY.encode(), body, hashlib.sha512
+    ).hexdigest()
+    return hmac.compare_digest(expected_signature, signature or "")
+
+
+def record_event(payload):
+    """
+    Store a webhook event in the inbox, events that were already stored are ignored.
+    """
+    event = payload.get("event")
+    reference = (payload.get("data") or {}).get("reference")
+    if not event or not reference:
+        raise Exception("The event has no type or reference")
+    PaystackEvent.objects.bulk_create(
+        [
+            PaystackEvent(
+                event_key=f"{event}:{reference}",
+                event=event,
+                reference=reference,
+                payload=payload,
+            )
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def process_pending_events(batch_size=None):
+    """
+    Apply the next batch of stored events, the ones that failed the fewest times first.
+    When the batch fails as a whole its events are applied one at a time, so one bad
+    event doesn't hold up the rest. Returns how many events were taken, not counting the
+    ones that failed and will be retried, so a worker only takes the next batch straight
+    away when this one went through.
+    """
+    webhook_settings = settings.PAYSTACK_WEBHOOKS
+    batch_size = batch_size or webhook_settings["BATCH_SIZE"]
+    failed = 0
+    with transaction.atomic():
+        events = list(
+            PaystackEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed__isnull=True, attempts__lt=webhook_settings["MAX_ATTEMPTS"])
+            .order_by("attempts", "id")[:batch_size]
+        )
+        if not events:
+            return 0
+
+        try:
+            with transaction.atomic():
+                apply_events(events)
+        except Exception as e:
+            logger.warning(f"Failed to process a batch of paystack events, retrying them one by one: {e}")
+            for event in events:
+                try:
+                    with transaction.atomic():
+                        apply_events([event])
+                except Exception as e:
+                    logger.exception(f"Failed to process paystack event {event.event_key}")
+                    PaystackEvent.objects.filter(id=event.id).update(
+                        attempts=F("attempts") + 1, error=str(e)
+                    )
+                    failed += 1
+    return len(events) - failed
+
+
+def apply_events(events):
+    charge_events = [event for event in events if event.event == CHARGE_SUCCESS]
+    unapplied = apply_successful_charges({
+        event.reference: (event.payload.get("data") or {}).get("amount") for event in charge_events
+    })
+    mismatched_ids = [
+        event.id for event in charge_events if unapplied.get(event.reference) == AMOUNT_MISMATCH
+    ]
+    # applying them again won't change the amount, so they are never retried:
+    PaystackEvent.objects.filter(id__in=mismatched_ids).update(
+        attempts=settings.PAYSTACK_WEBHOOKS["MAX_ATTEMPTS"], error="The amount charged doesn't match the payment"
+    )
+    # other event types are only kept for reference:
+    PaystackEvent.objects.filter(id__in=[event.id for event in events]).exclude(id__in=mismatched_ids).update(
+        processed=timezone.now(), attempts=F("attempts") + 1, error=""
+    )
+
+
+def apply_successful_charges(charges):
+    """
+    Apply the successful charges ({reference: amount charged in cents}). Returns
+    {reference: REFUND_DUE or AMOUNT_MISMATCH} for the charges that didn't complete
+    their payment.
+    """
+    unapplied = {}
+    # only payments we initialized, for the amount we initialized them with, are applied:
+    paid_references = set()
+    payments = Payment.objects.filter(reference__in=list(charges)).values_list("reference", "amount")
+    for reference, amount in payments:
+        if charges[reference] != amount * 100:
+            logger.error(
+                f"Paystack charged {charges[reference]} cents for payment {reference} of {amount}, "
+                "it wasn't applied"
+            )
+            unapplied[reference] = AMOUNT_MISMATCH
+        else:
+            paid_references.add(reference)
+    if not paid_references:
+        return unapplied
+
+    now = timezone.now()
+    Payment.objects.filter(reference__in=paid_references, paid=False).update(paid=True)
+    transactions = list(
+        Transaction.objects.filter(reference__in=paid_references)
+        .exclude(status__in=["COMPLETED", "REFUND_DUE"])
+        .values_list("id", "status", "reference")
+    )
+    completed_ids = [transaction_id for transaction_id, status, _ in transactions if status == "PENDING"]
+    Transaction.objects.filter(id__in=completed_ids, status="PENDING").update(
+        status="COMPLETED", date_updated=now
+    )
+    # the merchants are paid into their wallets once, when their transactions complete:
+    credit_completed_transactions(completed_ids)
+    late_payments = {
+        transaction_id: reference for transaction_id, status, reference in transactions if status != "PENDING"
+    }
+    if late_payments:
+        report_late_payments(late_payments, now)
+
+    orders = list(
+        Order.objects.filter(
+            transaction__reference__in=paid_references, status=Order.PAYMENT_PENDING
+        ).values(
+            "id",
+            "delivery",
+            "customer__device_token",
+            "transaction__branch__merchant_id",
+            "transaction__branch__merchant__name",
+        )
+    )
+    for delivery, status in [(True, Order.PENDING_DELIVERY), (False, Order.PENDING_PICKUP)]:
+        order_ids = [order["id"] for order in orders if bool(order["delivery"]) == delivery]
+        if order_ids:
+            Order.objects.filter(id__in=order_ids, status=Order.PAYMENT_PENDING).update(
+                status=status, updated=now
+            )
+
+    # the updates skip the order signals, so let the merchants and customers know here. feed
+    # requests waiting in the web processes find the paid orders when they next poll:
+    for merchant_id in {order["transaction__branch__merchant_id"] for order in orders}:
+        transaction.on_commit(lambda merchant_id=merchant_id: order_feed.publish(merchant_id))
+    transaction.on_commit(lambda: notify_customers(orders))
+    unapplied.update({reference: REFUND_DUE for reference in late_payments.values()})
+    return unapplied
+
+
+def report_late_payments(late_payments, now):
+    """
+    Mark the transactions ({id: reference}) that were paid after they were failed or
+    cancelled as REFUND_DUE and record an unrefunded cancellation with the amount paid
+    for each of their orders, so the customers can be refunded from the admin.
+    """
+    Transaction.objects.filter(id__in=late_payments).update(status="REFUND_DUE", date_updated=now)
+    orders = Order.objects.filter(transaction_id__in=late_payments).values_list(
+        "id", "transaction_id", "transaction__total_with_service_fee"
+    )
+    CancelledOrder.objects.bulk_create([
+        CancelledOrder(
+            order_id=order_id,
+            reason="PAYMENT_FAILED",
+            additional_notes=(
+                f"Payment {late_payments[transaction_id]} succeeded after it was failed or cancelled, "
+                "refund the customer."
+            ),
+            refund_amount=amount_paid,
+            refunded=False,
+        )
+        for order_id, transaction_id, amount_paid in orders
+    ])
+    for reference in late_payments.values():
+        logger.warning(f"Payment {reference} succeeded after it was failed or cancelled, a refund is due")
+
+
+def notify_customers(orders):
+    for order in orders:
+        try:
+            settings.FIREBASE_APP.send_push_notification(
+                order["customer__device_token"],
+                f"Order from {order['transaction__branch__merchant__name']} placed successfully!",
+                "You will be notified once the store has acknowledged your order!",
+                {"test": "data sent via notification"}
+            )
+        except Exception as e:
+            logger.warning(f"Failed to notify the customer of order {order['id']}: {e}")
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PriceComparisonConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.price_comparison'
+
+    def ready(self):
+        import apps.price_comparison.signals
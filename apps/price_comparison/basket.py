@@ -0,0 +1,238 @@
+"""
+The cheapest way to buy a whole shopping list.
+
+The prices of every listed product at every candidate branch are loaded with one query
+into a matrix of line totals in cents, one row per branch and one column per product.
+Rows and columns are combined with map/sum over whole rows instead of looping product
+by product.
+
+The cheapest single store is the branch carrying everything whose row total plus
+delivery fee is the lowest. The cheapest split (each product bought wherever it is
+cheapest, paying one delivery fee per branch used) is found with a local search: start
+from the branches that are cheapest for at least one product, then keep dropping the
+branch that brings the total down the most, or adding one once nothing can be dropped,
+until neither helps. The search is run again from the cheapest single store and the
+cheaper of the two results is used.
+"""
+
+import heapq
+from decimal import Decimal
+
+from apps.merchants.branch_locator import find_branches_in_radius, parse_coordinates
+from apps.merchants.models import Branch
+from apps.products.models import BranchProduct
+from apps.products.pricing import read_effective_prices, to_decimal
+
+# line total of a product a branch doesn't stock:
+UNAVAILABLE = 10 ** 15
+
+
+def to_cents(amount):
+    return int(to_decimal(amount) * 100)
+
+
+def from_cents(cents):
+    return str((Decimal(cents) / 100).quantize(Decimal("0.01")))
+
+
+def get_candidate_branches(store_ids=None, coordinates=None, radius_km=None):
+    """
+    Return the active branches to compare, optionally only those of the given merchants
+    and/or within radius_km of the customer.
+    """
+    branches = Branch.objects.filter(is_active=True, merchant__is_active=True)
+    if store_ids:
+        branches = branches.filter(merchant_id__in=store_ids)
+    if coordinates:
+        latitude, longitude = parse_coordinates(coordinates)
+        branches = branches.filter(id__in=[
+            branch["id"] for branch in find_branches_in_radius(latitude, longitude, radius_km)
+        ])
+    return list(
+        branches.order_by("id").values(
+            "id", "address", "merchant_id", "merchant__name", "merchant__delivery_fee"
+        )
+    )
+
+
+def get_branch_prices(global_product_ids, branch_ids):
+    """
+    Return {(branch id, global product id): price} with the cheapest in stock branch
+    product of each global product at each branch, using a single query.
+    """
+    rows = read_effective_prices(
+        BranchProduct.objects.filter(
+            global_product_id__in=global_product_ids,
+            branch_id__in=branch_ids,
+            in_stock=True,
+            is_active=True,
+        ),
+        ["branch_id", "global_product_id"],
+    )
+
+    prices = {}
+    for row in rows:
+        key = (row["branch_id"], row["global_product_id"])
+        if key not in prices or row["effective_price"] < prices[key]["unit_price"]:
+            prices[key] = {
+                "branch_product_id": row["id"],
+                "sale_campaign_id": row["sale_campaign_id"],
+                "unit_price": row["effective_price"],
+            }
+    return prices
+
+
+class BasketOptimizer():
+
+    def __init__(self, quantities, branches, prices):
+        # quantities is {global product id: quantity}:
+        self.branches = branches
+        self.prices = prices
+        self.quantities = quantities
+        self.delivery_fees = [to_cents(branch["merchant__delivery_fee"]) for branch in branches]
+
+        # products that no candidate branch stocks are left out of the matrix:
+        stocked_ids = {global_product_id for _, global_product_id in prices}
+        self.product_ids = [product_id for product_id in quantities if product_id in stocked_ids]
+        self.unavailable_product_ids = [
+            product_id for product_id in quantities if product_id not in stocked_ids
+        ]
+
+        self.line_totals = []
+        for branch in branches:
+            row = []
+            for product_id in self.product_ids:
+                price = prices.get((branch["id"], product_id))
+                row.append(
+                    to_cents(price["unit_price"]) * quantities[product_id] if price else UNAVAILABLE
+                )
+            self.line_totals.append(row)
+
+    def get_total(self, branch_indexes):
+        # cents to buy every product at the cheapest of the branches, None if they don't stock everything:
+        rows = [self.line_totals[index] for index in branch_indexes]
+        line_totals = list(map(min, *rows)) if len(rows) > 1 else rows[0]
+        if max(line_totals, default=0) >= UNAVAILABLE:
+            return None
+        return sum(line_totals) + sum(self.delivery_fees[index] for index in branch_indexes)
+
+    def get_cheapest_single_store_index(self):
+        best_index, best_total = None, None
+        for index, row in enumerate(self.line_totals):
+            if max(row, default=0) >= UNAVAILABLE:
+                continue
+            total = sum(row) + self.delivery_fees[index]
+            if best_total is None or total < best_total:
+                best_index, best_total = index, total
+        return best_index
+
+    def cheapest_single_store(self):
+        best_index = self.get_cheapest_single_store_index()
+        return None if best_index is None else self.describe([best_index])
+
+    def cheapest_split(self):
+        if not self.product_ids:
+            return None
+
+        # start with the cheapest branch for each product, and with the cheapest single store
+        # because the local search can get stuck above it (a single store is a valid split):
+        starts = [{min(range(len(column)), key=column.__getitem__) for column in zip(*self.line_totals)}]
+        single_store_index = self.get_cheapest_single_store_index()
+        if single_store_index is not None:
+            starts.append({single_store_index})
+
+        best_selected, best_total = None, None
+        for selected in starts:
+            selected, total = self.improve(selected)
+            if best_total is None or total < best_total:
+                best_selected, best_total = selected, total
+        return self.describe(sorted(best_selected))
+
+    def improve(self, selected):
+        total = self.get_total(selected)
+        # dropping is cheap to evaluate so branches are only added once nothing can be dropped:
+        while True:
+            move = self.get_best_drop(selected, total) or self.get_best_add(selected, total)
+            if move is None:
+                return selected, total
+            selected, total = move
+
+    def get_best_drop(self, selected, total):
+        if len(selected) < 2:
+            return None
+        indexes = list(selected)
+        rows = [self.line_totals[index] for index in indexes]
+
+        # dropping a branch saves its delivery fee but its products cost the second cheapest price:
+        savings = {index: self.delivery_fees[index] for index in indexes}
+        for column in zip(*rows):
+            cheapest, second_cheapest = heapq.nsmallest(2, range(len(column)), key=column.__getitem__)
+            savings[indexes[cheapest]] -= column[second_cheapest] - column[cheapest]
+
+        best_index = max(savings, key=savings.get)
+        if savings[best_index] <= 0:
+            return None
+        return selected - {best_index}, total - savings[best_index]
+
+    def get_best_add(self, selected, total):
+        rows = [self.line_totals[index] for index in selected]
+        current_line_totals = list(map(min, *rows)) if len(rows) > 1 else rows[0]
+        current_fees = total - sum(current_line_totals)
+
+        best_index, best_total = None, total
+        for index, row in enumerate(self.line_totals):
+            if index in selected:
+                continue
+            candidate_total = (
+                sum(map(min, current_line_totals, row)) + current_fees + self.delivery_fees[index]
+            )
+            if candidate_total < best_total:
+                best_index, best_total = index, candidate_total
+        if best_index is None:
+            return None
+        return selected | {best_index}, best_total
+
+    def describe(self, branch_indexes):
+        stores = {
+            index: {
+                "branch": {
+                    "id": self.branches[index]["id"],
+                    "address": self.branches[index]["address"],
+                    "merchant": {
+                        "id": self.branches[index]["merchant_id"],
+                        "name": self.branches[index]["merchant__name"],
+                    },
+                },
+                "items": [],
+                "products_total": 0,
+                "delivery_fee": self.delivery_fees[index],
+            }
+            for index in branch_indexes
+        }
+        for column, product_id in enumerate(self.product_ids):
+            index = min(branch_indexes, key=lambda index: self.line_totals[index][column])
+            price = self.prices[(self.branches[index]["id"], product_id)]
+            line_total = self.line_totals[index][column]
+            stores[index]["items"].append({
+                "global_product_id": product_id,
+                "branch_product_id": price["branch_product_id"],
+                "sale_campaign_id": price["sale_campaign_id"],
+                "quantity": self.quantities[product_id],
+                "unit_price": str(price["unit_price"]),
+                "line_total": from_cents(line_total),
+            })
+            stores[index]["products_total"] += line_total
+
+        # branches that ended up with nothing to buy aren't part of the split:
+        stores = [store for store in stores.values() if store["items"]]
+        products_total = sum(store["products_total"] for store in stores)
+        delivery_fees = sum(store["delivery_fee"] for store in stores)
+        for store in stores:
+            store["products_total"] = from_cents(store["products_total"])
+            store["delivery_fee"] = from_cents(store["delivery_fee"])
+        return {
+            "stores": stores,
+            "products_total": from_cents(products_total),
+            "delivery_fees": from_cents(delivery_fees),
+            "total": from_cents(products_total + delivery_fees),
+        }
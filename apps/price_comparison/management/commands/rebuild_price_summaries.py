@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.price_comparison.price_summaries import rebuild_price_summaries
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Rebuild the lowest price summary of every product. Run it nightly just after "
+        "midnight so sale campaigns that ended are no longer included."
+    )
+
+    def handle(self, *args, **options):
+        refreshed = rebuild_price_summaries()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {refreshed} price summaries"))
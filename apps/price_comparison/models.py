@@ -1,4 +1,26 @@
 from django.db import models
 
-# Create your models here.
+from apps.products.models import GlobalProduct
 
+
+class ProductPriceSummary(models.Model):
+
+    """
+    Read model with the effective (sale adjusted) prices a global product is offered at
+    across all active branches. Kept up to date by apps/price_comparison/signals.py and
+    rebuilt nightly with the rebuild_price_summaries command.
+    """
+
+    global_product = models.OneToOneField(
+        GlobalProduct, on_delete=models.CASCADE, primary_key=True, related_name="price_summary"
+    )
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, db_index=True)
+    median_price = models.DecimalField(max_digits=10, decimal_places=2)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2)
+    offer_count = models.PositiveIntegerField(default=0)
+    # the branches offering the product at min_price:
+    cheapest_branch_ids = models.JSONField(default=list)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.global_product_id} - from {self.min_price}"
@@ -0,0 +1,114 @@
+"""
+Keeps the ProductPriceSummary read model up to date.
+
+refresh_price_summaries() recalculates the summaries of a few global products. The
+BranchProduct and SaleCampaign signals in apps/price_comparison/signals.py schedule it
+with schedule_price_summary_refresh(), which refreshes every product saved in a
+transaction once that transaction commits. Sale campaigns end at midnight and branches
+can be deactivated without any of those signals firing, so the rebuild_price_summaries
+management command rebuilds every summary with rebuild_price_summaries() once a night.
+"""
+
+import statistics
+import threading
+from decimal import ROUND_HALF_UP
+
+from django.db import connection, transaction
+
+from apps.price_comparison.models import ProductPriceSummary
+from apps.products.models import BranchProduct, GlobalProduct
+from apps.products.pricing import CENTS, read_effective_prices
+
+REBUILD_BATCH_SIZE = 1000
+
+SUMMARY_FIELDS = ["min_price", "median_price", "max_price", "offer_count", "cheapest_branch_ids", "updated"]
+
+# the products saved in the current transaction of each thread, see schedule_price_summary_refresh():
+pending_refreshes = threading.local()
+
+
+def build_price_summaries(global_product_ids):
+    offers = read_effective_prices(
+        BranchProduct.objects.filter(
+            global_product_id__in=global_product_ids,
+            in_stock=True,
+            is_active=True,
+            branch__is_active=True,
+            branch__merchant__is_active=True,
+        ),
+        ["global_product_id", "branch_id"],
+    )
+
+    offers_by_product = {}
+    for offer in offers:
+        offers_by_product.setdefault(offer["global_product_id"], []).append(offer)
+
+    summaries = []
+    for global_product_id, product_offers in offers_by_product.items():
+        prices = sorted(offer["effective_price"] for offer in product_offers)
+        summaries.append(ProductPriceSummary(
+            global_product_id=global_product_id,
+            min_price=prices[0],
+            median_price=statistics.median(prices).quantize(CENTS, rounding=ROUND_HALF_UP),
+            max_price=prices[-1],
+            offer_count=len(prices),
+            cheapest_branch_ids=sorted({
+                offer["branch_id"] for offer in product_offers if offer["effective_price"] == prices[0]
+            }),
+        ))
+    return summaries
+
+
+def refresh_price_summaries(global_product_ids):
+    """
+    Recalculate the summaries of the given global products from their current offers,
+    products that aren't offered anywhere anymore lose their summary.
+    """
+    global_product_ids = set(global_product_ids) - {None}
+    if not global_product_ids:
+        return 0
+
+    summaries = build_price_summaries(global_product_ids)
+    # upserted so concurrent refreshes of a product without a summary don't collide,
+    # MySQL upserts on any unique key and doesn't take the fields to conflict on:
+    unique_fields = ["global_product"] if connection.features.supports_update_conflicts_with_target else None
+    with transaction.atomic():
+        ProductPriceSummary.objects.bulk_create(
+            summaries, update_conflicts=True, unique_fields=unique_fields, update_fields=SUMMARY_FIELDS
+        )
+        ProductPriceSummary.objects.filter(global_product_id__in=global_product_ids).exclude(
+            global_product_id__in=[summary.global_product_id for summary in summaries]
+        ).delete()
+    return len(summaries)
+
+
+def schedule_price_summary_refresh(global_product_ids):
+    """
+    Refresh the summaries of the given global products once the current transaction
+    commits, so a bulk price import refreshes every product once instead of once per
+    saved offer. Outside a transaction they are refreshed straight away.
+    """
+    if getattr(pending_refreshes, "global_product_ids", None) is None:
+        pending_refreshes.global_product_ids = set()
+    pending_refreshes.global_product_ids.update(set(global_product_ids) - {None})
+    # registered on every call since the callbacks of a rolled back transaction are dropped,
+    # the first one to run refreshes everything that is pending:
+    transaction.on_commit(refresh_pending_price_summaries, robust=True)
+
+
+def refresh_pending_price_summaries():
+    global_product_ids = getattr(pending_refreshes, "global_product_ids", None)
+    pending_refreshes.global_product_ids = None
+    if global_product_ids:
+        refresh_price_summaries(global_product_ids)
+
+
+def rebuild_price_summaries():
+    """
+    Recalculate every summary, a batch of global products at a time.
+    """
+    refreshed = 0
+    global_product_ids = list(GlobalProduct.objects.order_by("id").values_list("id", flat=True))
+    for start in range(0, len(global_product_ids), REBUILD_BATCH_SIZE):
+        refreshed += refresh_price_summaries(global_product_ids[start:start + REBUILD_BATCH_SIZE])
+    return refreshed
@@ -0,0 +1,66 @@
+"""
+Cache of product search result pages.
+
+Entries are keyed by the normalized query, the sorted store ids, the page and a version
+of the catalogs of the branches the search covers. That version changes whenever a
+product or sale campaign of one of those branches is saved or deleted (see
+apps/products/signals.py), so an entry is never served after the branches it was built
+from changed while searches over other stores keep their entries. The date is part of
+the key as well because sale campaigns end at midnight without anything being saved.
+"""
+
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+
+from apps.merchants.models import Branch
+from apps.products.catalog import make_catalog_etag
+from apps.products.search_index import tokenize
+
+# hit and miss counters for this process:
+stats = {"hits": 0, "misses": 0}
+stats_lock = threading.Lock()
+
+
+def get_search_cache_key(query, store_ids, page_size, cursor):
+    branches = Branch.objects.all()
+    if store_ids:
+        branches = branches.filter(merchant_id__in=store_ids)
+    # versions only ever go up so their sum changes whenever one of the catalogs does:
+    catalogs = branches.aggregate(versions=Sum("catalog_version"), count=Count("id"), last_id=Max("id"))
+
+    key = make_catalog_etag(
+        " ".join(tokenize(query)),
+        ",".join(sorted(set(store_ids))),
+        page_size,
+        cursor or "",
+        catalogs["versions"] or 0,
+        catalogs["count"],
+        catalogs["last_id"],
+    )
+    return f"product_search:{key.strip(chr(34))}"
+
+
+def get_cached_page(key):
+    page = cache.get(key)
+    with stats_lock:
+        stats["hits" if page is not None else "misses"] += 1
+    return page
+
+
+def cache_page(key, page):
+    cache.set(key, page, settings.PRODUCT_SEARCH_CACHE["TTL_SECONDS"])
+
+
+def get_search_cache_stats():
+    with stats_lock:
+        hits = stats["hits"]
+        misses = stats["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+    }
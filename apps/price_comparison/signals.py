@@ -0,0 +1,51 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from apps.merchants.models import SaleCampaign
+from apps.price_comparison.price_summaries import schedule_price_summary_refresh
+from apps.products.models import BranchProduct
+
+
+@receiver(post_init, sender=BranchProduct)
+def branch_product_loaded_handler(sender, instance: BranchProduct, **kwargs):
+    """
+    Remember the product of the offer so moving it to another product refreshes both.
+    """
+    # read from __dict__ so instances loaded with only() don't query for it:
+    instance._saved_global_product_id = instance.__dict__.get("global_product_id")
+
+
+@receiver(post_save, sender=BranchProduct)
+@receiver(post_delete, sender=BranchProduct)
+def branch_product_changed_handler(sender, instance: BranchProduct, **kwargs):
+    """
+    Recalculate the price summary of the product when one of its offers changes, and of
+    the product the offer belonged to before if it was moved.
+    """
+    global_product_ids = {instance.global_product_id, getattr(instance, "_saved_global_product_id", None)}
+    schedule_price_summary_refresh(global_product_ids)
+    instance._saved_global_product_id = instance.global_product_id
+
+
+@receiver(post_init, sender=SaleCampaign)
+def sale_campaign_loaded_handler(sender, instance: SaleCampaign, **kwargs):
+    """
+    Remember the offer the sale campaign reprices so moving it to another offer refreshes both.
+    """
+    instance._saved_branch_product_id = instance.__dict__.get("branch_product_id")
+
+
+@receiver(post_save, sender=SaleCampaign)
+@receiver(post_delete, sender=SaleCampaign)
+def sale_campaign_changed_handler(sender, instance: SaleCampaign, **kwargs):
+    """
+    Recalculate the price summary of the product a sale campaign reprices, and of the
+    product it repriced before if it was moved to another offer.
+    """
+    branch_product_ids = {instance.branch_product_id, getattr(instance, "_saved_branch_product_id", None)}
+    branch_product_ids -= {None}
+    if branch_product_ids:
+        schedule_price_summary_refresh(
+            BranchProduct.objects.filter(id__in=branch_product_ids).values_list("global_product_id", flat=True)
+        )
+    instance._saved_branch_product_id = instance.branch_product_id
@@ -1,16 +1,36 @@
-from django.db import connection
+from django.db import DatabaseError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 import pytest
 from rest_framework.test import APIClient
 from rest_framework import status
 from datetime import datetime, timedelta
 from django.apps import apps
 
-from apps.products.models import BranchProduct, GlobalProduct
-from apps.merchants.models import SaleCampaign
+import io
+import json
+import logging
+import time
 
+from apps.price_comparison import price_summaries, search_cache
+from apps.price_comparison.models import ProductPriceSummary
+from apps.price_comparison.views import ProductSearchView
+from apps.products.autocomplete import product_autocomplete, suggest_products
+from apps.products.models import BranchProduct, GlobalProduct
+from apps.products.search_index import product_search_index, search_products
+from apps.accounts.models import UserAccount
+from apps.merchants.models import Branch, MerchantBusiness, SaleCampaign
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.urls import reverse
-from global_test_config.global_test_config import GlobalTestCaseConfig
+from django.utils import timezone
+from unittest.mock import patch
+from global_test_config.global_test_config import GlobalTestCaseConfig, benchmark
+
+logger = logging.getLogger(__name__)
 
 
 @pytest.fixture(autouse=True)
@@ -40,6 +60,15 @@ def reset_auto_increment_ids():
         cursor.execute("SET FOREIGN_KEY_CHECKS=1;")
 
 
+def create_brand_products(count=200):
+    # products named after pet food brands, eg. "Royal Canin Formula14 14kg":
+    brands = ["Royal Canin", "Pedigree", "Hills Science", "Whiskas", "Acana", "Orijen", "Eukanuba"]
+    GlobalProduct.objects.bulk_create([
+        GlobalProduct(name=f"{brands[index % len(brands)]} Formula{index} {index % 25}kg", description="")
+        for index in range(count)
+    ])
+
+
 class ProductSearchViewTests(GlobalTestCaseConfig, TestCase):
 
     def setUp(self):
@@ -389,3 +418,930 @@ class ProductSearchViewTests(GlobalTestCaseConfig, TestCase):
             regular_price,
             "Regular priced product (50.00) should appear first"
         )
+
+
+class ProductSearchTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        product_search_index.build()
+        cache.clear()
+
+    def search(self, query, **params):
+        response = self.client.get(
+            reverse('search_products', kwargs={'query': query, 'store_ids': str(self.branch.merchant.id)}),
+            params,
+        )
+        return json.loads(response.content)
+
+    def test_search_results_are_ordered_by_their_sale_price(self):
+        response = self.search("Dog Food")
+
+        products = response['products']
+        self.assertEqual(len(products), 3)
+        self.assertEqual(products[0]['id'], self.branch_product_2.id)
+        self.assertEqual(products[0]['branch_price'], "50.00")
+        self.assertEqual(products[0]['campaign']['final_price'], 25.0)
+        self.assertIsNone(products[1]['campaign'])
+        self.assertEqual(products[1]['branch']['merchant']['name'], "Orsum Pets")
+        self.assertNotIn('user_account', products[1]['branch']['merchant'])
+        self.assertEqual(response['metadata']['count'], 3)
+        self.assertIsNone(response['metadata']['next_cursor'])
+
+    def test_results_are_paged_with_a_cursor(self):
+        # products at the same price as the discounted one so the cursor has to break ties on id:
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=self.branch_product_1.global_product,
+                branch_price=25 if index % 2 else 60,
+                created_by=self.merchant_user_account,
+            )
+            for index in range(200)
+        ])
+
+        pages = []
+        cursor = None
+        while True:
+            # every page is the same two queries no matter how many results there are:
+            with self.assertNumQueries(2):
+                response = self.search("Dog Food", page_size=50, **({"cursor": cursor} if cursor else {}))
+            pages.append(response['products'])
+            cursor = response['metadata']['next_cursor']
+            if cursor is None:
+                break
+
+        products = [product for page in pages for product in page]
+        self.assertEqual([len(page) for page in pages], [50, 50, 50, 50, 3])
+        self.assertEqual(len(set(product['id'] for product in products)), 203)
+        final_prices = [
+            product['campaign']['final_price'] if product['campaign'] else float(product['branch_price'])
+            for product in products
+        ]
+        self.assertEqual(final_prices, sorted(final_prices))
+
+    def test_invalid_cursors_are_rejected(self):
+        response = self.search("Dog Food", cursor="not-a-cursor")
+
+        self.assertEqual(response['success'], False)
+        self.assertEqual(response['error'], "Invalid cursor.")
+
+    def test_more_relevant_products_come_first(self):
+        cat_food = GlobalProduct.objects.create(
+            name="Cat Food", description="Not for dogs, try our dog food instead"
+        )
+        BranchProduct.objects.create(
+            branch=self.branch,
+            global_product=cat_food,
+            branch_price=10,
+            created_by=self.merchant_user_account,
+        )
+
+        response = self.search("dog food")
+
+        products = response['products']
+        self.assertEqual(len(products), 4)
+        # the cheap cat food only mentions dog food in its description:
+        self.assertEqual(products[-1]['global_product']['name'], "Cat Food")
+        self.assertGreater(products[0]['relevance'], products[-1]['relevance'])
+
+    def test_misspelt_searches_still_find_products(self):
+        response = self.search("Dog Fod")
+
+        self.assertEqual(response['success'], True)
+        products = response['products']
+        self.assertEqual(len(products), 3)
+        self.assertEqual(products[0]['campaign']['final_price'], 25.0)
+
+    def test_generic_queries_order_by_a_bounded_relevance_expression(self):
+        # names of every length so almost every product has a different score:
+        GlobalProduct.objects.bulk_create([
+            GlobalProduct(name="Dog Food" + " Extra" * (index % 40) + f" {index}", description="")
+            for index in range(300)
+        ])
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=global_product,
+                branch_price=10,
+                created_by=self.merchant_user_account,
+            )
+            for global_product in GlobalProduct.objects.filter(name__startswith="Dog Food Extra")
+        ])
+        product_search_index.build()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search("dog food", page_size=100)
+
+        self.assertEqual(response['metadata']['count'], 100)
+        search_sql = queries.captured_queries[-1]['sql']
+        self.assertLessEqual(search_sql.count(" WHEN "), ProductSearchView.RELEVANCE_LEVELS)
+        relevances = [product['relevance'] for product in response['products']]
+        self.assertEqual(relevances, sorted(relevances, reverse=True))
+
+    def test_products_past_the_first_candidates_can_be_paged_to(self):
+        GlobalProduct.objects.bulk_create([
+            GlobalProduct(name=f"Dog Food Extra {index}", description="") for index in range(7)
+        ])
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=global_product,
+                branch_price=10,
+                created_by=self.merchant_user_account,
+            )
+            for global_product in GlobalProduct.objects.filter(name__startswith="Dog Food Extra")
+        ])
+        product_search_index.build()
+
+        products = []
+        cursor = None
+        with patch.object(ProductSearchView, "MAX_CANDIDATES", 3):
+            while True:
+                response = self.search("dog food", page_size=4, **({"cursor": cursor} if cursor else {}))
+                products.extend(response['products'])
+                cursor = response['metadata']['next_cursor']
+                if cursor is None:
+                    break
+
+        self.assertEqual(len(products), 10)
+        self.assertEqual(len(set(product['id'] for product in products)), 10)
+        relevances = [product['relevance'] for product in products]
+        self.assertEqual(relevances, sorted(relevances, reverse=True))
+
+    def test_failures_while_serializing_a_page_are_reported(self):
+        with patch("apps.price_comparison.views.calculate_sale_price", side_effect=ValueError("Bad price")):
+            response = self.search("Dog Food")
+
+        self.assertEqual(response['success'], False)
+        self.assertEqual(response['error'], "Bad price")
+
+    def test_search_with_no_matches(self):
+        response = self.search("hamster")
+
+        self.assertEqual(response['success'], False)
+        self.assertEqual(response['error'], "No product matching this criteria was found.")
+
+
+class SearchCacheTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        product_search_index.build()
+        cache.clear()
+        search_cache.stats.update({"hits": 0, "misses": 0})
+
+    def search(self, query, store_ids=None):
+        response = self.client.get(reverse('search_products', kwargs={
+            'query': query, 'store_ids': store_ids or str(self.branch.merchant.id)
+        }))
+        return json.loads(response.content)
+
+    def test_normalized_queries_share_entries(self):
+        first_response = self.search("Dog Food")
+        with self.assertNumQueries(1):
+            second_response = self.search("  dog   FOOD ")
+
+        self.assertEqual(second_response['products'], first_response['products'])
+        self.assertEqual(second_response['metadata']['query'], "dog   FOOD")
+        self.assertEqual(search_cache.get_search_cache_stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_entries_are_invalidated_by_changes_to_the_branches_they_cover(self):
+        self.search("Dog Food")
+
+        self.branch_product_1.branch_price = 10
+        self.branch_product_1.save()
+        response = self.search("Dog Food")
+
+        self.assertEqual(response['products'][0]['id'], self.branch_product_1.id)
+        self.assertEqual(search_cache.stats["hits"], 0)
+
+        SaleCampaign.objects.filter(branch_product=self.branch_product_2).delete()
+        response = self.search("Dog Food")
+        self.assertIsNone(response['products'][-1]['campaign'])
+        self.assertEqual(search_cache.stats["hits"], 0)
+
+    def test_changes_to_other_stores_keep_the_entries(self):
+        other_user_account = UserAccount.objects.create(
+            user=User.objects.create(username="otherpets", email="otherpets@gmail.com"),
+            phone_number="0622222222",
+            is_merchant=True,
+            device_token="otherpetsdevicetoken",
+        )
+        other_merchant = MerchantBusiness.objects.create(
+            user_account=other_user_account,
+            name="Other Pets",
+            email="otherpets@gmail.com",
+            address="1 Other Street",
+        )
+        other_branch = Branch.objects.create(is_active=True, address="1 Other Street", merchant=other_merchant)
+
+        self.search("Dog Food")
+        BranchProduct.objects.create(
+            branch=other_branch,
+            global_product=self.branch_product_1.global_product,
+            branch_price=5,
+            created_by=self.merchant_user_account,
+        )
+        response = self.search("Dog Food")
+
+        self.assertEqual(len(response['products']), 3)
+        self.assertEqual(search_cache.stats["hits"], 1)
+
+    def test_entries_expire_with_the_sale_campaigns_at_midnight(self):
+        self.search("Dog Food")
+
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with patch("django.utils.timezone.localdate", return_value=tomorrow):
+            self.search("Dog Food")
+
+        self.assertEqual(search_cache.stats["hits"], 0)
+
+    def test_stats_are_only_shown_to_admins(self):
+        response = self.client.get(reverse('search_cache_stats'))
+        self.assertIn(response.status_code, [401, 403])
+
+        self.customer_user_account.user.is_staff = True
+        self.customer_user_account.user.save()
+        self.search("Dog Food")
+        response = self.client.get(
+            reverse('search_cache_stats'), HTTP_AUTHORIZATION=f"Token {self.user_token}"
+        )
+        self.assertEqual(response.data['stats'], {"hits": 0, "misses": 1, "hit_rate": 0.0})
+
+
+class CheapestBasketTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+
+        # a second store with cheaper delivery that doesn't stock the second dog food:
+        other_user_account = UserAccount.objects.create(
+            user=User.objects.create(username="otherpets", email="otherpets@gmail.com"),
+            phone_number="0622222222",
+            is_merchant=True,
+            device_token="otherpetsdevicetoken",
+        )
+        self.other_branch = Branch.objects.create(
+            is_active=True,
+            address="1 Other Street",
+            merchant=MerchantBusiness.objects.create(
+                user_account=other_user_account,
+                name="Other Pets",
+                email="otherpets@gmail.com",
+                address="1 Other Street",
+                delivery_fee=10,
+            ),
+        )
+        for branch_product, branch_price in [(self.branch_product_1, 20), (self.branch_product_3, 45)]:
+            BranchProduct.objects.create(
+                branch=self.other_branch,
+                global_product=branch_product.global_product,
+                branch_price=branch_price,
+                created_by=self.merchant_user_account,
+            )
+
+    def get_cheapest_basket(self, items, **data):
+        data.setdefault("store_ids", [self.branch.merchant.id, self.other_branch.merchant.id])
+        return self.client.post(
+            reverse('cheapest_basket'), {"items": items, **data}, content_type="application/json"
+        )
+
+    def test_cheapest_single_store_and_split(self):
+        response = self.get_cheapest_basket([
+            {"global_product_id": self.branch_product_1.global_product.id, "quantity": 2},
+            {"global_product_id": self.branch_product_2.global_product.id, "quantity": 1},
+            {"global_product_id": self.branch_product_3.global_product.id, "quantity": 1},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # only orsum pets stocks everything, the second dog food is on sale at half price:
+        single_store = response.data['cheapest_single_store']
+        self.assertEqual(single_store['stores'][0]['branch']['id'], self.branch.id)
+        self.assertEqual(single_store['products_total'], "175.00")
+        self.assertEqual(single_store['total'], "195.00")
+
+        split = response.data['cheapest_split']
+        self.assertEqual(split['total'], "140.00")
+        self.assertEqual(split['delivery_fees'], "30.00")
+        self.assertEqual(
+            {store['branch']['id']: len(store['items']) for store in split['stores']},
+            {self.branch.id: 1, self.other_branch.id: 2},
+        )
+        self.assertEqual(response.data['split_savings'], "55.00")
+
+    def test_one_store_is_used_when_splitting_costs_more_in_delivery(self):
+        response = self.get_cheapest_basket([
+            {"global_product_id": self.branch_product_2.global_product.id, "quantity": 1},
+            {"global_product_id": self.branch_product_3.global_product.id, "quantity": 1},
+        ])
+
+        # the other store saves 5.00 on the third dog food but costs 10.00 in delivery:
+        split = response.data['cheapest_split']
+        self.assertEqual([store['branch']['id'] for store in split['stores']], [self.branch.id])
+        self.assertEqual(split['total'], response.data['cheapest_single_store']['total'])
+
+    def test_prices_are_loaded_with_one_query(self):
+        with self.assertNumQueries(2):
+            response = self.get_cheapest_basket([
+                {"global_product_id": self.branch_product_1.global_product.id, "quantity": 1},
+                {"global_product_id": 999, "quantity": 1},
+            ])
+
+        self.assertEqual(response.data['unavailable_products'], [999])
+        self.assertEqual(response.data['cheapest_split']['total'], "30.00")
+
+    def test_invalid_shopping_lists_are_rejected(self):
+        response = self.get_cheapest_basket([{"quantity": 1}])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "Invalid shopping list format.")
+
+    def test_quantities_are_capped(self):
+        global_product_id = self.branch_product_1.global_product.id
+        response = self.get_cheapest_basket([
+            {"global_product_id": global_product_id, "quantity": 60},
+            {"global_product_id": global_product_id, "quantity": 60},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "A shopping list can have at most 100 of a product.")
+
+    def test_a_location_or_stores_are_required(self):
+        items = [{"global_product_id": self.branch_product_1.global_product.id, "quantity": 1}]
+
+        response = self.get_cheapest_basket(items, store_ids=[])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "Coordinates or store ids are required.")
+
+        response = self.get_cheapest_basket(items, store_ids=list(range(1, 22)))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "At most 20 stores can be compared.")
+
+    def test_thirty_items_across_two_hundred_branches(self):
+        global_products = GlobalProduct.objects.bulk_create([
+            GlobalProduct(name=f"Basket Product {index}", description="") for index in range(30)
+        ])
+        global_product_ids = list(
+            GlobalProduct.objects.filter(name__startswith="Basket Product").values_list("id", flat=True)
+        )
+        Branch.objects.bulk_create([
+            Branch(is_active=True, address=f"{index} Basket Street", merchant=self.other_branch.merchant)
+            for index in range(200)
+        ])
+        branch_ids = list(Branch.objects.filter(address__endswith="Basket Street").values_list("id", flat=True))
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch_id=branch_id,
+                global_product_id=global_product_id,
+                branch_price=20 + (branch_index * 7 + product_index * 13) % 50,
+                created_by=self.merchant_user_account,
+            )
+            for branch_index, branch_id in enumerate(branch_ids)
+            for product_index, global_product_id in enumerate(global_product_ids)
+        ])
+        items = [{"global_product_id": global_product_id, "quantity": 2} for global_product_id in global_product_ids]
+
+        response = self.get_cheapest_basket(items)
+
+        self.assertEqual(response.data['success'], True)
+        self.assertLessEqual(
+            float(response.data['cheapest_split']['total']),
+            float(response.data['cheapest_single_store']['total']),
+        )
+
+    def test_split_is_never_dearer_than_the_cheapest_single_store(self):
+        # starting from the cheapest branch per product gets stuck at 100.02 here:
+        cheap_food = GlobalProduct.objects.create(name="Split Food", description="")
+        cheap_treats = GlobalProduct.objects.create(name="Split Treats", description="")
+        stores = [
+            self.create_store("storea", "0633333331", {cheap_food: "0.01", cheap_treats: "100.00"}),
+            self.create_store("storeb", "0633333332", {cheap_food: "100.00", cheap_treats: "0.01"}),
+            self.create_store("storec", "0633333333", {cheap_food: "10.00", cheap_treats: "10.00"}),
+        ]
+
+        response = self.get_cheapest_basket(
+            [
+                {"global_product_id": cheap_food.id, "quantity": 1},
+                {"global_product_id": cheap_treats.id, "quantity": 1},
+            ],
+            store_ids=[store.merchant.id for store in stores],
+        )
+
+        self.assertEqual(response.data['cheapest_single_store']['total'], "70.00")
+        self.assertEqual(response.data['cheapest_split']['total'], "70.00")
+        self.assertEqual(
+            [store['branch']['id'] for store in response.data['cheapest_split']['stores']], [stores[2].id]
+        )
+        self.assertEqual(response.data['split_savings'], "0.00")
+
+    def create_store(self, name, phone_number, prices):
+        # a store with a delivery fee of 50.00:
+        user_account = UserAccount.objects.create(
+            user=User.objects.create(username=name, email=f"{name}@gmail.com"),
+            phone_number=phone_number,
+            is_merchant=True,
+            device_token=f"{name}devicetoken",
+        )
+        branch = Branch.objects.create(
+            is_active=True,
+            address=f"1 {name} Street",
+            merchant=MerchantBusiness.objects.create(
+                user_account=user_account,
+                name=name,
+                email=f"{name}@gmail.com",
+                address=f"1 {name} Street",
+                delivery_fee=50,
+            ),
+        )
+        for global_product, branch_price in prices.items():
+            BranchProduct.objects.create(
+                branch=branch,
+                global_product=global_product,
+                branch_price=branch_price,
+                created_by=self.merchant_user_account,
+            )
+        return branch
+
+
+class PriceSummaryTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        # summaries are refreshed once the saves commit:
+        with self.captureOnCommitCallbacks(execute=True):
+            super().setUp()
+
+            other_user_account = UserAccount.objects.create(
+                user=User.objects.create(username="otherpets", email="otherpets@gmail.com"),
+                phone_number="0622222222",
+                is_merchant=True,
+                device_token="otherpetsdevicetoken",
+            )
+            self.other_branch = Branch.objects.create(
+                is_active=True,
+                address="1 Other Street",
+                merchant=MerchantBusiness.objects.create(
+                    user_account=other_user_account,
+                    name="Other Pets",
+                    email="otherpets@gmail.com",
+                    address="1 Other Street",
+                    delivery_fee=10,
+                ),
+            )
+            self.global_product = self.branch_product_1.global_product
+            self.other_branch_product = BranchProduct.objects.create(
+                branch=self.other_branch,
+                global_product=self.global_product,
+                branch_price=30,
+                created_by=self.merchant_user_account,
+            )
+
+    def get_summary(self):
+        return ProductPriceSummary.objects.get(global_product=self.global_product)
+
+    def test_summaries_follow_price_changes(self):
+        summary = self.get_summary()
+        self.assertEqual(str(summary.min_price), "30.00")
+        self.assertEqual(str(summary.median_price), "40.00")
+        self.assertEqual(str(summary.max_price), "50.00")
+        self.assertEqual(summary.offer_count, 2)
+        self.assertEqual(summary.cheapest_branch_ids, [self.other_branch.id])
+
+        self.branch_product_1.branch_price = 25
+        with self.captureOnCommitCallbacks(execute=True):
+            self.branch_product_1.save()
+        summary = self.get_summary()
+        self.assertEqual(str(summary.min_price), "25.00")
+        self.assertEqual(summary.cheapest_branch_ids, [self.branch.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other_branch_product.delete()
+            self.branch_product_1.delete()
+        self.assertFalse(ProductPriceSummary.objects.filter(global_product=self.global_product).exists())
+
+    def test_offers_moved_to_another_product_update_both_summaries(self):
+        self.other_branch_product.global_product = self.branch_product_2.global_product
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other_branch_product.save()
+
+        summary = self.get_summary()
+        self.assertEqual(str(summary.min_price), "50.00")
+        self.assertEqual(summary.offer_count, 1)
+        new_summary = ProductPriceSummary.objects.get(global_product=self.branch_product_2.global_product)
+        self.assertEqual(new_summary.offer_count, 2)
+        self.assertEqual(new_summary.cheapest_branch_ids, [self.branch.id])
+
+    def test_summaries_follow_sale_campaigns(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            campaign = SaleCampaign.objects.create(
+                branch=self.branch,
+                branch_product=self.branch_product_1,
+                percentage_off=50,
+                campaign_ends=timezone.localdate() + timedelta(days=3),
+            )
+        self.assertEqual(str(self.get_summary().min_price), "25.00")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            campaign.delete()
+        self.assertEqual(str(self.get_summary().min_price), "30.00")
+
+    def test_sale_campaigns_moved_to_another_offer_update_both_summaries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            campaign = SaleCampaign.objects.create(
+                branch=self.other_branch,
+                branch_product=self.other_branch_product,
+                percentage_off=50,
+                campaign_ends=timezone.localdate() + timedelta(days=3),
+            )
+        self.assertEqual(str(self.get_summary().min_price), "15.00")
+
+        campaign.branch = self.branch
+        campaign.branch_product = self.branch_product_3
+        with self.captureOnCommitCallbacks(execute=True):
+            campaign.save()
+
+        self.assertEqual(str(self.get_summary().min_price), "30.00")
+        new_summary = ProductPriceSummary.objects.get(global_product=self.branch_product_3.global_product)
+        self.assertEqual(str(new_summary.min_price), "25.00")
+
+    def test_offers_saved_in_one_transaction_refresh_their_product_once(self):
+        with patch.object(
+            price_summaries, "build_price_summaries", wraps=price_summaries.build_price_summaries
+        ) as mocked_build, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for price in [45, 35, 20]:
+                    self.branch_product_1.branch_price = price
+                    self.branch_product_1.save()
+            # nothing is refreshed before the transaction commits:
+            self.assertEqual(str(self.get_summary().min_price), "30.00")
+
+        self.assertEqual(mocked_build.call_count, 1)
+        self.assertEqual(str(self.get_summary().min_price), "20.00")
+
+    def test_nightly_rebuild_drops_ended_campaigns(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            SaleCampaign.objects.create(
+                branch=self.branch,
+                branch_product=self.branch_product_1,
+                percentage_off=50,
+                campaign_ends=timezone.localdate() + timedelta(days=1),
+            )
+        self.assertEqual(str(self.get_summary().min_price), "25.00")
+
+        # the campaign ends at midnight without anything being saved:
+        with patch("django.utils.timezone.localdate", return_value=timezone.localdate() + timedelta(days=2)):
+            call_command("rebuild_price_summaries", stdout=io.StringIO())
+        self.assertEqual(str(self.get_summary().min_price), "30.00")
+
+    def test_lowest_prices_are_a_single_read(self):
+        global_product_ids = [self.global_product.id, self.branch_product_2.global_product.id, 999999]
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse('lowest_prices', kwargs={"global_product_ids": ",".join(map(str, global_product_ids))})
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        prices = response.data['prices']
+        # the second dog food is on sale at half price:
+        self.assertEqual(
+            [(price['global_product']['id'], price['min_price']) for price in prices],
+            [(self.branch_product_2.global_product.id, "25.00"), (self.global_product.id, "30.00")],
+        )
+        self.assertEqual(prices[1]['offer_count'], 2)
+        self.assertEqual(response.data['unavailable_products'], [999999])
+
+    def test_invalid_product_ids_are_rejected(self):
+        response = self.client.get(reverse('lowest_prices', kwargs={"global_product_ids": "abc"}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductSearchIndexTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        product_search_index.build()
+
+    def test_every_query_word_has_to_match_the_start_of_a_word(self):
+        puppy_food = GlobalProduct.objects.create(name="Puppies Dry Food", description="For puppies")
+
+        self.assertEqual([product_id for product_id, _ in search_products("pupp dry")], [puppy_food.id])
+        self.assertEqual(search_products("puppies wet"), [])
+        # words in the middle of other words are only found when they look alike:
+        self.assertEqual(search_products("uppies")[0][0], puppy_food.id)
+
+    def test_whole_words_rank_above_prefixes(self):
+        dog = GlobalProduct.objects.create(name="Dog Leash", description="")
+        dogs = GlobalProduct.objects.create(name="Dogster Leash", description="")
+
+        matches = search_products("dog leash")
+
+        self.assertEqual(matches[0][0], dog.id)
+        self.assertLess([product_id for product_id, _ in matches].index(dog.id),
+                        [product_id for product_id, _ in matches].index(dogs.id))
+
+    def test_index_finds_the_same_branch_products_as_icontains(self):
+        animals = ["Cat", "Bird", "Fish", "Horse"]
+        GlobalProduct.objects.bulk_create([
+            GlobalProduct(name=f"{animals[index % 4]} Product {index}", description="")
+            for index in range(40)
+        ])
+        BranchProduct.objects.bulk_create([
+            BranchProduct(
+                branch=self.branch,
+                global_product=global_product,
+                branch_price=10,
+                created_by=self.merchant_user_account,
+            )
+            for global_product in GlobalProduct.objects.all()
+        ])
+        product_search_index.build()
+
+        for query in ["dog food", "fish product", "product 1"]:
+            icontains_results = set(BranchProduct.objects.filter(
+                global_product__name__icontains=query, in_stock=True, is_active=True
+            ).values_list("id", flat=True))
+            global_product_ids = [product_id for product_id, _ in search_products(query)]
+            indexed_results = set(BranchProduct.objects.filter(
+                global_product_id__in=global_product_ids, in_stock=True, is_active=True
+            ).values_list("id", flat=True))
+            self.assertTrue(icontains_results)
+            self.assertTrue(icontains_results <= indexed_results)
+
+    def test_misspelt_brand_names_are_matched_by_trigrams(self):
+        royal_canin = GlobalProduct.objects.create(name="Royal Canin Maxi Adult", description="Dry dog food")
+        pedigree = GlobalProduct.objects.create(name="Pedigree Adult Chicken", description="Dry dog food")
+
+        self.assertEqual(search_products("Royl Canin")[0][0], royal_canin.id)
+        self.assertEqual([product_id for product_id, _ in search_products("pedegree")], [pedigree.id])
+        self.assertEqual(search_products("xyzzy"), [])
+
+        # exact words still rank above similar ones:
+        self.assertLess(
+            search_products("pedegree")[0][1], search_products("pedigree")[0][1]
+        )
+
+    def test_misspelt_words_are_matched_among_many_similar_names(self):
+        create_brand_products()
+        product_search_index.build()
+
+        matches = search_products("Royl Canin Formula14")
+
+        self.assertEqual(
+            GlobalProduct.objects.get(id=matches[0][0]).name, "Royal Canin Formula14 14kg"
+        )
+        matched_names = GlobalProduct.objects.filter(
+            id__in=[product_id for product_id, _ in matches]
+        ).values_list("name", flat=True)
+        self.assertTrue(all(name.startswith("Royal Canin Formula14") for name in matched_names))
+
+    def test_index_follows_product_changes(self):
+        global_product = self.branch_product_1.global_product
+
+        global_product.name = "Bird Seed"
+        global_product.save()
+        self.assertEqual(search_products("bird")[0][0], global_product.id)
+        # it is only found through its description now:
+        self.assertEqual(search_products("dog food")[-1][0], global_product.id)
+
+        global_product.delete()
+        self.assertEqual(search_products("bird"), [])
+
+    def test_new_product_names_are_added_to_the_trigram_index(self):
+        whiskas = GlobalProduct.objects.create(name="Whiskas Tuna", description="")
+
+        self.assertEqual(search_products("whiskers")[0][0], whiskas.id)
+
+    def test_stale_indexes_are_rebuilt(self):
+        # changes made by another process don't reach this index through signals:
+        GlobalProduct.objects.filter(id=self.branch_product_1.global_product.id).update(name="Fish Flakes")
+        self.assertEqual(search_products("fish"), [])
+
+        with self.settings(PRODUCT_SEARCH_INDEX={"REFRESH_SECONDS": 0}):
+            time.sleep(0.01)
+            self.assertEqual(search_products("fish")[0][0], self.branch_product_1.global_product.id)
+
+    def test_searches_are_not_held_up_by_a_rebuild(self):
+        # another thread is rebuilding the stale index:
+        product_search_index.build_lock.acquire()
+        try:
+            with self.settings(PRODUCT_SEARCH_INDEX={"REFRESH_SECONDS": 0}):
+                time.sleep(0.01)
+                self.assertEqual(len(search_products("dog food")), 3)
+        finally:
+            product_search_index.build_lock.release()
+
+    def test_a_failed_rebuild_keeps_the_current_index(self):
+        with patch.object(GlobalProduct.objects, "values_list", side_effect=DatabaseError("connection lost")):
+            with self.assertRaises(DatabaseError):
+                product_search_index.build()
+
+        self.assertEqual(len(search_products("dog food")), 3)
+
+    def test_changes_made_during_a_rebuild_are_kept(self):
+        products = list(GlobalProduct.objects.values_list("id", "name", "description"))
+
+        class ProductRows():
+            def iterator(self):
+                # saved by another request after the rebuild read the table:
+                GlobalProduct.objects.create(name="Bird Seed", description="")
+                yield from products
+
+        with patch.object(GlobalProduct.objects, "values_list", return_value=ProductRows()):
+            product_search_index.build()
+
+        self.assertEqual(len(search_products("bird seed")), 1)
+        self.assertEqual(len(search_products("dog food")), 3)
+
+
+class ProductAutocompleteTests(GlobalTestCaseConfig):
+
+    def setUp(self):
+        super().setUp()
+        product_autocomplete.mark_stale()
+
+        # a second branch that also stocks the second dog food:
+        self.second_branch = Branch.objects.create(
+            is_active=True, address="Gateway Theatre of Shopping, Umhlanga", merchant=self.branch.merchant
+        )
+        BranchProduct.objects.create(
+            branch=self.second_branch,
+            global_product=self.branch_product_2.global_product,
+            branch_price=55,
+            created_by=self.merchant_user_account,
+        )
+
+    def autocomplete(self, prefix):
+        return self.client.get(reverse('autocomplete_products', kwargs={'prefix': prefix}))
+
+    def test_suggestions_are_ranked_by_the_branches_that_stock_them(self):
+        response = self.autocomplete("dog fo")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        suggestions = response.data['suggestions']
+        self.assertEqual(
+            [suggestion['id'] for suggestion in suggestions],
+            [
+                self.branch_product_2.global_product.id,
+                self.branch_product_1.global_product.id,
+                self.branch_product_3.global_product.id,
+            ],
+        )
+        self.assertEqual(suggestions[0]['branch_count'], 2)
+
+    def test_any_word_of_the_name_can_be_completed(self):
+        self.assertEqual(len(suggest_products("foo")), 3)
+        self.assertEqual(len(suggest_products("foo", limit=1)), 1)
+        self.assertEqual(suggest_products("bird"), [])
+
+    def test_suggestions_are_served_from_memory(self):
+        self.autocomplete("do")
+
+        with self.assertNumQueries(0):
+            response = self.autocomplete("dog")
+        self.assertEqual(len(response.data['suggestions']), 3)
+
+    def test_index_is_rebuilt_when_the_stock_changes(self):
+        suggest_products("dog")
+
+        # stocking the third dog food at the second branch changes the suggestion version:
+        BranchProduct.objects.create(
+            branch=self.second_branch,
+            global_product=self.branch_product_3.global_product,
+            branch_price=45,
+            created_by=self.merchant_user_account,
+        )
+        with self.settings(PRODUCT_AUTOCOMPLETE={**settings.PRODUCT_AUTOCOMPLETE, "VERSION_CHECK_SECONDS": 0}):
+            suggestions = suggest_products("dog")
+
+        self.assertEqual(suggestions[0]['branch_count'], 2)
+        self.assertEqual(suggestions[2]['id'], self.branch_product_1.global_product.id)
+
+    def test_price_changes_do_not_rebuild_the_index(self):
+        suggest_products("dog")
+
+        self.branch_product_1.branch_price = 45
+        self.branch_product_1.save()
+        with self.settings(PRODUCT_AUTOCOMPLETE={**settings.PRODUCT_AUTOCOMPLETE, "VERSION_CHECK_SECONDS": 0}):
+            with patch.object(product_autocomplete, "_build") as mocked_build:
+                suggest_products("dog")
+        mocked_build.assert_not_called()
+
+    def test_products_renamed_by_other_processes_are_picked_up_by_the_max_age_rebuild(self):
+        suggest_products("dog")
+
+        # an update doesn't send signals, like a save in another process:
+        GlobalProduct.objects.filter(id=self.branch_product_3.global_product.id).update(name="Cat Food-3")
+        autocomplete_settings = {**settings.PRODUCT_AUTOCOMPLETE, "VERSION_CHECK_SECONDS": 0}
+        with self.settings(PRODUCT_AUTOCOMPLETE=autocomplete_settings):
+            self.assertEqual(len(suggest_products("dog")), 3)
+        with self.settings(PRODUCT_AUTOCOMPLETE={**autocomplete_settings, "MAX_AGE_SECONDS": 0}):
+            self.assertEqual(len(suggest_products("dog")), 2)
+
+    def test_suggestions_are_not_held_up_by_a_rebuild(self):
+        suggest_products("dog")
+        product_autocomplete.mark_stale()
+
+        # another thread is rebuilding, the current suggestions are served in the meantime:
+        product_autocomplete.build_lock.acquire()
+        try:
+            with self.assertNumQueries(0):
+                suggestions = suggest_products("dog")
+        finally:
+            product_autocomplete.build_lock.release()
+        self.assertEqual(len(suggestions), 3)
+
+        # and the next request after it rebuilds:
+        GlobalProduct.objects.create(name="Dog Leash", description="")
+        self.assertEqual(len(suggest_products("dog")), 4)
+
+    def test_suggestions_among_many_similar_names(self):
+        create_brand_products()
+        product_autocomplete.mark_stale()
+
+        suggestions = suggest_products("royal canin formula1")
+        self.assertEqual(len(suggestions), 10)
+        self.assertTrue(
+            all(suggestion['name'].startswith("Royal Canin Formula1") for suggestion in suggestions)
+        )
+        # any word of the name can be completed, products without stock are ranked by name:
+        self.assertEqual(
+            [suggestion['name'] for suggestion in suggest_products("formula14", limit=2)],
+            ["Acana Formula144 19kg", "Eukanuba Formula146 21kg"],
+        )
+        self.assertEqual(suggest_products("xyz"), [])
+
+    def test_invalid_limits_are_rejected(self):
+        for limit in ["abc", "0", "-1"]:
+            response = self.client.get(reverse('autocomplete_products', kwargs={'prefix': "dog"}), {"limit": limit})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('autocomplete_products', kwargs={'prefix': "dog"}), {"limit": 1})
+        self.assertEqual(len(response.data['suggestions']), 1)
+
+
+@benchmark
+class ProductSearchBenchmarkTests(GlobalTestCaseConfig):
+
+    """
+    Compares the old icontains scan with the search index. Run it with RUN_BENCHMARKS=1,
+    and set BRANCH_PRODUCTS to 1_000_000 to run it at production scale.
+    """
+
+    GLOBAL_PRODUCTS = 2_000
+    BRANCH_PRODUCTS = 50_000
+
+    def setUp(self):
+        super().setUp()
+        animals = ["Cat", "Bird", "Fish", "Horse"]
+        GlobalProduct.objects.bulk_create([
+            GlobalProduct(
+                name=f"{animals[index % 4]} Product {index}",
+                description=f"Everything for your {animals[index % 4].lower()}",
+            )
+            for index in range(self.GLOBAL_PRODUCTS)
+        ])
+        global_product_ids = list(GlobalProduct.objects.values_list("id", flat=True))
+        BranchProduct.objects.bulk_create(
+            [
+                BranchProduct(
+                    branch=self.branch,
+                    global_product_id=global_product_ids[index % len(global_product_ids)],
+                    branch_price=index % 500,
+                    created_by=self.merchant_user_account,
+                )
+                for index in range(self.BRANCH_PRODUCTS)
+            ],
+            batch_size=5_000,
+        )
+        product_search_index.build()
+
+    def measure(self, search, runs=10):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            results = search()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        return results, round(timings[int(runs * 0.95) - 1] * 1000, 2)
+
+    def test_search_index_against_icontains(self):
+        def icontains_search():
+            return sorted(BranchProduct.objects.filter(
+                global_product__name__icontains="dog food", in_stock=True, is_active=True
+            ).values_list("id", flat=True))
+
+        def indexed_search():
+            global_product_ids = [product_id for product_id, _ in search_products("dog food")]
+            return sorted(BranchProduct.objects.filter(
+                global_product_id__in=global_product_ids, in_stock=True, is_active=True
+            ).values_list("id", flat=True))
+
+        icontains_results, icontains_p95_ms = self.measure(icontains_search)
+        indexed_results, indexed_p95_ms = self.measure(indexed_search)
+        timings = (
+            f"search over {self.BRANCH_PRODUCTS + 3} branch products: "
+            f"icontains p95 {icontains_p95_ms}ms, search index p95 {indexed_p95_ms}ms"
+        )
+        logger.info(timings)
+
+        self.assertEqual(indexed_results, icontains_results, timings)
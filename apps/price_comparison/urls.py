@@ -1,6 +1,16 @@
 from django.urls import path
-from .views import ProductSearchView
+from .views import (
+    CheapestBasketView,
+    LowestPricesView,
+    ProductAutocompleteView,
+    ProductSearchView,
+    SearchCacheStatsView,
+)
 
 urlpatterns = [
+    path('cheapest-basket/', CheapestBasketView.as_view(), name='cheapest_basket'),
+    path('search-cache-stats/', SearchCacheStatsView.as_view(), name='search_cache_stats'),
+    path('lowest-prices/<str:global_product_ids>', LowestPricesView.as_view(), name='lowest_prices'),
+    path('autocomplete/<str:prefix>', ProductAutocompleteView.as_view(), name='autocomplete_products'),
     path('<str:query>/<str:store_ids>', ProductSearchView.as_view(), name='search_products'),
 ]
@@ -1,17 +1,47 @@
+import base64
+import json
+import math
+from decimal import Decimal
+
+from rest_framework.permissions import IsAdminUser
+from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from datetime import datetime
-from django.db.models import F, Case, When, DecimalField, Q, Exists, OuterRef, Subquery
+from django.db.models import Case, DecimalField, Q, Value, When
 
+from apps.price_comparison.basket import (
+    BasketOptimizer,
+    from_cents,
+    get_branch_prices,
+    get_candidate_branches,
+    to_cents,
+)
+from apps.price_comparison.models import ProductPriceSummary
+from apps.price_comparison.search_cache import (
+    cache_page,
+    get_cached_page,
+    get_search_cache_key,
+    get_search_cache_stats,
+)
+from apps.products.autocomplete import suggest_products
 from apps.products.models import BranchProduct
-from apps.merchants.models import SaleCampaign
-from apps.products.serializers.serializers import BranchProductSerializer
+from apps.products.pricing import annotate_sale_campaigns, calculate_sale_price
+from apps.products.search_index import search_products
+from apps.products.serializers.serializers import BranchProductProjectionSerializer
 from global_view_functions.global_view_functions import GlobalViewFunctions
 
 class ProductSearchView(APIView, GlobalViewFunctions):
     permission_classes = []
 
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+
+    # generic queries like "food" are looked up this many global products (a window) at a time,
+    # the windows are paged through in order of relevance:
+    MAX_CANDIDATES = 1000
+    RELEVANCE_LEVELS = 20
+
     def get(self, request, **kwargs):
         try:
             query = kwargs.get("query", "").strip()
@@ -25,69 +55,326 @@ class ProductSearchView(APIView, GlobalViewFunctions):
             if not query:
                 raise Exception("A search query was not specified.")
 
-            current_date = datetime.now().date()
-            filters = Q(global_product__name__icontains=query, in_stock=True, is_active=True)
+            page_size = min(
+                max(int(request.query_params.get("page_size", self.DEFAULT_PAGE_SIZE)), 1),
+                self.MAX_PAGE_SIZE,
+            )
+            cursor = self.decode_cursor(request.query_params.get("cursor"))
+            metadata = {
+                "query": query,
+                "filtered_stores": store_ids or "all",
+                "page_size": page_size,
+            }
+
+            # popular searches are served from the cache until a branch they cover changes:
+            cache_key = get_search_cache_key(query, store_ids, page_size, request.query_params.get("cursor"))
+            cached_page = get_cached_page(cache_key)
+            if cached_page is not None:
+                return self.get_page_response(cached_page, metadata)
+
+            # look the matching global products up in the search index instead of scanning every product:
+            candidates = search_products(query)
+            if not candidates:
+                raise Exception("No product matching this criteria was found.")
+            best_score = candidates[0][1]
 
+            filters = Q(in_stock=True, is_active=True)
             if store_ids:
                 filters &= Q(branch__merchant__id__in=store_ids)
 
-            products = BranchProduct.objects.select_related(
-                'global_product', 'branch', 'branch__merchant'
-            ).filter(filters)
+            # the page is filled from the window the cursor is in and the ones after it, the
+            # extra row tells us if there is another page:
+            window, position = (cursor[3], cursor[:3]) if cursor else (0, None)
+            results = []
+            while len(results) <= page_size and window * self.MAX_CANDIDATES < len(candidates):
+                relevance = dict(candidates[window * self.MAX_CANDIDATES:(window + 1) * self.MAX_CANDIDATES])
 
-            if not products.exists():
-                raise Exception("No product matching this criteria was found.")
+                # Note: Now each product can only have one active sale campaign
+                products = annotate_sale_campaigns(
+                    BranchProduct.objects.filter(filters, global_product_id__in=list(relevance))
+                ).annotate(relevance=self.get_relevance_expression(relevance, best_score))
+
+                # the most relevant products first, the cheapest first when they are equally relevant:
+                if position:
+                    products = products.filter(self.get_cursor_filter(*position))
+                products = products.order_by('-relevance', 'final_price', 'id')[:page_size + 1 - len(results)]
 
-            # Note: Now each product can only have one active sale campaign
-            active_campaigns = SaleCampaign.objects.filter(
-                campaign_ends__gte=datetime.now(),
-                branch_product=OuterRef("pk"),
-            ).order_by("id")
-
-            products = products.annotate(
-                has_campaign=Exists(active_campaigns),
-                
-                campaign_percentage=Subquery(
-                    active_campaigns.values('percentage_off')[:1],
-                    output_field=DecimalField(max_digits=10, decimal_places=2)
-                ),
-                
-                final_price=Case(
-                    When(
-                        has_campaign=True,
-                        then=F('branch_price') - (F('branch_price') * F('campaign_percentage') / 100)
-                    ),
-                    default=F('branch_price'),
-                    output_field=DecimalField(max_digits=10, decimal_places=2)
+                serializer = BranchProductProjectionSerializer(
+                    products, extra_fields=['sale_campaign_id', 'campaign_percentage', 'final_price', 'relevance']
                 )
-            ).order_by('final_price')
+                results.extend((window, product, product_data) for product, product_data in serializer.stream())
+                window, position = window + 1, None
 
-            serializer = BranchProductSerializer(products, many=True)
-            serialized_data = serializer.data
+            page = self.serialize_page(results, page_size)
+            if not page["count"] and not cursor:
+                raise Exception("No product matching this criteria was found.")
 
-            for product_data, product in zip(serialized_data, products):
-                if product.has_campaign:
-                    product_data['campaign'] = {
-                        'percentage_off': float(product.campaign_percentage or 0),
-                        'final_price': float(product.final_price or product.branch_price)
-                    }
-                else:
-                    product_data['campaign'] = None
+            cache_page(cache_key, page)
+            return self.get_page_response(page, metadata)
 
+        except Exception as e:
             return Response({
-                "success": True,
-                "message": "Products retrieved successfully.",
-                "products": serialized_data,
-                "metadata": {
-                    "total_count": len(serialized_data),
-                    "query": query,
-                    "filtered_stores": store_ids or "all",
+                "success": False,
+                "message": "Failed to retrieve products.",
+                "error": str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def serialize_page(self, results, page_size):
+        products = []
+        next_cursor = None
+        for window, product, product_data in results:
+            if len(products) == page_size:
+                next_cursor = self.encode_cursor(*last_result)
+                break
+
+            # campaign data is worked out in the same pass:
+            product_data['relevance'] = float(product['relevance'])
+            if product['sale_campaign_id'] is not None:
+                final_price = calculate_sale_price(product['branch_price'], product['campaign_percentage'])
+                product_data['campaign'] = {
+                    'percentage_off': float(product['campaign_percentage']),
+                    'final_price': float(final_price)
                 }
+            else:
+                product_data['campaign'] = None
+
+            products.append(product_data)
+            last_result = (window, product)
+
+        return {
+            "products": products,
+            "count": len(products),
+            "next_cursor": next_cursor,
+        }
+
+    def get_page_response(self, page, metadata):
+        return Response({
+            "success": True,
+            "message": "Products retrieved successfully.",
+            "products": page["products"],
+            "metadata": {**metadata, "count": page["count"], "next_cursor": page["next_cursor"]},
+        }, status=status.HTTP_200_OK)
+
+    def get_relevance_expression(self, relevance, best_score):
+        # scores are bucketed into RELEVANCE_LEVELS levels of the best score, so the database
+        # orders by a CASE with a handful of branches no matter how many products match:
+        product_ids_by_level = {}
+        for product_id, score in relevance.items():
+            level = max(math.ceil(score / best_score * self.RELEVANCE_LEVELS), 1)
+            product_ids_by_level.setdefault(level, []).append(product_id)
+        return Case(
+            *[
+                When(global_product_id__in=product_ids, then=Value(Decimal(level)))
+                for level, product_ids in product_ids_by_level.items()
+            ],
+            default=Value(Decimal(0)),
+            output_field=DecimalField(max_digits=12, decimal_places=4),
+        )
+
+    def get_cursor_filter(self, relevance, final_price, product_id):
+        # everything that comes after the last product of the previous page:
+        return (
+            Q(relevance__lt=relevance)
+            | Q(relevance=relevance, final_price__gt=final_price)
+            | Q(relevance=relevance, final_price=final_price, id__gt=product_id)
+        )
+
+    def encode_cursor(self, window, product):
+        cursor = json.dumps([str(product['relevance']), str(product['final_price']), product['id'], window])
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            relevance, final_price, product_id, window = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return Decimal(relevance), Decimal(final_price), int(product_id), max(int(window), 0)
+        except Exception:
+            raise Exception("Invalid cursor.")
+
+
+class ProductAutocompleteView(APIView, GlobalViewFunctions):
+    permission_classes = []
+
+    def get(self, request, **kwargs):
+        try:
+            prefix = kwargs.get("prefix", "").strip()
+            if not prefix:
+                raise Exception("A search prefix was not specified.")
+
+            limit = request.query_params.get("limit")
+            if limit is not None and not (limit.isdigit() and int(limit) > 0):
+                return Response({
+                    "success": False,
+                    "message": "Failed to retrieve suggestions.",
+                    "error": "The limit has to be a positive whole number.",
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            # served from memory, no queries unless the product catalog changed:
+            suggestions = suggest_products(prefix, int(limit) if limit else None)
+
+            return Response({
+                "success": True,
+                "message": "Suggestions retrieved successfully.",
+                "suggestions": suggestions,
             }, status=status.HTTP_200_OK)
 
         except Exception as e:
             return Response({
                 "success": False,
-                "message": "Failed to retrieve products.",
+                "message": "Failed to retrieve suggestions.",
                 "error": str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class CheapestBasketView(APIView, GlobalViewFunctions):
+    permission_classes = []
+
+    MAX_ITEMS = 100
+    # keeps every line total far below basket.UNAVAILABLE:
+    MAX_QUANTITY = 100
+    MAX_STORES = 20
+
+    def post(self, request, **kwargs):
+        try:
+            quantities = self.get_quantities(request.data.get("items"))
+            store_ids = [str(store_id) for store_id in request.data.get("store_ids") or []]
+            if not store_ids and not request.data.get("coordinates"):
+                # otherwise every active branch in the country would be compared:
+                raise Exception("Coordinates or store ids are required.")
+            if len(store_ids) > self.MAX_STORES:
+                raise Exception(f"At most {self.MAX_STORES} stores can be compared.")
+
+            branches = get_candidate_branches(
+                store_ids=store_ids,
+                coordinates=request.data.get("coordinates"),
+                radius_km=settings.STORE_RANGE_RADIUS_KM,
+            )
+            if not branches:
+                raise Exception("No Pet stores were found")
+
+            # every price of every listed product at every branch in one query:
+            prices = get_branch_prices(list(quantities), [branch["id"] for branch in branches])
+            optimizer = BasketOptimizer(quantities, branches, prices)
+            if not optimizer.product_ids:
+                raise Exception("None of these products are stocked by the stores.")
+
+            cheapest_single_store = optimizer.cheapest_single_store()
+            cheapest_split = optimizer.cheapest_split()
+            savings = (
+                from_cents(to_cents(cheapest_single_store["total"]) - to_cents(cheapest_split["total"]))
+                if cheapest_single_store else None
+            )
+
+            return Response({
+                "success": True,
+                "message": "Cheapest basket calculated successfully.",
+                "cheapest_single_store": cheapest_single_store,
+                "cheapest_split": cheapest_split,
+                "split_savings": savings,
+                "unavailable_products": optimizer.unavailable_product_ids,
+            }, status=status.HTTP_200_OK)
+
+        except Exception as e:
+            return Response({
+                "success": False,
+                "message": "Failed to calculate the cheapest basket.",
+                "error": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    def get_quantities(self, items):
+        if not items:
+            raise Exception("A shopping list was not specified.")
+        if len(items) > self.MAX_ITEMS:
+            raise Exception(f"A shopping list can have at most {self.MAX_ITEMS} items.")
+        quantities = {}
+        try:
+            for item in items:
+                global_product_id = int(item["global_product_id"])
+                quantity = int(item.get("quantity", 1))
+                if quantity < 1:
+                    raise ValueError
+                quantities[global_product_id] = quantities.get(global_product_id, 0) + quantity
+        except (KeyError, TypeError, ValueError):
+            raise Exception("Invalid shopping list format.")
+        if max(quantities.values()) > self.MAX_QUANTITY:
+            raise Exception(f"A shopping list can have at most {self.MAX_QUANTITY} of a product.")
+        return quantities
+
+
+class LowestPricesView(APIView, GlobalViewFunctions):
+    permission_classes = []
+
+    MAX_PRODUCTS = 100
+
+    def get(self, request, **kwargs):
+        try:
+            try:
+                global_product_ids = {
+                    int(global_product_id)
+                    for global_product_id in kwargs.get("global_product_ids", "").split(",")
+                    if global_product_id.strip()
+                }
+            except ValueError:
+                raise Exception("Invalid product ids.")
+            if not global_product_ids:
+                raise Exception("No products were specified.")
+            if len(global_product_ids) > self.MAX_PRODUCTS:
+                raise Exception(f"At most {self.MAX_PRODUCTS} products can be compared at once.")
+
+            # a single read of the materialized summaries, see apps/price_comparison/price_summaries.py:
+            summaries = list(
+                ProductPriceSummary.objects.filter(global_product_id__in=global_product_ids)
+                .order_by("min_price", "global_product_id")
+                .values(
+                    "global_product_id",
+                    "global_product__name",
+                    "global_product__image",
+                    "min_price",
+                    "median_price",
+                    "max_price",
+                    "offer_count",
+                    "cheapest_branch_ids",
+                )
+            )
+            found_ids = {summary["global_product_id"] for summary in summaries}
+
+            return Response({
+                "success": True,
+                "message": "Lowest prices retrieved successfully.",
+                "prices": [
+                    {
+                        "global_product": {
+                            "id": summary["global_product_id"],
+                            "name": summary["global_product__name"],
+                            "image": summary["global_product__image"],
+                        },
+                        "min_price": str(summary["min_price"]),
+                        "median_price": str(summary["median_price"]),
+                        "max_price": str(summary["max_price"]),
+                        "offer_count": summary["offer_count"],
+                        "cheapest_branch_ids": summary["cheapest_branch_ids"],
+                    }
+                    for summary in summaries
+                ],
+                "unavailable_products": sorted(global_product_ids - found_ids),
+            }, status=status.HTTP_200_OK)
+
+        except Exception as e:
+            return Response({
+                "success": False,
+                "message": "Failed to retrieve lowest prices.",
+                "error": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SearchCacheStatsView(APIView, GlobalViewFunctions):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, **kwargs):
+        return Response({
+            "success": True,
+            "message": "Search cache stats retrieved successfully.",
+            "stats": get_search_cache_stats(),
+        }, status=status.HTTP_200_OK)
+
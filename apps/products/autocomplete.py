@@ -0,0 +1,222 @@
+"""
+Product name suggestions for the search box.
+
+Every word of every product name starts an entry (eg. "royal canin maxi", "canin maxi"
+and "maxi") in a sorted array, so the products with a word starting with what the
+customer typed so far are a single bisect away. Suggestions are ranked by how many
+branches stock the product, and a segment tree over those ranks finds the best
+products for a prefix without reading every key that starts with it.
+
+The index is rebuilt lazily: at most every PRODUCT_AUTOCOMPLETE["VERSION_CHECK_SECONDS"]
+the suggestion version is read and the index is rebuilt if it changed. The version only
+covers what suggestions show (which products exist and which branches stock them), so
+price edits don't rebuild the index. Products saved in this process mark the index as
+stale straight away, products renamed by other processes are picked up by rebuilding at
+least every PRODUCT_AUTOCOMPLETE["MAX_AGE_SECONDS"]. Only one thread rebuilds, the
+others keep suggesting from the current arrays until the new ones are swapped in.
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+from apps.products.models import BranchProduct, GlobalProduct
+from apps.products.search_index import tokenize
+
+
+def get_suggestion_version():
+    """
+    Return a version of what suggestions show that changes whenever products are added
+    or removed or branches start or stop stocking them, but not when prices change.
+    """
+    stocked = BranchProduct.objects.filter(in_stock=True, is_active=True, branch__is_active=True).aggregate(
+        count=Count("id"), ids=Sum("id"), branch_ids=Sum("branch_id"), product_ids=Sum("global_product_id")
+    )
+    global_products = GlobalProduct.objects.aggregate(count=Count("id"), last_id=Max("id"))
+    return (
+        stocked["count"],
+        stocked["ids"],
+        stocked["branch_ids"],
+        stocked["product_ids"],
+        global_products["count"],
+        global_products["last_id"],
+    )
+
+
+class ProductNameAutocomplete():
+
+    def __init__(self):
+        self.keys = []
+        # the global product id and the rank of that product for every key:
+        self.product_ids = array("I")
+        self.ranks = array("I")
+        # segment tree over the ranks holding the position of the best ranked key in each
+        # range, so the best products for a prefix are found without reading all its keys:
+        self.best_positions = array("I")
+        self.names = {}
+        self.branch_counts = {}
+        self.version = None
+        self.built_at = None
+        self.checked_at = None
+        self.stale = True
+        self.lock = threading.RLock()
+        # only one thread checks the version and rebuilds, the others keep using the current arrays:
+        self.build_lock = threading.Lock()
+
+    def mark_stale(self):
+        self.stale = True
+
+    def build(self, version):
+        # cleared before reading so products saved during the build mark it stale again:
+        self.stale = False
+        try:
+            self._build(version)
+        except Exception:
+            self.stale = True
+            raise
+
+    def _build(self, version):
+        branch_counts = dict(
+            BranchProduct.objects.filter(in_stock=True, is_active=True, branch__is_active=True)
+            .values("global_product_id")
+            .annotate(branch_count=Count("branch_id", distinct=True))
+            .values_list("global_product_id", "branch_count")
+        )
+        names = dict(GlobalProduct.objects.values_list("id", "name").iterator())
+
+        # rank 0 is the product stocked by the most branches:
+        ranked_ids = sorted(
+            names,
+            key=lambda product_id: (
+                -branch_counts.get(product_id, 0), names[product_id].lower(), product_id
+            ),
+        )
+        ranks = {product_id: rank for rank, product_id in enumerate(ranked_ids)}
+
+        entries = []
+        for product_id, name in names.items():
+            words = tokenize(name)
+            for index in range(len(words)):
+                entries.append((" ".join(words[index:]), product_id))
+        entries.sort()
+
+        entry_ranks = array("I", [ranks[product_id] for _, product_id in entries])
+        size = len(entries)
+        best_positions = array("I", [0]) * size + array("I", range(size))
+        for node in range(size - 1, 0, -1):
+            left, right = best_positions[2 * node], best_positions[2 * node + 1]
+            best_positions[node] = left if entry_ranks[left] <= entry_ranks[right] else right
+
+        with self.lock:
+            self.keys = [key for key, _ in entries]
+            self.product_ids = array("I", [product_id for _, product_id in entries])
+            self.ranks = entry_ranks
+            self.best_positions = best_positions
+            self.names = names
+            self.branch_counts = branch_counts
+            self.version = version
+            self.built_at = time.monotonic()
+
+    def is_current(self):
+        check_seconds = settings.PRODUCT_AUTOCOMPLETE["VERSION_CHECK_SECONDS"]
+        return (
+            not self.stale
+            and self.checked_at is not None
+            and time.monotonic() - self.checked_at < check_seconds
+        )
+
+    def ensure_current(self):
+        if self.is_current():
+            return
+        # the first build has to be waited for, later ones are left to whichever thread started them:
+        if not self.build_lock.acquire(blocking=self.version is None):
+            return
+        try:
+            if self.is_current():
+                return
+            version = get_suggestion_version()
+            self.checked_at = time.monotonic()
+            max_age_seconds = settings.PRODUCT_AUTOCOMPLETE["MAX_AGE_SECONDS"]
+            if (
+                self.stale
+                or version != self.version
+                or self.checked_at - self.built_at >= max_age_seconds
+            ):
+                self.build(version)
+        finally:
+            self.build_lock.release()
+
+    def suggest(self, prefix, limit=None):
+        """
+        Return up to limit [{"id", "name", "branch_count"}] for the products with a word
+        starting with prefix, the ones stocked by the most branches first.
+        """
+        max_suggestions = settings.PRODUCT_AUTOCOMPLETE["MAX_SUGGESTIONS"]
+        limit = min(limit or max_suggestions, max_suggestions)
+        prefix = " ".join(tokenize(prefix))
+        if not prefix:
+            return []
+
+        self.ensure_current()
+        with self.lock:
+            start = bisect_left(self.keys, prefix)
+            end = bisect_left(self.keys, prefix + "\uffff", lo=start)
+
+            # take the best ranked keys out of the range one at a time:
+            suggested_ids = []
+            ranges = []
+            self._push_range(ranges, start, end)
+            while ranges and len(suggested_ids) < limit:
+                _, position, range_start, range_end = heapq.heappop(ranges)
+                product_id = self.product_ids[position]
+                # a product can have more than one word starting with the prefix:
+                if product_id not in suggested_ids:
+                    suggested_ids.append(product_id)
+                self._push_range(ranges, range_start, position)
+                self._push_range(ranges, position + 1, range_end)
+
+            return [
+                {
+                    "id": product_id,
+                    "name": self.names[product_id],
+                    "branch_count": self.branch_counts.get(product_id, 0),
+                }
+                for product_id in suggested_ids
+            ]
+
+    def _push_range(self, ranges, start, end):
+        if start < end:
+            position = self._best_position(start, end)
+            heapq.heappush(ranges, (self.ranks[position], position, start, end))
+
+    def _best_position(self, start, end):
+        # position of the best ranked key in keys[start:end]:
+        size = len(self.keys)
+        best_position = start
+        low, high = start + size, end + size
+        while low < high:
+            if low & 1:
+                position = self.best_positions[low]
+                if self.ranks[position] < self.ranks[best_position]:
+                    best_position = position
+                low += 1
+            if high & 1:
+                high -= 1
+                position = self.best_positions[high]
+                if self.ranks[position] < self.ranks[best_position]:
+                    best_position = position
+            low //= 2
+            high //= 2
+        return best_position
+
+
+product_autocomplete = ProductNameAutocomplete()
+
+
+def suggest_products(prefix, limit=None):
+    return product_autocomplete.suggest(prefix, limit)
@@ -0,0 +1,192 @@
+"""
+Versioned branch catalogs.
+
+Every branch has a catalog_version that the signals in apps/products/signals.py bump
+whenever one of its products or sale campaigns is saved or deleted, recording which
+products changed. Products show parts of their merchant, branch and global product
+too, so saving a change to CATALOG_FIELDS of those records a change for the products
+showing them. The mobile app keeps the version and ETag of the catalog it last
+downloaded so it can revalidate it with If-None-Match or ask for only what changed.
+"""
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import parse_etags
+
+from apps.merchants.models import Branch, MerchantBusiness, SaleCampaign
+from apps.products.models import BranchCatalogChange, BranchProduct, GlobalProduct
+from apps.products.pricing import active_sale_campaigns, calculate_sale_price
+from apps.products.serializers.serializers import (
+    BranchProductProjectionSerializer,
+    SaleCampaignProjectionSerializer,
+)
+
+# the fields catalogs and store lists show of merchants, branches and global products,
+# see MerchantSerializer and BranchProductProjectionSerializer:
+CATALOG_FIELDS = {
+    MerchantBusiness: ["name", "email", "address", "logo", "delivery_fee", "closing_time", "is_active"],
+    Branch: ["is_active", "address", "merchant_id"],
+    GlobalProduct: ["name", "description", "recommended_retail_price", "image", "photo", "category"],
+}
+
+
+def record_catalog_change(branch_id, branch_product_ids, removed=False):
+    with transaction.atomic():
+        # the update locks the branch row so concurrent changes get their own versions:
+        Branch.objects.filter(id=branch_id).update(catalog_version=F("catalog_version") + 1)
+        version = (
+            Branch.objects.filter(id=branch_id)
+            .values_list("catalog_version", flat=True)
+            .first()
+        )
+        if version is None:
+            # the branch itself is being deleted:
+            return None
+        BranchCatalogChange.objects.bulk_create([
+            BranchCatalogChange(
+                branch_id=branch_id,
+                branch_product_id=branch_product_id,
+                version=version,
+                removed=removed,
+            )
+            for branch_product_id in branch_product_ids
+        ])
+    return version
+
+
+def get_catalog_values(instance):
+    # read from __dict__ so instances loaded with only() don't query for the other fields:
+    return {field: instance.__dict__.get(field) for field in CATALOG_FIELDS[type(instance)]}
+
+
+def record_shown_change(instance):
+    """
+    Record a change for every product showing the merchant, branch or global product,
+    after one of its CATALOG_FIELDS changed. The catalog version of the branches of a
+    merchant is bumped even when they have no products since store lists show it too.
+    """
+    if isinstance(instance, GlobalProduct):
+        branch_ids = []
+        branch_products = BranchProduct.objects.filter(global_product_id=instance.id)
+    else:
+        if isinstance(instance, Branch):
+            branch_ids = [instance.id]
+        else:
+            branch_ids = list(Branch.objects.filter(merchant_id=instance.id).values_list("id", flat=True))
+        branch_products = BranchProduct.objects.filter(branch_id__in=branch_ids)
+
+    branch_product_ids = {branch_id: [] for branch_id in branch_ids}
+    for branch_id, branch_product_id in branch_products.order_by("id").values_list("branch_id", "id"):
+        branch_product_ids.setdefault(branch_id, []).append(branch_product_id)
+    for branch_id, ids in branch_product_ids.items():
+        record_catalog_change(branch_id, ids)
+
+
+def prune_catalog_changes():
+    """
+    Delete the recorded changes older than BRANCH_CATALOG["CHANGE_RETENTION_DAYS"]. Apps
+    that last synced before then can't be sent a delta anymore and get the full catalog.
+    Returns the number of changes deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.BRANCH_CATALOG["CHANGE_RETENTION_DAYS"])
+    deleted, _ = BranchCatalogChange.objects.filter(created__lt=cutoff).delete()
+    return deleted
+
+
+def make_catalog_etag(*parts):
+    # sale campaigns end at midnight without anything being saved so the date is always included:
+    serialized_parts = "|".join(str(part) for part in (*parts, timezone.localdate()))
+    return f'"{hashlib.sha1(serialized_parts.encode()).hexdigest()}"'
+
+
+def etag_matches(request, etag):
+    etags = parse_etags(request.headers.get("If-None-Match", ""))
+    return "*" in etags or etag in etags
+
+
+def get_catalog_changes(branch, since):
+    """
+    Return the ids of the products that changed and the ids of the products that were
+    removed from the branch catalog after version `since`. Returns None when the
+    changes can't be worked out and the full catalog has to be sent instead.
+    """
+    if since <= 0 or since > branch.catalog_version:
+        return None
+
+    since_created = (
+        BranchCatalogChange.objects.filter(branch_id=branch.id, version=since)
+        .values_list("created", flat=True)
+        .first()
+    )
+    if since_created is None:
+        return None
+
+    changed_ids = set()
+    removed_ids = set()
+    changes = BranchCatalogChange.objects.filter(
+        branch_id=branch.id, version__gt=since
+    ).values_list("branch_product_id", "removed")
+    for branch_product_id, removed in changes:
+        if removed:
+            removed_ids.add(branch_product_id)
+        else:
+            changed_ids.add(branch_product_id)
+
+    # products whose sale campaigns ended since then are back at their normal price:
+    changed_ids.update(
+        SaleCampaign.objects.filter(
+            branch=branch,
+            active=True,
+            campaign_ends__gte=timezone.localdate(since_created),
+            campaign_ends__lt=timezone.localdate(),
+        ).values_list("branch_product_id", flat=True)
+    )
+
+    changed_ids -= removed_ids
+    changed_ids.discard(None)
+    return sorted(changed_ids), sorted(removed_ids)
+
+
+def serialize_sale_campaigns(sale_campaigns):
+    # the products in the campaigns are shown at their sale price:
+    serialized_campaigns = SaleCampaignProjectionSerializer(sale_campaigns).data
+    for sale_campaign in serialized_campaigns:
+        branch_product = sale_campaign["branch_product"]
+        if branch_product is not None:
+            branch_product["branch_price"] = str(
+                calculate_sale_price(branch_product["branch_price"], sale_campaign["percentage_off"])
+            )
+    return serialized_campaigns
+
+
+def get_branch_catalog(branch, branch_product_ids=None):
+    """
+    Serialize the products of a branch with their sale prices applied, along with its
+    active sale campaigns. Pass branch_product_ids to only serialize those products.
+    """
+    branch_products = BranchProduct.objects.filter(branch=branch).order_by("id")
+    sale_campaigns = active_sale_campaigns().filter(branch=branch)
+    if branch_product_ids is not None:
+        branch_products = branch_products.filter(id__in=branch_product_ids)
+        sale_campaigns = sale_campaigns.filter(branch_product_id__in=branch_product_ids)
+
+    products = BranchProductProjectionSerializer(branch_products).data
+    sale_campaigns = serialize_sale_campaigns(sale_campaigns)
+
+    # price the whole catalog in one pass with the campaigns loaded above, the oldest campaign wins:
+    percentages_off = {}
+    for sale_campaign in sale_campaigns:
+        if sale_campaign["branch_product"] is not None:
+            percentages_off.setdefault(sale_campaign["branch_product"]["id"], sale_campaign["percentage_off"])
+    for product in products:
+        if product["id"] in percentages_off:
+            product["branch_price"] = str(
+                calculate_sale_price(product["branch_price"], percentages_off[product["id"]])
+            )
+
+    return products, sale_campaigns
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.products.catalog import prune_catalog_changes
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Delete the recorded branch catalog changes that are older than the retention "
+        "window. Run it nightly, apps that synced before then get the full catalog."
+    )
+
+    def handle(self, *args, **options):
+        deleted = prune_catalog_changes()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} catalog changes"))
@@ -29,3 +29,19 @@ class BranchProduct(models.Model):
 
     def __str__(self) -> str:
         return f"{self.branch.merchant.name} - Product {self.global_product.name}"
+
+
+class BranchCatalogChange(models.Model):
+
+    # plain ids so the change history survives products and branches being deleted:
+    branch_id = models.PositiveBigIntegerField()
+    branch_product_id = models.PositiveBigIntegerField()
+    version = models.PositiveIntegerField()
+    removed = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["branch_id", "version"])]
+
+    def __str__(self) -> str:
+        return f"Branch {self.branch_id} - Version {self.version}"
@@ -0,0 +1,161 @@
+"""
+Effective (sale adjusted) prices of branch products.
+
+A branch product is on sale when it has an active sale campaign that has not ended yet.
+If a product somehow has more than one, the oldest campaign applies. All prices are
+calculated with Decimal and rounded half up to cents so that every screen, the order
+history and the payment balancing agree on the same amount.
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db.models import (
+    Case,
+    DecimalField,
+    ExpressionWrapper,
+    F,
+    FilteredRelation,
+    OuterRef,
+    Q,
+    Subquery,
+    When,
+)
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from apps.merchants.models import SaleCampaign
+from apps.products.models import BranchProduct
+
+CENTS = Decimal("0.01")
+
+
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    # go through str so floats don't drag their binary representation along:
+    return Decimal(str(value or 0))
+
+
+def calculate_sale_price(price, percentage_off):
+    price = to_decimal(price)
+    discount = price * to_decimal(percentage_off) / Decimal(100)
+    return (price - discount).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def active_sale_campaigns():
+    return SaleCampaign.objects.filter(
+        active=True, campaign_ends__gte=timezone.localdate()
+    ).order_by("id")
+
+
+def annotate_sale_campaigns(branch_products):
+    """
+    Annotate a BranchProduct queryset with the id and percentage off of its active sale
+    campaign (if any) and a database side final_price that can be used for ordering and
+    filtering.
+    """
+    campaigns = active_sale_campaigns().filter(branch_product=OuterRef("pk"))
+    price_field = DecimalField(max_digits=10, decimal_places=2)
+    return branch_products.annotate(
+        sale_campaign_id=Subquery(campaigns.values("id")[:1]),
+        campaign_percentage=Subquery(campaigns.values("percentage_off")[:1]),
+    ).annotate(
+        final_price=Case(
+            When(
+                sale_campaign_id__isnull=False,
+                # rounded to cents like calculate_sale_price so the value can be compared exactly:
+                then=Round(
+                    ExpressionWrapper(
+                        F("branch_price") - (F("branch_price") * F("campaign_percentage") / 100),
+                        output_field=price_field,
+                    ),
+                    2,
+                    output_field=price_field,
+                ),
+            ),
+            default=F("branch_price"),
+            output_field=price_field,
+        )
+    )
+
+
+def join_active_sale_campaigns(branch_products):
+    """
+    Left join a BranchProduct queryset to its active sale campaigns as
+    "active_sale_campaign", eg. values("active_sale_campaign__percentage_off"). Cheaper
+    than annotate_sale_campaigns for large bulk reads, but a product with more than one
+    active campaign comes back once per campaign so callers keep the oldest one.
+    """
+    return branch_products.annotate(
+        active_sale_campaign=FilteredRelation(
+            "salecampaign",
+            condition=Q(
+                salecampaign__active=True,
+                salecampaign__campaign_ends__gte=timezone.localdate(),
+            ),
+        )
+    )
+
+
+def read_effective_prices(branch_products, fields):
+    """
+    Read the given fields of every product in a BranchProduct queryset along with its
+    sale_campaign_id and effective_price, using a single joined query. Returns a list
+    of dicts, one per branch product.
+    """
+    rows = list(
+        join_active_sale_campaigns(branch_products).values(
+            "id",
+            "branch_price",
+            *fields,
+            sale_campaign_id=F("active_sale_campaign__id"),
+            percentage_off=F("active_sale_campaign__percentage_off"),
+        ).order_by("sale_campaign_id")
+    )
+
+    # the oldest campaign of a product comes first and wins:
+    effective_prices = {}
+    for row in rows:
+        if row["id"] not in effective_prices:
+            row["effective_price"] = build_effective_price(
+                row["branch_price"], row["sale_campaign_id"], row["percentage_off"]
+            )["effective_price"]
+            effective_prices[row["id"]] = row
+    return list(effective_prices.values())
+
+
+def build_effective_price(branch_price, sale_campaign_id=None, percentage_off=None):
+    branch_price = to_decimal(branch_price)
+    on_sale = sale_campaign_id is not None
+    return {
+        "branch_price": branch_price.quantize(CENTS, rounding=ROUND_HALF_UP),
+        "sale_campaign_id": sale_campaign_id,
+        "percentage_off": percentage_off if on_sale else None,
+        "effective_price": (
+            calculate_sale_price(branch_price, percentage_off) if on_sale
+            else branch_price.quantize(CENTS, rounding=ROUND_HALF_UP)
+        ),
+    }
+
+
+def get_effective_prices(branch_product_ids):
+    """
+    Return {branch_product_id: effective price} for the given ids using a single query.
+    Each effective price is a dict with the branch_price, the sale_campaign_id and
+    percentage_off of the campaign that applies (None if not on sale) and the
+    effective_price the customer pays.
+    """
+    branch_product_ids = set(branch_product_ids)
+    if not branch_product_ids:
+        return {}
+
+    rows = annotate_sale_campaigns(
+        BranchProduct.objects.filter(id__in=branch_product_ids)
+    ).values("id", "branch_price", "sale_campaign_id", "campaign_percentage")
+
+    return {
+        row["id"]: build_effective_price(
+            row["branch_price"], row["sale_campaign_id"], row["campaign_percentage"]
+        )
+        for row in rows
+    }
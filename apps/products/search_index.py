@@ -0,0 +1,273 @@
+"""
+In-process inverted index over the names and descriptions of global products.
+
+Searching with icontains is a leading wildcard LIKE that can't use an index, so every
+search used to scan all branch products. Instead, the words of every global product
+are indexed here and a search looks up the matching global products (ranked by
+relevance) first. The branch products are then fetched through their indexed
+global_product foreign key.
+
+Query words that don't match any indexed word (eg. "Royl Canin" or "pedegree") fall
+back to a trigram index over the words in product names, which finds the most
+similar ones instead.
+
+The index is built on the first search and kept up to date by the GlobalProduct
+signals in apps/products/signals.py. Other processes don't get those signals, so every
+process also rebuilds its index once it is older than
+PRODUCT_SEARCH_INDEX["REFRESH_SECONDS"]. Rebuilds read the table into a new index that
+is only swapped in once it is complete, searches use the current one in the meantime.
+"""
+
+import math
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+
+from django.conf import settings
+
+from apps.products.models import GlobalProduct
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# a word in the name of a product says more about it than one in its description:
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+
+# a query word that is only the start of a word (eg. "puppy" for "puppies") counts for less:
+PREFIX_MATCH_WEIGHT = 0.5
+
+# how similar (shared trigrams / all trigrams) a misspelt word has to be to a product word:
+MIN_TRIGRAM_SIMILARITY = 0.3
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text or "").lower())
+
+
+def get_trigrams(word):
+    # padded like postgres' pg_trgm so the start and end of the word count too:
+    padded_word = f"  {word} "
+    return {padded_word[index:index + 3] for index in range(len(padded_word) - 2)}
+
+
+class ProductSearchIndex():
+
+    def __init__(self):
+        # word -> {global product id: weight of the word in that product}:
+        self.postings = {}
+        # global product id -> the words it was indexed under:
+        self.product_words = {}
+        # every indexed word, sorted so words starting with a prefix can be found with bisect:
+        self.words = []
+        # the trigram index over the words in product names, held in compact arrays.
+        # trigram -> ids of the name words containing it:
+        self.trigram_words = {}
+        # name word -> its id, and the word and trigram count of every id:
+        self.name_word_ids = {}
+        self.name_words = []
+        self.name_word_trigram_counts = array("B")
+        self.built_at = None
+        self.lock = threading.RLock()
+        # only one thread builds at a time, the others keep searching the current index:
+        self.build_lock = threading.Lock()
+        # products added or removed while a build is reading the table, replayed onto the new index:
+        self.changes_during_build = None
+
+    def build(self):
+        with self.build_lock:
+            self._build()
+
+    def refresh(self):
+        # the first build has to be waited for, later ones are left to whichever thread started them:
+        if not self.build_lock.acquire(blocking=self.built_at is None):
+            return
+        try:
+            if self.is_stale():
+                self._build()
+        finally:
+            self.build_lock.release()
+
+    def _build(self):
+        # the new index is built without holding the lock and only swapped in once it is complete:
+        with self.lock:
+            self.changes_during_build = []
+        new_index = ProductSearchIndex()
+        try:
+            products = GlobalProduct.objects.values_list("id", "name", "description")
+            for product_id, name, description in products.iterator():
+                new_index._index_product(product_id, name, description)
+        except Exception:
+            with self.lock:
+                self.changes_during_build = None
+            raise
+
+        with self.lock:
+            for product_id, product in self.changes_during_build:
+                new_index._remove_product(product_id)
+                if product is not None:
+                    new_index._index_product(product_id, *product)
+            self.changes_during_build = None
+            self.postings = new_index.postings
+            self.product_words = new_index.product_words
+            self.words = sorted(new_index.postings)
+            self.trigram_words = new_index.trigram_words
+            self.name_word_ids = new_index.name_word_ids
+            self.name_words = new_index.name_words
+            self.name_word_trigram_counts = new_index.name_word_trigram_counts
+            self.built_at = time.monotonic()
+
+    def is_stale(self):
+        refresh_seconds = settings.PRODUCT_SEARCH_INDEX["REFRESH_SECONDS"]
+        return self.built_at is None or time.monotonic() - self.built_at > refresh_seconds
+
+    def add_product(self, product_id, name, description):
+        with self.lock:
+            if self.changes_during_build is not None:
+                self.changes_during_build.append((product_id, (name, description)))
+            if self.built_at is None:
+                # the whole index is built on the next search anyway:
+                return
+            self._remove_product(product_id)
+            for word in self._index_product(product_id, name, description):
+                if len(self.postings[word]) == 1:
+                    insort(self.words, word)
+
+    def remove_product(self, product_id):
+        with self.lock:
+            if self.changes_during_build is not None:
+                self.changes_during_build.append((product_id, None))
+            if self.built_at is not None:
+                self._remove_product(product_id)
+
+    def search(self, query):
+        """
+        Return [(global product id, relevance)] for the products that have a word
+        starting with every word of the query, most relevant first.
+        """
+        query_words = list(dict.fromkeys(tokenize(query)))
+        if not query_words:
+            return []
+
+        if self.is_stale():
+            self.refresh()
+
+        with self.lock:
+            scores = None
+            for query_word in query_words:
+                word_scores = self._score_word(query_word)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {
+                        product_id: scores[product_id] + score
+                        for product_id, score in word_scores.items() if product_id in scores
+                    }
+                if not scores:
+                    return []
+
+        return sorted(scores.items(), key=lambda match: (-match[1], match[0]))
+
+    def _score_word(self, query_word):
+        # tf-idf like score of every product with a word that starts with (or looks like) query_word:
+        matching_words = []
+        index = bisect_left(self.words, query_word)
+        while index < len(self.words) and self.words[index].startswith(query_word):
+            matching_words.append(self.words[index])
+            index += 1
+
+        match_weights = {
+            word: 1.0 if word == query_word else PREFIX_MATCH_WEIGHT for word in matching_words
+        }
+        if not match_weights:
+            # probably misspelt, use the most similar words in product names instead:
+            match_weights = {
+                word: similarity * PREFIX_MATCH_WEIGHT
+                for word, similarity in self.find_similar_words(query_word)
+            }
+
+        word_scores = {}
+        for word, match_weight in match_weights.items():
+            for product_id, weight in self.postings[word].items():
+                score = weight * match_weight
+                if score > word_scores.get(product_id, 0):
+                    word_scores[product_id] = score
+
+        # query words that few products match say more about what the customer wants:
+        rarity = math.log(1 + len(self.product_words) / max(len(word_scores), 1))
+        return {product_id: score * rarity for product_id, score in word_scores.items()}
+
+    def _index_product(self, product_id, name, description):
+        name_words = tokenize(name)
+        weights = Counter()
+        for word in name_words:
+            weights[word] += NAME_WEIGHT
+        for word in tokenize(description):
+            weights[word] += DESCRIPTION_WEIGHT
+
+        # matching one word of a short name means more than matching one of a long name:
+        length_norm = 1 + math.log(1 + len(name_words))
+        for word, weight in weights.items():
+            self.postings.setdefault(word, {})[product_id] = weight / length_norm
+        for word in name_words:
+            self._index_name_word(word)
+        self.product_words[product_id] = list(weights)
+        return list(weights)
+
+    def _index_name_word(self, word):
+        # words are only ever added, words that are no longer used are dropped on the next build:
+        if word in self.name_word_ids or len(word) < 3:
+            return
+        word_id = len(self.name_words)
+        self.name_word_ids[word] = word_id
+        self.name_words.append(word)
+        trigrams = get_trigrams(word)
+        self.name_word_trigram_counts.append(min(len(trigrams), 255))
+        for trigram in trigrams:
+            self.trigram_words.setdefault(trigram, array("I")).append(word_id)
+
+    def find_similar_words(self, query_word):
+        """
+        Return [(name word, similarity)] for the words in product names that share
+        enough trigrams with query_word, most similar first.
+        """
+        if len(query_word) < 3:
+            return []
+        query_trigrams = get_trigrams(query_word)
+        shared_trigrams = Counter()
+        for trigram in query_trigrams:
+            word_ids = self.trigram_words.get(trigram)
+            if word_ids is not None:
+                shared_trigrams.update(word_ids)
+
+        similar_words = []
+        for word_id, shared in shared_trigrams.items():
+            similarity = shared / (
+                len(query_trigrams) + self.name_word_trigram_counts[word_id] - shared
+            )
+            word = self.name_words[word_id]
+            if similarity >= MIN_TRIGRAM_SIMILARITY and word in self.postings:
+                similar_words.append((word, similarity))
+        similar_words.sort(key=lambda similar_word: (-similar_word[1], similar_word[0]))
+        return similar_words
+
+    def _remove_product(self, product_id):
+        for word in self.product_words.pop(product_id, []):
+            postings = self.postings.get(word)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self.postings[word]
+                index = bisect_left(self.words, word)
+                if index < len(self.words) and self.words[index] == word:
+                    del self.words[index]
+
+
+product_search_index = ProductSearchIndex()
+
+
+def search_products(query):
+    return product_search_index.search(query)
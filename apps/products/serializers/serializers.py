@@ -6,6 +6,13 @@ from apps.accounts.models import UserAccount
 from apps.merchants.models import MerchantBusiness
 from apps.merchants.serializers.merchant_serializer import BranchSerializer
 from apps.products.models import BranchProduct, GlobalProduct
+from global_serializer_functions.projection_serializer import (
+    ProjectionSerializer,
+    date_to_string,
+    decimal_to_string,
+    file_to_url,
+    time_to_string,
+)
 
 class ProductSerializer(ModelSerializer):
 
@@ -61,3 +68,65 @@ class BranchProductSerializer(ModelSerializer):
     
     def create(self, validated_data):
         return super().create(validated_data)
+
+
+class BranchProductProjectionSerializer(ProjectionSerializer):
+
+    """
+    Lean version of BranchProductSerializer for catalogs and search results. Only the
+    product and the parts of the branch and merchant the app shows are included.
+    """
+
+    fields = [
+        "id",
+        "branch_price",
+        "global_product__id",
+        "global_product__name",
+        "global_product__description",
+        "global_product__recommended_retail_price",
+        "global_product__image",
+        "global_product__photo",
+        "global_product__category",
+        "branch__id",
+        "branch__is_active",
+        "branch__address",
+        "branch__merchant__id",
+        "branch__merchant__name",
+        "branch__merchant__logo",
+        "branch__merchant__address",
+        "branch__merchant__delivery_fee",
+        "branch__merchant__closing_time",
+    ]
+
+    formatters = {
+        "branch_price": decimal_to_string,
+        "global_product__photo": file_to_url,
+        "branch__merchant__delivery_fee": decimal_to_string,
+        "branch__merchant__closing_time": time_to_string,
+    }
+
+
+class SaleCampaignProjectionSerializer(ProjectionSerializer):
+
+    """
+    Lean version of SaleCampaignSerializer. The branch product is nested the same way
+    as in BranchProductProjectionSerializer, its price is not discounted here.
+    """
+
+    fields = [
+        "id",
+        "percentage_off",
+        "campaign_ends",
+        "branch__id",
+        "branch__address",
+        "branch__merchant__id",
+        "branch__merchant__name",
+    ] + [f"branch_product__{field}" for field in BranchProductProjectionSerializer.fields]
+
+    formatters = {
+        "campaign_ends": date_to_string,
+        **{
+            f"branch_product__{field}": formatter
+            for field, formatter in BranchProductProjectionSerializer.formatters.items()
+        },
+    }
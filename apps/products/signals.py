@@ -0,0 +1,107 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from apps.merchants.models import Branch, MerchantBusiness, SaleCampaign
+from apps.products.autocomplete import product_autocomplete
+from apps.products.catalog import get_catalog_values, record_catalog_change, record_shown_change
+from apps.products.search_index import product_search_index
+from .models import BranchProduct, GlobalProduct
+
+
+@receiver(post_init, sender=BranchProduct)
+def branch_product_loaded_handler(sender, instance: BranchProduct, **kwargs):
+    """
+    Remember the branch of the product so moving it to another branch removes it there.
+    """
+    # read from __dict__ so instances loaded with only() don't query for it:
+    instance._catalog_branch_id = instance.__dict__.get("branch_id")
+
+
+@receiver(post_save, sender=BranchProduct)
+def branch_product_post_save_handler(sender, instance: BranchProduct, **kwargs):
+    """
+    Bump the catalog version of the branch so apps pick up the new or updated product,
+    and of the branch it was moved from so apps drop it there.
+    """
+    saved_branch_id = getattr(instance, "_catalog_branch_id", None)
+    if saved_branch_id is not None and saved_branch_id != instance.branch_id:
+        record_catalog_change(saved_branch_id, [instance.id], removed=True)
+    record_catalog_change(instance.branch_id, [instance.id])
+    instance._catalog_branch_id = instance.branch_id
+
+
+@receiver(post_delete, sender=BranchProduct)
+def branch_product_post_delete_handler(sender, instance: BranchProduct, **kwargs):
+    """
+    Bump the catalog version of the branch so apps drop the deleted product.
+    """
+    record_catalog_change(instance.branch_id, [instance.id], removed=True)
+
+
+@receiver(post_init, sender=SaleCampaign)
+def sale_campaign_loaded_handler(sender, instance: SaleCampaign, **kwargs):
+    """
+    Remember the product the sale campaign reprices so moving it reprices that one too.
+    """
+    instance._catalog_product = (instance.__dict__.get("branch_id"), instance.__dict__.get("branch_product_id"))
+
+
+@receiver(post_save, sender=SaleCampaign)
+@receiver(post_delete, sender=SaleCampaign)
+def sale_campaign_changed_handler(sender, instance: SaleCampaign, **kwargs):
+    """
+    Bump the catalog version of the branch when a sale campaign reprices one of its
+    products, and record the product it repriced before if it was moved.
+    """
+    branch_product_ids = {}
+    for branch_id, branch_product_id in {
+        (instance.branch_id, instance.branch_product_id),
+        getattr(instance, "_catalog_product", (None, None)),
+    }:
+        if branch_id and branch_product_id:
+            branch_product_ids.setdefault(branch_id, []).append(branch_product_id)
+    for branch_id, ids in branch_product_ids.items():
+        record_catalog_change(branch_id, sorted(ids))
+    instance._catalog_product = (instance.branch_id, instance.branch_product_id)
+
+
+@receiver(post_init, sender=MerchantBusiness)
+@receiver(post_init, sender=Branch)
+@receiver(post_init, sender=GlobalProduct)
+def shown_in_catalog_loaded_handler(sender, instance, **kwargs):
+    """
+    Remember what catalogs show of the merchant, branch or global product so saves can tell whether it changed.
+    """
+    instance._catalog_values = get_catalog_values(instance)
+
+
+@receiver(post_save, sender=MerchantBusiness)
+@receiver(post_save, sender=Branch)
+@receiver(post_save, sender=GlobalProduct)
+def shown_in_catalog_post_save_handler(sender, instance, created, **kwargs):
+    """
+    Bump the catalog version of the branches showing the merchant, branch or global
+    product when what they show of it changed, so apps don't keep an old delivery fee.
+    """
+    catalog_values = get_catalog_values(instance)
+    if not created and catalog_values != getattr(instance, "_catalog_values", catalog_values):
+        record_shown_change(instance)
+    instance._catalog_values = catalog_values
+
+
+@receiver(post_save, sender=GlobalProduct)
+def global_product_post_save_handler(sender, instance: GlobalProduct, **kwargs):
+    """
+    Re-index the name and description of the product so searches find it straight away.
+    """
+    product_search_index.add_product(instance.id, instance.name, instance.description)
+    product_autocomplete.mark_stale()
+
+
+@receiver(post_delete, sender=GlobalProduct)
+def global_product_post_delete_handler(sender, instance: GlobalProduct, **kwargs):
+    """
+    Drop the deleted product from the search index.
+    """
+    product_search_index.remove_product(instance.id)
+    product_autocomplete.mark_stale()
@@ -16,6 +16,8 @@ class Transaction(models.Model):
         ("RECEIVED_BY_PAYGATE", "Received by PayGate"),
         ("SETTLEMENT_VOIDED", "Settlement Voided"),
         ("CUSTOMER_CANCELLED", "Customer Cancelled"),
+        # paid after the transaction was failed or cancelled, the customer has to be refunded:
+        ("REFUND_DUE", "Refund Due"),
     ]
 
     reference = models.CharField(max_length=191, blank=False, null=True)
@@ -0,0 +1,81 @@
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+# formatters that give the same output as the matching rest framework fields:
+
+def decimal_to_string(value):
+    return f"{value:.2f}"
+
+
+def file_to_url(name):
+    return default_storage.url(name) if name else None
+
+
+date_to_string = serializers.DateField().to_representation
+datetime_to_string = serializers.DateTimeField().to_representation
+time_to_string = serializers.TimeField().to_representation
+
+
+class ProjectionSerializer():
+
+    """
+    Serializes a queryset with a single values() query instead of walking model
+    instances. `fields` are values() lookups such as "branch__merchant__name" and every
+    row is nested on "__" so the output has the shape a nested ModelSerializer would
+    give, minus everything that isn't listed. Relations that are not set come out as None.
+    """
+
+    fields = []
+
+    # field -> function used to format its value when it isn't None:
+    formatters = {}
+
+    def __init__(self, queryset, prefix="", extra_fields=()):
+        # prefix lets the same fields be read through a relation, eg. a many to many table:
+        self.queryset = queryset
+        self.prefix = prefix
+        self.extra_fields = list(extra_fields)
+        self.rows = None
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            lookups = [f"{self.prefix}{field}" for field in self.fields]
+            self.rows = list(self.queryset.values(*lookups, *self.extra_fields))
+            self._data = [self.to_representation(row) for row in self.rows]
+        return self._data
+
+    def stream(self, chunk_size=2000):
+        """
+        Yield (row, representation) one row at a time instead of building the whole list,
+        the queryset is read in chunks of chunk_size.
+        """
+        lookups = [f"{self.prefix}{field}" for field in self.fields]
+        rows = self.queryset.values(*lookups, *self.extra_fields).iterator(chunk_size=chunk_size)
+        for row in rows:
+            yield row, self.to_representation(row)
+
+    def to_representation(self, row):
+        representation = {}
+        for field in self.fields:
+            value = row[f"{self.prefix}{field}"]
+            formatter = self.formatters.get(field)
+            if formatter is not None and value is not None:
+                value = formatter(value)
+
+            *relations, name = field.split("__")
+            nested = representation
+            for relation in relations:
+                nested = nested.setdefault(relation, {})
+            nested[name] = value
+        return self.drop_missing_relations(representation)
+
+    def drop_missing_relations(self, representation):
+        for key, value in representation.items():
+            if isinstance(value, dict):
+                representation[key] = (
+                    None if "id" in value and value["id"] is None
+                    else self.drop_missing_relations(value)
+                )
+        return representation
@@ -1,3 +1,5 @@
+import os
+import unittest
 from datetime import datetime, timedelta
 from django.test import TestCase
 from django.contrib.auth.models import User
@@ -8,6 +10,11 @@ from rest_framework.authtoken.models import Token
 
 # test functions shared by all tests
 
+# benchmarks load production sized fixtures so they only run when RUN_BENCHMARKS is set:
+benchmark = unittest.skipUnless(
+    os.environ.get("RUN_BENCHMARKS"), "set RUN_BENCHMARKS=1 to run the benchmarks"
+)
+
 
 class MockedPaystackResponse:
     status_code = 200
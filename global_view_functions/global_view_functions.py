@@ -1,6 +1,5 @@
 
 
-import traceback
 
 import hashlib
 
@@ -17,8 +16,6 @@ from apps.accounts.models import UserAccount
 from apps.accounts.tokens import accountActivationTokenGenerator
 
 from apps.merchants.models import Branch, MerchantBusiness
-from apps.products.models import GlobalProduct
-from apps.products.serializers.serializers import ProductSerializer
 
 import logging
 
@@ -75,23 +72,6 @@ class GlobalViewFunctions():
     def notify_all_of_item_creation(self, instance):
         pass
 
-    def get_products(self, branch):
-        logger.info("Getting updated stores near customer...")
-        try:
-            products = GlobalProduct.objects.filter(
-                is_active=True,
-                branch=branch,
-                in_stock=True,
-            )
-            if products:
-                serializer = ProductSerializer(products, many=True)
-            else:
-                raise Exception("No Product was found")
-            return serializer.data
-        except Exception as e:
-            tb = traceback.format_exc()
-            raise Exception(f"{tb}")
-
     def send_activation_email(self, user_account, request):
         mail_subject = "Littlebuddies Email Activation"
         user = User.objects.get(id=user_account["user"]["id"])
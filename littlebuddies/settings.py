@@ -48,6 +48,75 @@ FERNET_KEY = os.environ.get("FERNET_KEY").encode()
 # TODO: restrict api key access to server ip address:
 GOOGLE_SERVICES_API_KEY = os.environ.get("GOOGLE_SERVICES_API_KEY")
 
+# how far (in km) from the customer a branch can be to be shown as in range:
+STORE_RANGE_RADIUS_KM = 20
+
+# google maps responses are cached in the database to save on api calls:
+GOOGLE_MAPS_CACHE = {
+    "TTL_SECONDS": 60 * 60 * 24 * 30,
+    "MAX_ENTRIES": 50000,
+    # eviction scans the whole table so each process runs it at most this often:
+    "EVICT_EVERY_SECONDS": 300,
+    # 3 decimal places is roughly 110m, customers this close share cache entries:
+    "COORDINATE_PRECISION": 3,
+}
+
+# driving distances from customers to branches (see apps/merchants/branch_distances.py):
+DISTANCE_MATRIX = {
+    # google accepts up to 25 destinations per request:
+    "MAX_DESTINATIONS": 25,
+    # travel times change with traffic and roadworks so they aren't kept as long as addresses:
+    "TTL_SECONDS": 60 * 60 * 24,
+    # used to estimate distances when google can't answer:
+    "ROAD_DISTANCE_FACTOR": 1.3,
+    "FALLBACK_SPEED_KMH": 40,
+}
+
+# the in-process product search index (see apps/products/search_index.py):
+PRODUCT_SEARCH_INDEX = {
+    # each process rebuilds its index this often to pick up changes made by other processes:
+    "REFRESH_SECONDS": 60 * 10,
+}
+
+# pages of product search results (see apps/price_comparison/search_cache.py), entries stop
+# being used as soon as a branch they cover changes, the ttl picks up product renames:
+PRODUCT_SEARCH_CACHE = {
+    "TTL_SECONDS": 60 * 10,
+}
+
+# product name suggestions (see apps/products/autocomplete.py):
+PRODUCT_AUTOCOMPLETE = {
+    # how often each process checks whether the names or stock of products changed:
+    "VERSION_CHECK_SECONDS": 5,
+    # each process rebuilds its index at least this often to pick up products renamed by other processes:
+    "MAX_AGE_SECONDS": 60 * 10,
+    "MAX_SUGGESTIONS": 10,
+}
+
+# outbound http calls (eg. google maps) made during a request run on this shared pool:
+OUTBOUND_POOL = {
+    "MAX_WORKERS": 8,
+    # how long a request waits for a single call before giving up on it:
+    "TIMEOUT_SECONDS": 5,
+}
+
+# the merchant order feed (see apps/orders/order_feed.py):
+ORDER_FEED = {
+    # how long a feed request waits for an order to change before answering with nothing,
+    # kept under the usual 30 second proxy timeouts:
+    "MAX_WAIT_SECONDS": 25,
+    "MAX_ORDERS": 50,
+    # how often the poller of each process checks for orders changed by other processes,
+    # while requests are waiting:
+    "POLL_SECONDS": 1,
+    # orders are stamped before they commit, the poller looks back this far to find late ones:
+    "POLL_LOOKBACK_SECONDS": 60,
+    # every waiting request holds a worker thread, keep this well under the threads per process:
+    "MAX_WAITING_REQUESTS": 100,
+    # how long apps are told to wait before retrying when the feed is busy:
+    "BUSY_RETRY_SECONDS": 5,
+}
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
@@ -58,6 +127,42 @@ FIREBASE_APP = FirebaseApp()
 # Paystack stuff
 PAYSTACK_SECRET_KEY = "sk_test_8d7f4a2a27d5fd71a22a1590dde35b2d61fe6895"
 
+# calls to the paystack api (see apps/paystack/paystack_client.py):
+PAYSTACK_CLIENT = {
+    "BASE_URL": "https://api.paystack.co",
+    "CONNECT_TIMEOUT_SECONDS": 3,
+    "READ_TIMEOUT_SECONDS": 10,
+    # only calls that are safe to repeat (eg. verifying a payment) are retried:
+    "MAX_RETRIES": 2,
+    "BACKOFF_SECONDS": 0.25,
+    # kept alive connections per process:
+    "POOL_SIZE": 10,
+}
+
+# processing of the stored paystack webhook events (see apps/paystack/webhook_inbox.py):
+PAYSTACK_WEBHOOKS = {
+    "BATCH_SIZE": 100,
+    # how often the process_paystack_events worker looks for new events:
+    "POLL_SECONDS": 1,
+    # events that keep failing are left for someone to look at:
+    "MAX_ATTEMPTS": 5,
+}
+
+# the reconcile_payments job (see apps/paystack/reconciliation.py):
+PAYSTACK_RECONCILIATION = {
+    # customers can still finish paying for a while, so only older payments are checked:
+    "STALE_AFTER_MINUTES": 120,
+    "PAGE_SIZE": 1000,
+    # verify calls in flight at once:
+    "CONCURRENCY": 16,
+}
+
+# recorded branch catalog changes (see apps/products/catalog.py), pruned by prune_catalog_changes:
+BRANCH_CATALOG = {
+    # catalog deltas can only be sent to apps that synced within this many days:
+    "CHANGE_RETENTION_DAYS": 30,
+}
+
 # server stuff
 DEVELOPEMENT_URL = (
     "https://3f63-41-10-122-84.ngrok-free.app"  # using ngrok server during development
@@ -38,6 +38,16 @@ urlpatterns = [
         include("apps.merchant_dashboard.urls"),
         name="merchant_dashboard",
     ),
+    path(
+        "merchant_wallets/",
+        include("apps.merchant_wallets.urls"),
+        name="merchant_wallets",
+    ),
+    path(
+        "integrations/",
+        include("apps.integrations.urls"),
+        name="integrations",
+    ),
     path(
         "paystack/",
         include("apps.paystack.urls"),